@@ -0,0 +1,389 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from ipa_client import IPAClient
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+
+'''
+Module for keeping a local replica of the IPA accounts that may open the door.
+
+The AccessCache maps a card's employeenumber (the 8 digit ID on the card) to
+the few attributes that Account.has_access() needs to make a decision, so a
+swipe can be answered without a round trip to the IPA server.
+
+The cache is filled in bulk from the members of the allowed groups, and
+individual entries are added whenever a live lookup succeeds. Entries older
+than the configured TTL are treated as misses, and once the cache holds more
+than max_entries the least recently refreshed entries are evicted.
+
+Lookups never take the lock. Writers build a new dict and swap it in, so a
+reader always sees either the old or the new index.
+
+Removed accounts are remembered for one TTL, so replication (see
+replication.py) does not bring them back from a peer that still has them.
+`merge()` only takes records newer than what the cache already knows.
+'''
+
+class GroupNames:
+    '''
+    Numbers the groups access can be granted to, so that an entry's groups
+    are an int with a bit per group. Groups get a number when the policy or
+    the allowed groups name them (`register()`); entries only keep those, so
+    masks stay as wide as the configured groups however many groups the realm
+    has. The numbers are only valid in this process; the cache file and
+    replication use the names.
+
+    Masks and name tuples are interned as well, so entries in the same groups
+    share them.
+    '''
+
+    def __init__(self) -> None:
+        self.bits: Dict[str, int] = {}
+        self._names: List[str] = []
+        self._masks: Dict[int, int] = {}
+        self._tuples: Dict[int, Tuple[str, ...]] = {}
+        self._lock = threading.Lock()
+
+    def bit(self, group: str) -> int:
+        '''
+        The bit of `group`, numbering it if it has none yet.
+        '''
+        bit = self.bits.get(group)
+        if bit is None:
+            with self._lock:
+                bit = self.bits.get(group)
+                if bit is None:
+                    bit = 1 << len(self._names)
+                    self._names.append(sys.intern(group))
+                    self.bits[group] = bit
+        return bit
+
+    def register(self, groups: Iterable[str]) -> int:
+        '''
+        Number all of `groups` and return their mask.
+        '''
+        mask = 0
+        for group in groups:
+            mask |= self.bit(group)
+        return self._masks.setdefault(mask, mask)
+
+    def mask(self, groups: Iterable[str]) -> int:
+        '''
+        The mask of those of `groups` that are numbered, the others are
+        dropped.
+        '''
+        bits = self.bits
+        mask = 0
+        for group in groups:
+            mask |= bits.get(group, 0)
+        return self._masks.setdefault(mask, mask)
+
+    def names(self, mask: int) -> Tuple[str, ...]:
+        names = self._tuples.get(mask)
+        if names is None:
+            names = tuple(name for i, name in enumerate(self._names) if mask >> i & 1)
+            self._tuples[mask] = names
+        return names
+
+GROUPS = GroupNames()
+
+class AccessEntry:
+    '''
+    The parts of an IPA account needed to decide whether a swipe is allowed.
+
+    Entries are slotted and hold their groups as a mask of GROUPS bits, as
+    the cache keeps one per account. Groups GROUPS has not numbered are not
+    kept, no policy grants access to them.
+    '''
+    __slots__ = ('id', 'uid', 'lcc', 'group_mask', 'fetched_at', 'changed_at')
+
+    def __init__(self, id: str, uid: str, lcc: str, groups: Iterable[str] = (), fetched_at: float = 0.0, changed_at: float = 0.0, group_mask: Optional[int] = None) -> None:
+        self.id = id
+        self.uid = uid
+        # there are only a hundred LCCs, every entry shares one of them
+        self.lcc = sys.intern(lcc)
+        self.group_mask = GROUPS.mask(groups) if group_mask is None else group_mask
+        # time.time() at which the entry was fetched from IPA
+        self.fetched_at = fetched_at
+        # time.time() at which it was changed locally, by a swipe with a newer LCC
+        self.changed_at = changed_at
+
+    @property
+    def groups(self) -> Tuple[str, ...]:
+        return GROUPS.names(self.group_mask)
+
+    @property
+    def version(self) -> float:
+        return max(self.fetched_at, self.changed_at)
+
+    def replace(self, **changes) -> 'AccessEntry':
+        '''
+        A copy of the entry with `changes` applied.
+        '''
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return AccessEntry(**fields)
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'uid': self.uid, 'lcc': self.lcc, 'groups': list(self.groups), 'fetched_at': self.fetched_at, 'changed_at': self.changed_at}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, AccessEntry):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"AccessEntry(id={self.id!r}, uid={self.uid!r}, lcc={self.lcc!r}, groups={list(self.groups)!r}, fetched_at={self.fetched_at!r}, changed_at={self.changed_at!r})"
+
+    @staticmethod
+    def from_ipa_user(user: dict, fetched_at: float, id: Optional[str] = None) -> Optional['AccessEntry']:
+        '''
+        Build an entry from one element of a `user_find` result. `id` is the
+        card ID searched for, if the user was found by it. Returns None if the
+        user has no card ID or LCC set.
+        '''
+        try:
+            return AccessEntry(
+                id=id if id is not None else user['employeenumber'][0],
+                uid=user['uid'][0],
+                lcc=user['employeetype'][0],
+                groups=user.get('memberof_group', ()),
+                fetched_at=fetched_at,
+            )
+        except (KeyError, IndexError):
+            return None
+
+class AccessCache:
+    '''
+    In-memory (and optionally on-disk) index from card ID to AccessEntry.
+    '''
+
+    def __init__(self, logger: logging.Logger, ttl: float, max_entries: int, path: Optional[os.PathLike] = None) -> None:
+        self.logger = logger
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+
+        self._entries: Dict[str, AccessEntry] = {}
+        # card ID -> time.time() it was removed, for at most one TTL
+        self._removed: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # incremented by every change, lets replication skip rehashing an unchanged cache
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, id: str) -> Optional[AccessEntry]:
+        '''
+        Returns the cached entry for the card ID, or None if it is unknown or
+        older than the TTL.
+        '''
+        entry = self._entries.get(id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if time.time() - entry.fetched_at > self.ttl:
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def contains(self, id: str) -> bool:
+        '''
+        Whether `get()` would return an entry for the card ID, without
+        counting a hit or miss.
+        '''
+        entry = self._entries.get(id)
+        return entry is not None and time.time() - entry.fetched_at <= self.ttl
+
+    def put(self, entry: AccessEntry) -> None:
+        '''
+        Add or refresh a single entry.
+        '''
+        with self._lock:
+            entries = dict(self._entries)
+            # re-insert so that the entry moves to the end of the eviction order
+            entries.pop(entry.id, None)
+            entries[entry.id] = entry
+            self._removed.pop(entry.id, None)
+            self._evict(entries)
+            self._entries = entries
+            self.generation += 1
+
+    def remove(self, id: str) -> None:
+        with self._lock:
+            if id in self._entries:
+                entries = dict(self._entries)
+                del entries[id]
+                self._removed[id] = time.time()
+                self._entries = entries
+                self.generation += 1
+
+    def apply(self, upserts: Iterable[AccessEntry], removals: Iterable[str] = ()) -> None:
+        '''
+        Add or refresh several entries and remove others in one atomic swap.
+        '''
+        now = time.time()
+        with self._lock:
+            entries = dict(self._entries)
+            for id in removals:
+                if entries.pop(id, None) is not None:
+                    self._removed[id] = now
+            for entry in upserts:
+                entries.pop(entry.id, None)
+                entries[entry.id] = entry
+                self._removed.pop(entry.id, None)
+            self._evict(entries)
+            self._entries = entries
+            self.generation += 1
+
+    def replace(self, entries: Iterable[AccessEntry]) -> None:
+        '''
+        Atomically replace the whole index. Accounts that are not in `entries`
+        any more count as removed.
+        '''
+        now = time.time()
+        new_entries = {}
+        for entry in sorted(entries, key=lambda e: e.fetched_at):
+            new_entries[entry.id] = entry
+        with self._lock:
+            for id in self._entries.keys() - new_entries.keys():
+                self._removed[id] = now
+            for id in new_entries:
+                self._removed.pop(id, None)
+            self._evict(new_entries)
+            self._entries = new_entries
+            self.generation += 1
+
+    def merge(self, upserts: Iterable[AccessEntry], removals: Optional[Dict[str, float]] = None) -> int:
+        '''
+        Take the entries and removals (card ID -> time.time() of the removal)
+        that are newer than the cache's own, in one atomic swap. Returns the
+        number taken.
+        '''
+        if removals is None:
+            removals = {}
+        taken = 0
+        with self._lock:
+            entries = dict(self._entries)
+            for entry in upserts:
+                current = entries.get(entry.id)
+                if entry.version <= max(current.version if current is not None else 0.0, self._removed.get(entry.id, 0.0)):
+                    continue
+                entries.pop(entry.id, None)
+                entries[entry.id] = entry
+                self._removed.pop(entry.id, None)
+                taken += 1
+            for id, removed_at in removals.items():
+                current = entries.get(id)
+                if removed_at <= max(current.version if current is not None else 0.0, self._removed.get(id, 0.0)):
+                    continue
+                entries.pop(id, None)
+                self._removed[id] = removed_at
+                taken += 1
+            if taken:
+                self._evict(entries)
+                self._entries = entries
+                self.generation += 1
+        return taken
+
+    def removed(self) -> Dict[str, float]:
+        '''
+        Card IDs removed within the last TTL, and when.
+        '''
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            if any(removed_at < cutoff for removed_at in self._removed.values()):
+                self._removed = {id: removed_at for id, removed_at in self._removed.items() if removed_at >= cutoff}
+                self.generation += 1
+            return dict(self._removed)
+
+    def _evict(self, entries: Dict[str, AccessEntry]) -> None:
+        # dicts keep insertion order, so the first keys are the ones that were
+        # refreshed the longest time ago
+        while len(entries) > self.max_entries:
+            del entries[next(iter(entries))]
+            self.evictions += 1
+
+    def entries(self) -> List[AccessEntry]:
+        return list(self._entries.values())
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+    def load_from_ipa(self, client: IPAClient, allowed_groups: Iterable[str]) -> int:
+        '''
+        Rebuild the index from the members of the allowed groups with one bulk
+        `user_find` per group. Returns the number of entries loaded.
+        '''
+        now = time.time()
+        entries: Dict[str, AccessEntry] = {}
+        allowed_groups = list(allowed_groups)
+        GROUPS.register(allowed_groups)
+        for group in allowed_groups:
+            users = client.user_find(o_in_group=group, o_sizelimit=0)
+            for user in users['result']:
+                entry = AccessEntry.from_ipa_user(user, now)
+                if entry is not None:
+                    entries[entry.id] = entry
+
+        if len(entries) > self.max_entries:
+            self.logger.warning(f"Allowed groups have {len(entries)} members with cards, but the access cache only holds {self.max_entries}. Consider raising cache.max_entries.")
+
+        self.replace(entries.values())
+        return len(entries)
+
+    def load(self) -> None:
+        '''
+        Load the on-disk copy of the cache, if one is configured and exists.
+        '''
+        if not self.path:
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            # merged rather than replaced: lookups and peers may have filled in
+            # newer entries while the file was read
+            self.merge([AccessEntry(**e) for e in data['entries']])
+            self.logger.info(f"Loaded {len(self)} access cache entries from {self.path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f"Unable to load access cache from {self.path}", exc_info=e)
+
+    def save(self) -> None:
+        '''
+        Write the cache to disk, if a path is configured. The file is replaced
+        atomically so a crash never leaves a half-written cache behind.
+        '''
+        if not self.path:
+            return
+
+        try:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': [e.to_dict() for e in self.entries()]}, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.warning(f"Unable to save access cache to {self.path}", exc_info=e)
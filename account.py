@@ -1,6 +1,11 @@
-from python_freeipa import ClientMeta
+from typing import Optional
+from ipa_client import IPAClient
 import logging
+import time
 from config import Config
+from access_cache import AccessEntry
+from lcc_writeback import LCCWriteback
+from policy import Policy, default_policy
 
 ONE_USER_MATCHED = '1 user matched'
 
@@ -9,16 +14,38 @@ class Account():
     Representation of an IPA server account.
     """
 
-    def __init__(self, id: str, lcc: str, client: ClientMeta, logger: logging.Logger, config: Config) -> None:
+    def __init__(self, id: str, lcc: str, client: IPAClient, logger: logging.Logger, config: Config, entry: Optional[AccessEntry] = None, writeback: Optional[LCCWriteback] = None, policy: Optional[Policy] = None, door: Optional[str] = None) -> None:
         self.logger = logger
         self.config = config
         self.client = client
+        self.entry = entry
+        # access policy and the reader swiped at. Without a policy, members of
+        # access.allowed_groups are allowed at any door
+        self.policy = policy if policy is not None else default_policy(frozenset(config.access.allowed_groups))
+        self.door = door
+        # if set, newer LCCs are written back to IPA in the background instead
+        # of before access is granted
+        self.writeback = writeback
+
+        if entry is not None:
+            # answered from the local access cache, no IPA round trip needed
+            self.record = entry
+            self.summary = ONE_USER_MATCHED
+        else:
+            # two matches are enough to tell that the card is not unique. Only
+            # the attributes in an AccessEntry are kept from the response
+            users = client.user_find(o_employeenumber=id, o_sizelimit=2)
+            self.summary = users['summary']
+            self.record = AccessEntry.from_ipa_user(users['result'][0], time.time(), id=id) if len(users['result']) == 1 else None
 
-        self.user = client.user_find(o_employeenumber=id) # returns a dictionary with the user's info
-        
-        self.summary = self.get_summary()
         self.swiped_lcc = lcc
         self.id = id
+        # True once the swiped, newer LCC was written to IPA or queued for it
+        self.lcc_updated = False
+        # short machine-readable reason for the decision, for the audit log
+        self.reason = None
+        # name of the policy rule or user override that allowed or denied access
+        self.rule = None
 
         try:
             self.netid = self.get_net_id()
@@ -27,18 +54,31 @@ class Account():
             self.has_access = self.has_access()
         except Exception as e:
             self.has_access = False
+            self.reason = 'no_unique_match' if self.summary != ONE_USER_MATCHED else 'incomplete_account'
 
     def get_net_id(self) -> str:
-        return self.user['result'][0]['uid'][0]
-    
-    def get_summary(self) -> str:
-        return self.user['summary']
+        return self.record.uid
     
     def get_lcc(self) -> str:
-        return self.user['result'][0]['employeetype'][0]
+        return self.record.lcc
     
-    def get_groups(self) -> list:
-        return self.user['result'][0]['memberof_group']
+    def get_groups(self) -> int:
+        # the AccessEntry.group_mask, which the policy checks directly
+        return self.record.group_mask
+
+    def to_access_entry(self) -> Optional[AccessEntry]:
+        """
+        Returns an `AccessEntry` for the access cache reflecting this account
+        after the swipe, or `None` if the lookup did not match exactly one user.
+        """
+
+        if self.summary != ONE_USER_MATCHED or self.record is None:
+            return None
+
+        if not self.lcc_updated:
+            return self.record
+        # a newer LCC has to win over the cached entry on replicating nodes
+        return self.record.replace(lcc=self.swiped_lcc, changed_at=time.time())
     
     def has_access(self) -> bool:
         """
@@ -50,10 +90,15 @@ class Account():
         if self.summary != ONE_USER_MATCHED:
             # make sure that there is only one user being matched
             # (if swiped lcc and 8 digit id are both empty, all users will be matched)
+            self.reason = 'no_unique_match'
             return False
 
-        if not (set(self.groups) & self.config.access.allowed_groups):
-            # account does not have any of the groups with access
+        match = self.policy.check(self.netid, self.groups, self.door)
+        self.rule = match.rule
+        if not match.allowed:
+            # no rule lets any of the account's groups in at this door right
+            # now, or the user is denied explicitly
+            self.reason = match.reason
             return False
         
         try:
@@ -61,22 +106,33 @@ class Account():
                 # if someone tries to swipe with an earlier, 
                 # perhaps lost id, access will be denied
                 self.logger.warning(f"LCC of user {self.netid} is {self.lcc}. Swiped LCC was {self.swiped_lcc}.")
+                self.reason = 'old_lcc'
                 return False
             elif int(self.swiped_lcc) > int(self.lcc):
                 # if someone tries to swipe with a newer lcc id,
                 # update their lcc in Citadel and grant access
                 self.logger.info(f"LCC of user {self.netid} is {self.lcc}. Swiped LCC was {self.swiped_lcc}. Updating user {self.netid} with new LCC of {self.swiped_lcc}...")
+                self.reason = 'new_lcc'
+
+                if self.writeback is not None:
+                    self.writeback.enqueue(self.netid, self.swiped_lcc)
+                    self.lcc_updated = True
+                    return True
 
                 try:
                     self.update_LCC()
+                    self.lcc_updated = True
                     self.logger.info(f"The LCC change for user {self.netid} from {self.lcc} to {self.swiped_lcc} succeeded.")
                 except Exception as e:
                     self.logger.warning(f"The attempt to change the LCC of user {self.netid} from {self.lcc} to {self.swiped_lcc} failed.")
                     self.logger.exception(e)
         except:
             self.logger.warning("LCC String to Int conversion failed. Automatically denying access.")
+            self.reason = 'invalid_lcc'
             return False
 
+        if self.reason is None:
+            self.reason = match.reason
         return True
     
     def update_LCC(self) -> None:
@@ -0,0 +1,237 @@
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import serial
+import serial.tools.list_ports
+
+'''
+Module for managing the serial connection to the strike's Arduino.
+
+ArduinoConnection finds the Arduino once in the background and keeps it
+connected:
+
+- The USB VID/PID/serial number of the port the Arduino was last found on is
+  remembered in a small state file. On the next start that port is probed
+  first, and only if it does not answer are the remaining ports probed, all
+  in parallel. Opening a port resets the Arduino, so every probe has to wait
+  for it to boot; probing in parallel pays that wait once instead of once per
+  port.
+- A heartbeat thread sends the `Q` query from arduino_strike.ino every few
+  seconds and expects `Arduino_Online` back. If it goes unanswered, or a
+  write fails, the port is closed and the thread reconnects.
+
+Writes never wait on probing or on the heartbeat. While the Arduino is not
+connected, `write()` returns False right away.
+'''
+
+BAUD_RATE = 9600
+QUERY = b'Q'
+ONLINE = 'Arduino_Online'
+
+class ArduinoConnection:
+    '''
+    Self-healing serial connection to the Arduino.
+    '''
+
+    def __init__(self, logger: logging.Logger, port: Optional[str] = None, state_path: Optional[os.PathLike] = None, heartbeat: float = 30.0, reset_delay: float = 2.0) -> None:
+        self.logger = logger
+        # explicit port from the config, skips scanning
+        self.port = port
+        self.state_path = state_path
+        self.heartbeat = heartbeat
+        # time the Arduino needs to boot after the port is opened
+        self.reset_delay = reset_delay
+
+        self.serial: Optional[serial.Serial] = None
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.reconnects = 0
+        self.heartbeat_failures = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.serial is not None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='arduino', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._disconnect()
+
+    def write(self, data: bytes) -> bool:
+        '''
+        Send data to the Arduino. Returns False if it is not connected or the
+        write failed, in which case a reconnect is started in the background.
+        '''
+        ser = self.serial
+        if ser is None:
+            return False
+
+        try:
+            with self._write_lock:
+                ser.write(data)
+            return True
+        except Exception as e:
+            self.logger.error(f"Error writing to Arduino on {ser.port}: {str(e)}")
+            self._disconnect(ser)
+            self._wake.set()
+            return False
+
+    def _run(self) -> None:
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            if self.serial is None:
+                ser = self.find()
+                if ser is None:
+                    self._wake.wait(backoff)
+                    self._wake.clear()
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                self.serial = ser
+                self.reconnects += 1
+                backoff = 1.0
+
+            self._wake.wait(self.heartbeat)
+            self._wake.clear()
+
+            ser = self.serial
+            if ser is not None and not self._stop_event.is_set() and not self._query(ser):
+                self.heartbeat_failures += 1
+                self.logger.warning(f"Arduino on {ser.port} stopped answering, reconnecting")
+                self._disconnect(ser)
+
+    def _disconnect(self, ser: Optional[serial.Serial] = None) -> None:
+        '''
+        Close the given port, or the current one. Does nothing if the current
+        port was already replaced.
+        '''
+        ser = ser or self.serial
+        if ser is None:
+            return
+        if self.serial is ser:
+            self.serial = None
+        try:
+            ser.close()
+        except Exception:
+            pass
+
+    def _query(self, ser: serial.Serial) -> bool:
+        '''
+        Send the `Q` query and wait for `Arduino_Online`. Other output, such
+        as the `striking...` echo, is skipped.
+        '''
+        try:
+            with self._write_lock:
+                ser.write(QUERY)
+            deadline = time.monotonic() + max(ser.timeout or 1.0, 1.0)
+            while time.monotonic() < deadline:
+                response = ser.readline().decode(errors='replace').strip()
+                if response == ONLINE:
+                    return True
+        except Exception as e:
+            self.logger.warning(f"Exception while querying {ser.port}: {str(e)}")
+        return False
+
+    def _probe(self, device: str) -> Optional[serial.Serial]:
+        ser = None
+        try:
+            ser = serial.Serial(device, BAUD_RATE, timeout=1)
+            time.sleep(self.reset_delay)  # Allow some time for connection stabilization
+            ser.reset_input_buffer()
+            if self._query(ser):
+                return ser
+        except Exception as e:
+            self.logger.debug(f"Probing {device} failed: {str(e)}")
+
+        if ser is not None:
+            ser.close()
+        return None
+
+    def find(self) -> Optional[serial.Serial]:
+        '''
+        Find the Arduino, trying the configured or last known port first and
+        then all remaining ports in parallel.
+        '''
+        if self.port:
+            ser = self._probe(self.port)
+            if ser is not None:
+                self.logger.info(f"Arduino found on port {self.port}")
+            else:
+                self.logger.error(f"Arduino not found on configured port {self.port}")
+            return ser
+
+        ports = serial.tools.list_ports.comports()
+        known = self._load_state()
+        preferred = [p for p in ports if known is not None and self._matches(p, known)]
+        others = [p for p in ports if p not in preferred]
+
+        for port in preferred:
+            ser = self._probe(port.device)
+            if ser is not None:
+                self.logger.info(f"Arduino found on last known port {port.device}")
+                return ser
+
+        ser = self._probe_parallel(others)
+        if ser is None:
+            self.logger.error("Arduino not found")
+        return ser
+
+    def _probe_parallel(self, ports: List) -> Optional[serial.Serial]:
+        if not ports:
+            return None
+
+        found = None
+        with ThreadPoolExecutor(max_workers=len(ports), thread_name_prefix='arduino-probe') as executor:
+            futures = {executor.submit(self._probe, port.device): port for port in ports}
+            for future in as_completed(futures):
+                ser = future.result()
+                if ser is None:
+                    continue
+                if found is None:
+                    found = ser
+                    port = futures[future]
+                    self.logger.info(f"Arduino found on port {port.device}")
+                    self._save_state(port)
+                else:
+                    # more than one device answered, keep the first
+                    ser.close()
+        return found
+
+    @staticmethod
+    def _matches(port, known: dict) -> bool:
+        return (port.vid, port.pid, port.serial_number) == (known.get('vid'), known.get('pid'), known.get('serial_number'))
+
+    def _load_state(self) -> Optional[dict]:
+        if not self.state_path:
+            return None
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning(f"Unable to read Arduino port state from {self.state_path}", exc_info=e)
+            return None
+
+    def _save_state(self, port) -> None:
+        if not self.state_path:
+            return
+        try:
+            pathlib.Path(self.state_path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.state_path, 'w') as f:
+                json.dump({'device': port.device, 'vid': port.vid, 'pid': port.pid, 'serial_number': port.serial_number}, f)
+        except Exception as e:
+            self.logger.warning(f"Unable to save Arduino port state to {self.state_path}", exc_info=e)
@@ -1,5 +1,11 @@
 int mosfetGatePin = 7;
 
+// The strike closes on its own this long after the last '1', even if
+// GateKeeper never sends '0'. Each '1' restarts the timer.
+const unsigned long holdMs = 5000;
+unsigned long openedAt = 0;
+bool isOpen = false;
+
 void setup() {
   Serial.begin(9600); // initialize serial communication at 9600 bps
   pinMode(mosfetGatePin, OUTPUT); 
@@ -12,11 +18,21 @@ void loop() {
     if (inChar == '1') {
       Serial.println("striking...\n");
       digitalWrite(mosfetGatePin, HIGH); // Turn ON the MOSFET
-      delay(5000); // Keep the door strike activated for 5 seconds
+      // don't delay() here, so the serial port keeps being served while the door is open
+      openedAt = millis();
+      isOpen = true;
+    }
+    if (inChar == '0') {
       digitalWrite(mosfetGatePin, LOW); // Turn OFF the MOSFET
+      isOpen = false;
     }
     if (inChar == 'Q') {  // Add a query-response mechanism
       Serial.println("Arduino_Online");
     }
   }
+
+  if (isOpen && millis() - openedAt >= holdMs) {
+    digitalWrite(mosfetGatePin, LOW); // Turn OFF the MOSFET
+    isOpen = false;
+  }
 }
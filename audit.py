@@ -0,0 +1,187 @@
+from typing import List, Optional
+import atexit
+import glob
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import queue
+import re
+import threading
+import time
+
+'''
+Module for the structured audit log of access decisions.
+
+Every decision becomes one compact JSON object on its own line (NDJSON):
+
+    {"ts": 1700000000.123, "card": "3f9a...", "netid": "abc1234", "reader": "default",
+     "decision": "granted", "reason": "granted", "source": "account",
+     "ms": {"read": 41.2, "lookup": 0.08, "decision": 0.3, "actuation": 0.05}}
+
+Card IDs are never written in the clear, only as a keyed hash (see
+`hash_card_id`), which is enough to find all swipes of a given card.
+
+`record()` only puts the record on a queue. A writer thread writes whatever
+has accumulated in one batch, at most every `flush_interval` seconds, and
+rotates the file once it exceeds `max_bytes` or is older than
+`rotate_interval` seconds, keeping `backup_count` old files. Before old
+files are deleted, the rotated files are ingested into the database of
+gatekeeper_audit.py (`db`), so the indexed history keeps every record no
+matter how few files are kept.
+'''
+
+# suffix of rotated audit logs, their time of rotation
+ROTATED_SUFFIX = re.compile(r'\.\d{8}-\d{6}(-\d+)?$')
+
+def hash_card_id(id: str, salt: str = '') -> str:
+    '''
+    Keyed hash of a card ID as written to the audit log.
+    '''
+    return hashlib.blake2b(id.encode(), key=salt.encode()[:64], digest_size=8).hexdigest()
+
+class AuditLog:
+    '''
+    Batched, rotating NDJSON writer for decision records.
+    '''
+
+    def __init__(self, logger: logging.Logger, path: os.PathLike, db: Optional[os.PathLike] = None, salt: str = '', max_bytes: int = 10 * 1024 * 1024, rotate_interval: float = 0, backup_count: int = 30, flush_interval: float = 1.0) -> None:
+        self.logger = logger
+        self.path = path
+        # database the rotated files are ingested into, None to only rotate
+        self.db = db
+        self.salt = salt
+        self.max_bytes = max_bytes
+        # seconds after which the file is rotated regardless of size, 0 to disable
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._opened_at = 0.0
+
+        self.written = 0
+        self.ingested = 0
+
+    def start(self) -> None:
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='audit', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self) -> None:
+        '''
+        Write everything still queued and stop the writer thread.
+        '''
+        if self._thread is None or self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._thread.join()
+
+    def record(self, id: str, netid: Optional[str], reader: Optional[str], granted: bool, reason: Optional[str], source: str, stages: dict) -> None:
+        '''
+        Queue one decision record. `stages` maps stage names to seconds. Never
+        blocks on I/O.
+        '''
+        self._queue.put({
+            'ts': round(time.time(), 3),
+            'card': hash_card_id(id, self.salt),
+            'netid': netid,
+            'reader': reader,
+            'decision': 'granted' if granted else 'denied',
+            'reason': reason,
+            'source': source,
+            'ms': {stage: round(seconds * 1000, 3) for stage, seconds in stages.items() if seconds is not None},
+        })
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._stop_event.wait(self.flush_interval)
+            self._write_batch()
+        self._write_batch()
+        if self._file is not None:
+            self._file.close()
+
+    def _write_batch(self) -> None:
+        records: List[dict] = []
+        try:
+            while True:
+                records.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not records:
+            return
+
+        try:
+            self._rotate_if_needed()
+            data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+            self._file.write(data)
+            self._file.flush()
+            self.written += len(records)
+        except Exception as e:
+            self.logger.error(f"Unable to write {len(records)} records to the audit log {self.path}", exc_info=e)
+
+    def _rotate_if_needed(self) -> None:
+        if self._file is None:
+            self._open()
+
+        too_big = self._file.tell() >= self.max_bytes
+        too_old = self.rotate_interval and time.time() - self._opened_at >= self.rotate_interval
+        if not (too_big or too_old):
+            return
+
+        self._file.close()
+        rotated_path = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        n = 1
+        while os.path.exists(rotated_path):
+            # rotated twice within a second
+            rotated_path = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}-{n}"
+            n += 1
+        os.replace(self.path, rotated_path)
+        if self.db is not None and not self._ingest():
+            # deleted once a later rotation managed to ingest them
+            self._open()
+            return
+        # rotated names sort by time, so everything before the last
+        # backup_count files is the oldest. Other files next to the log, like
+        # gatekeeper_audit.py's default database, are left alone
+        rotated = sorted(f for f in glob.glob(f"{glob.escape(str(self.path))}.*") if ROTATED_SUFFIX.search(f))
+        for old in rotated[:-self.backup_count] if self.backup_count else rotated:
+            os.remove(old)
+        self._open()
+
+    def _ingest(self) -> bool:
+        '''
+        Ingest the rotated files into `self.db`. Returns False if that failed.
+        '''
+        # imports audit.py itself, and is only needed once per rotation
+        from gatekeeper_audit import AuditStore
+
+        try:
+            pathlib.Path(self.db).parent.mkdir(parents=True, exist_ok=True)
+            store = AuditStore(self.db)
+            try:
+                added = store.ingest_audit_log(self.path)
+            finally:
+                store.close()
+        except Exception as e:
+            self.logger.error(f"Unable to ingest the rotated audit logs into {self.db}, keeping them", exc_info=e)
+            return False
+        self.ingested += added
+        return True
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'a')
+        # the age of a file left over from a previous run counts from now
+        self._opened_at = time.time()
+
+    def stats(self) -> dict:
+        return {
+            'written': self.written,
+            'ingested': self.ingested,
+            'queued': self._queue.qsize(),
+        }
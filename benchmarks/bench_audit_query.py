@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audit import hash_card_id
+from gatekeeper_audit import AuditStore
+
+'''
+Benchmark for gatekeeper_audit.py. Writes a synthetic audit log covering
+several years of swipes, ingests it, and times typical queries.
+
+    python3 benchmarks/bench_audit_query.py --years 5 --per-day 1000
+'''
+
+def write_audit_log(path: str, years: float, per_day: int, users: int) -> int:
+    rng = random.Random(1)
+    now = time.time()
+    start = now - years * 365 * 86400
+    count = int(years * 365 * per_day)
+    with open(path, 'w') as f:
+        for i in range(count):
+            user = rng.randrange(users)
+            granted = rng.random() < 0.95
+            f.write(json.dumps({
+                'ts': round(start + (now - start) * i / count, 3),
+                'card': hash_card_id(f"{10000000 + user:08d}"),
+                'netid': f"user{user}" if granted else None,
+                'reader': rng.choice(['default', 'exit']),
+                'decision': 'granted' if granted else 'denied',
+                'reason': 'allowed' if granted else 'old_lcc',
+                'source': 'account',
+                'ms': {'lookup': 0.05, 'decision': 0.3},
+            }, separators=(',', ':')) + '\n')
+    return count
+
+def timed(label: str, fn, repeat: int = 5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    size = result if isinstance(result, int) else len(result)
+    print(f"{label:<50} {best * 1000:8.2f}ms  ({size} rows)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark audit log ingestion and queries.")
+    parser.add_argument('--years', type=float, default=5)
+    parser.add_argument('--per-day', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log = os.path.join(tmp, 'audit.ndjson')
+        count = write_audit_log(log, args.years, args.per_day, args.users)
+
+        store = AuditStore(os.path.join(tmp, 'audit.sqlite3'))
+        start = time.perf_counter()
+        store.ingest_audit_log(log)
+        elapsed = time.perf_counter() - start
+        print(f"ingested {count} records in {elapsed:.1f}s ({count / elapsed:.0f}/s), database {os.path.getsize(store.path) / 2**20:.0f} MiB")
+
+        with open(log, 'a') as f:
+            f.write(json.dumps({'ts': time.time(), 'card': None, 'decision': 'denied'}) + '\n')
+        timed('incremental ingest of 1 new record', lambda: store.ingest_audit_log(log), repeat=1)
+
+        now = time.time()
+        month = (now - 60 * 86400, now - 30 * 86400)
+        timed('one month, 2am-4am, granted', lambda: store.query(since=month[0], until=month[1], hours=(2, 4), granted=True))
+        timed('one netid, all time', lambda: store.query(netid='user42'))
+        timed('one card, all time', lambda: store.query(card=hash_card_id('10000042')))
+        timed('one day', lambda: store.query(since=now - 86400))
+        timed('denials in the last week', lambda: store.query(since=now - 7 * 86400, granted=False))
+        timed('count of all denials', lambda: store.count(granted=False))
+        store.close()
+
+if __name__ == '__main__':
+    main()
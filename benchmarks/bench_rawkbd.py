@@ -0,0 +1,85 @@
+from typing import Iterator
+import argparse
+import logging
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cardreader import RawKbdReader, ReaderEvent, _parse_reader_line, EVENT
+from evdev_dump import swipe_line, write_dump
+
+'''
+Microbenchmark for RawKbdReader. Replays an evdev dump through the batched
+reader and through the previous one-event-per-read implementation, and
+reports events per second and the time per decoded swipe.
+
+    python3 benchmarks/bench_rawkbd.py                  # synthetic dump
+    python3 benchmarks/bench_rawkbd.py --dump dump.bin  # recorded dump, e.g. from `cat /dev/input/eventN > dump.bin`
+'''
+
+def legacy_events(device: str, logger: logging.Logger) -> Iterator[ReaderEvent]:
+    '''
+    RawKbdReader.events() before batching: one read() and struct.unpack per
+    event, string concatenation for the line.
+    '''
+    EVENT_FORMAT = 'llHHi'
+    EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+    TY_KEY = 1
+    KEYS = "  1234567890-= \tqwertyuiop[]\n asdfghjkl;'` \\zxcvbnm,./ "
+    VL_KEYDOWN = 1
+
+    buf = ''
+    with open(device, mode='rb', buffering=0) as f:
+        while True:
+            event = f.read(EVENT_SIZE)
+            if not event:
+                break
+            (tv_sec, tv_usec, type, code, value) = struct.unpack(EVENT_FORMAT, event)
+            if type == TY_KEY and value == VL_KEYDOWN:
+                if code < len(KEYS):
+                    buf += KEYS[code]
+                else:
+                    logger.warning(f"received out-of-bounds keycode {code} while reading rawkbd device")
+            if buf.endswith('\n'):
+                yield _parse_reader_line(buf[0:-1])
+                buf = ''
+
+def run(name: str, events: Iterator[ReaderEvent], event_count: int) -> float:
+    start = time.perf_counter()
+    swipes = sum(1 for _ in events)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {event_count / elapsed:12,.0f} events/s  {elapsed / swipes * 1e6:8.1f} us/swipe  ({swipes} swipes)")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RawKbdReader against recorded or synthetic evdev dumps.")
+    parser.add_argument('--dump', help='Recorded evdev dump to replay. A synthetic one is generated if omitted.')
+    parser.add_argument('--swipes', type=int, default=20000, help='Number of swipes in the synthetic dump.')
+    parser.add_argument('--batch', type=int, default=64, help='Events per read for the batched reader.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('bench')
+
+    tmp = None
+    path = args.dump
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        tmp.close()
+        path = tmp.name
+        write_dump(path, (swipe_line(f"{i:08d}", '01') for i in range(args.swipes)))
+    event_count = os.path.getsize(path) // EVENT.size
+
+    try:
+        legacy = run('legacy', legacy_events(path, logger), event_count)
+        batched = run('batched', RawKbdReader(path, logger, batch_events=args.batch).events(), event_count)
+        print(f"speedup: {legacy / batched:.1f}x")
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
+
+if __name__ == '__main__':
+    main()
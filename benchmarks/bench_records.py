@@ -0,0 +1,160 @@
+from typing import List
+from dataclasses import dataclass
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from access_cache import AccessEntry
+from policy import default_policy
+
+'''
+Microbenchmark for access records. Decodes `user_find` responses shaped like
+FreeIPA's default output (every default attribute, direct and indirect group
+memberships) and compares the previous records with the current ones:
+
+- memory of an access cache full of records, measured with tracemalloc
+- time and memory allocated per live lookup, from the response body to the
+  policy's decision
+
+The previous implementation is kept here: a plain dataclass with the group
+names as a list, and lookups that keep the whole response.
+
+    python3 benchmarks/bench_records.py --records 20000 --groups 40
+'''
+
+@dataclass
+class LegacyEntry:
+    id: str
+    uid: str
+    lcc: str
+    groups: List[str]
+    fetched_at: float = 0.0
+    changed_at: float = 0.0
+
+def ipa_user(rng: random.Random, i: int, groups: List[str]) -> dict:
+    uid = f"abc{i:04d}"
+    member_of = ['ipausers'] + rng.sample(groups, rng.randrange(1, 6))
+    return {
+        'dn': f"uid={uid},cn=users,cn=accounts,dc=cif,dc=rochester,dc=edu",
+        'uid': [uid],
+        'givenname': ['Test'],
+        'sn': [f"User{i}"],
+        'cn': [f"Test User{i}"],
+        'homedirectory': [f"/home/{uid}"],
+        'loginshell': ['/bin/bash'],
+        'krbprincipalname': [f"{uid}@CIF.ROCHESTER.EDU"],
+        'mail': [f"{uid}@u.rochester.edu"],
+        'uidnumber': [str(1_000_000 + i)],
+        'gidnumber': [str(1_000_000 + i)],
+        'nsaccountlock': False,
+        'has_password': True,
+        'has_keytab': True,
+        'employeenumber': [f"{10000000 + i:08d}"],
+        'employeetype': [f"{rng.randrange(1, 4):02d}"],
+        'memberof_group': member_of,
+        'memberofindirect_group': rng.sample(groups, 2),
+        'memberof_hbacrule': ['allow_ssh'],
+        'memberof_sudorule': ['lab_sudo'] if i % 20 == 0 else [],
+    }
+
+def response(user: dict) -> bytes:
+    return json.dumps({'result': {'result': [user], 'count': 1, 'truncated': False, 'summary': '1 user matched'}, 'error': None}).encode()
+
+def cache_memory(make, users: List[dict]) -> int:
+    '''
+    Bytes held by an access cache dict of one record per user, as built from
+    freshly parsed responses.
+    '''
+    payloads = [json.dumps(user).encode() for user in users]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = {}
+    for payload in payloads:
+        entry = make(json.loads(payload))
+        cache[entry.id] = entry
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del cache
+    return size
+
+def legacy_entry(user: dict) -> LegacyEntry:
+    return LegacyEntry(user['employeenumber'][0], user['uid'][0], user['employeetype'][0], list(user['memberof_group']), time.time())
+
+def current_entry(user: dict) -> AccessEntry:
+    return AccessEntry.from_ipa_user(user, time.time())
+
+def legacy_lookup(payload: bytes, lcc: str, policy) -> bool:
+    '''
+    A live lookup before the records: the whole response is kept, the
+    policy is checked against the group names and an entry is built for the
+    access cache.
+    '''
+    user = json.loads(payload)['result']
+    result = user['result'][0]
+    netid, user_lcc, groups = result['uid'][0], result['employeetype'][0], result['memberof_group']
+    allowed = policy.check(netid, groups).allowed and int(lcc) >= int(user_lcc)
+    LegacyEntry(id=result['employeenumber'][0], uid=netid, lcc=user_lcc, groups=groups, fetched_at=time.time())
+    return allowed
+
+def current_lookup(payload: bytes, lcc: str, policy) -> bool:
+    '''
+    Account's live lookup: the response is decoded into an AccessEntry and
+    the policy is checked against its group mask. The same entry goes into
+    the access cache.
+    '''
+    users = json.loads(payload)['result']
+    entry = AccessEntry.from_ipa_user(users['result'][0], time.time()) if len(users['result']) == 1 else None
+    return policy.check(entry.uid, entry.group_mask).allowed and int(lcc) >= int(entry.lcc)
+
+def per_lookup(name: str, lookup, swipes: List[tuple], policy) -> None:
+    # the first swipe of every set of groups fills the policy's mask table
+    for payload, lcc in swipes:
+        lookup(payload, lcc, policy)
+    runs = []
+    for _ in range(3):
+        start = time.perf_counter()
+        for payload, lcc in swipes:
+            lookup(payload, lcc, policy)
+        runs.append(time.perf_counter() - start)
+    elapsed = min(runs)
+
+    tracemalloc.start()
+    for payload, lcc in swipes[:2000]:
+        lookup(payload, lcc, policy)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>8}: {elapsed / len(swipes) * 1e6:6.1f} us/lookup  peak {peak / 1024:.0f} KiB allocated by 2000 lookups")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory and decode time of access records.")
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--groups', type=int, default=40, help='Distinct groups the users are members of.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    groups = [f"group{i}" for i in range(args.groups)]
+    users = [ipa_user(rng, i, groups) for i in range(args.records)]
+
+    policy = default_policy(frozenset(groups[:10]))
+    swipes = [(response(user), user['employeetype'][0]) for user in users]
+    rng.shuffle(swipes)
+
+    per_lookup('legacy', legacy_lookup, swipes, policy)
+    per_lookup('current', current_lookup, swipes, policy)
+
+    legacy = cache_memory(legacy_entry, users)
+    current = cache_memory(current_entry, users)
+    print(f"cache of {args.records} records: legacy {legacy / 2 ** 20:.1f} MiB ({legacy / args.records:.0f} B/record), current {current / 2 ** 20:.1f} MiB ({current / args.records:.0f} B/record), {legacy / current:.1f}x smaller")
+
+if __name__ == '__main__':
+    main()
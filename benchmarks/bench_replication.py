@@ -0,0 +1,170 @@
+from typing import Dict
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cardreader
+import main as gatekeeper
+from config import load_config
+from strike import Strike
+from evdev_dump import swipe_line
+from replay import CONFIG_PATH, serve_fake_ipa
+
+'''
+Replication test with several GateKeeper processes on localhost. Every node
+runs `main.run()` with its own metrics endpoint, which is how the test watches
+it, and a pipe as its card reader.
+
+1. All nodes start together. Only the leader (the lowest node name) syncs
+   with IPA, the others fill their caches by replication.
+2. Idle nodes only exchange digests: reports the bytes per exchange.
+3. A swipe with a newer LCC at the last node: reports how long until every
+   node has it, and how many records were sent.
+4. Power cut: the second node is killed and restarted without its cache
+   file: reports how long until its cache is full again.
+5. The leader is killed: reports how long until another node takes over.
+
+    python3 benchmarks/bench_replication.py --nodes 3 --users 5000
+'''
+
+SECRET = 'bench-replication-secret'
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_node(name: str, ports: Dict[str, tuple], host: str, tmp: str, interval: float, read_fd: int) -> None:
+    urllib3.disable_warnings()
+    os.dup2(read_fd, sys.stdin.fileno())
+
+    logger = logging.getLogger(f'node-{name}')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    config = load_config(CONFIG_PATH)
+    config.credentials.hosts = [host]
+    config.credentials.verify_ssl = False
+    # a node restarted after a power cut has nothing on disk
+    config.cache.path = None
+    config.offline.snapshot = os.path.join(tmp, f'{name}-snapshot.bin')
+    config.writeback.path = None
+    config.audit.path = None
+    config.metrics.port = ports[name][1]
+    config.ratelimit.reader_rate = config.ratelimit.card_rate = 0
+    config.replication.listen = f"127.0.0.1:{ports[name][0]}"
+    config.replication.peers = [f"127.0.0.1:{replication}" for peer, (replication, _) in ports.items() if peer != name]
+    config.replication.node = name
+    config.replication.secret = SECRET
+    config.replication.interval = interval
+    config.replication.peer_timeout = interval * 4
+
+    reader = cardreader.StdinReader(logger, name=name)
+    gatekeeper.run(config, logger, Strike(logger, 0.1), reader)
+
+def scrape(port: int) -> Dict[str, float]:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as response:
+            text = response.read().decode()
+    except OSError:
+        return {}
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            key, _, value = line.partition(' ')
+            values[key] = float(value)
+    return values
+
+def wait_for(condition, timeout: float = 30.0, poll: float = 0.005) -> float:
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('condition not met in time')
+        time.sleep(poll)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Test access cache replication between several GateKeeper processes.")
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--interval', type=float, default=0.5, help='replication.interval in seconds.')
+    args = parser.parse_args()
+
+    ipa_conn, child_conn = multiprocessing.Pipe()
+    ipa = multiprocessing.Process(target=serve_fake_ipa, args=(args.users, 0.002, 0.002, 0.0, child_conn), daemon=True)
+    ipa.start()
+    host = ipa_conn.recv()
+
+    names = [f"node{i}" for i in range(args.nodes)]
+    ports = {name: (free_port(), free_port()) for name in names}
+    processes: Dict[str, multiprocessing.Process] = {}
+    swipes: Dict[str, int] = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def start(name: str) -> None:
+            read_fd, write_fd = os.pipe()
+            processes[name] = multiprocessing.Process(target=run_node, args=(name, ports, host, tmp, args.interval, read_fd), daemon=True)
+            processes[name].start()
+            os.close(read_fd)
+            swipes[name] = write_fd
+
+        def metrics(name: str) -> Dict[str, float]:
+            return scrape(ports[name][1])
+
+        def cache_size(name: str) -> float:
+            return metrics(name).get('gatekeeper_cache_size', 0)
+
+        # the fake IPA has args.users users, a few without a card
+        for name in names:
+            start(name)
+        elapsed = wait_for(lambda: cache_size(names[0]) > 0 and all(cache_size(name) == cache_size(names[0]) for name in names))
+        full = cache_size(names[0])
+        syncs = {name: metrics(name).get('gatekeeper_sync_syncs', 0) for name in names}
+        print(f"1. {args.nodes} nodes hold {full:.0f} accounts {elapsed:.2f}s after starting; IPA syncs per node: {syncs}")
+
+        before = {name: metrics(name) for name in names}
+        time.sleep(args.interval * 4)
+        after = {name: metrics(name) for name in names}
+        exchanges = sum(after[name]['gatekeeper_replication_exchanges'] - before[name]['gatekeeper_replication_exchanges'] for name in names)
+        sent = sum(after[name]['gatekeeper_replication_bytes_sent'] - before[name]['gatekeeper_replication_bytes_sent'] for name in names)
+        print(f"2. idle: {exchanges:.0f} exchanges sent {sent / max(exchanges, 1):.0f} bytes each")
+
+        last = names[-1]
+        merged_before = {name: metrics(name)['gatekeeper_replication_records_merged'] for name in names[:-1]}
+        sent_before = metrics(last)['gatekeeper_replication_records_sent']
+        os.write(swipes[last], swipe_line('10000001', '02').encode())
+        elapsed = wait_for(lambda: all(metrics(name)['gatekeeper_replication_records_merged'] > merged_before[name] for name in names[:-1]))
+        time.sleep(args.interval * 2)
+        print(f"3. LCC update at {last} reached every node in {elapsed * 1000:.0f}ms, {metrics(last)['gatekeeper_replication_records_sent'] - sent_before:.0f} records sent by {last}")
+
+        victim = names[1]
+        processes[victim].kill()
+        processes[victim].join()
+        start_time = time.perf_counter()
+        start(victim)
+        up = wait_for(lambda: bool(metrics(victim)))
+        elapsed = wait_for(lambda: cache_size(victim) >= full)
+        print(f"4. {victim} restarted without a cache: metrics up after {up * 1000:.0f}ms, cache full {(time.perf_counter() - start_time) * 1000:.0f}ms after the restart")
+
+        leader = names[0]
+        processes[leader].kill()
+        processes[leader].join()
+        elapsed = wait_for(lambda: metrics(names[1]).get('gatekeeper_replication_leader') == 1, timeout=args.interval * 20)
+        print(f"5. {leader} killed, {names[1]} took over polling IPA after {elapsed:.2f}s (replication.peer_timeout {args.interval * 4:.1f}s)")
+
+        for process in processes.values():
+            if process.is_alive():
+                process.kill()
+        ipa_conn.send('stop')
+
+if __name__ == '__main__':
+    main()
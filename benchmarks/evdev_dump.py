@@ -0,0 +1,54 @@
+from typing import Iterable
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cardreader import EVENT, KEYS, TY_KEY, VL_KEYDOWN, VL_KEYUP
+
+'''
+Helpers for building evdev keyboard dumps, in the format RawKbdReader reads
+from /dev/input/event*, from card swipe strings.
+'''
+
+EV_SYN = 0
+EV_MSC = 4
+MSC_SCAN = 4
+
+# character -> keycode. The reader types '?' as shift+'/', which RawKbdReader
+# sees as '/'.
+KEYCODES = {char: code for code, char in reversed(list(enumerate(KEYS))) if char != ' '}
+KEYCODES['?'] = KEYCODES['/']
+
+def swipe_line(id: str, lcc: str) -> str:
+    return f";9{id}{lcc}00000?\n"
+
+def encode(text: str, start: float = 0.0, key_interval: float = 0.002) -> bytes:
+    '''
+    Encode text as the events a USB keyboard produces for it: a scan code,
+    key down, sync, key up and sync per character.
+    '''
+    out = bytearray()
+    t = start
+    for char in text:
+        code = KEYCODES[char]
+        sec, usec = int(t), int((t % 1) * 1_000_000)
+        out += EVENT.pack(sec, usec, EV_MSC, MSC_SCAN, code)
+        out += EVENT.pack(sec, usec, TY_KEY, code, VL_KEYDOWN)
+        out += EVENT.pack(sec, usec, EV_SYN, 0, 0)
+        out += EVENT.pack(sec, usec, TY_KEY, code, VL_KEYUP)
+        out += EVENT.pack(sec, usec, EV_SYN, 0, 0)
+        t += key_interval
+    return bytes(out)
+
+def write_dump(path: str, lines: Iterable[str]) -> int:
+    '''
+    Write a dump of the given lines, one second apart. Returns the number of
+    events written.
+    '''
+    data = bytearray()
+    for i, line in enumerate(lines):
+        data += encode(line, start=float(i))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data) // EVENT.size
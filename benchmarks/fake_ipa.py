@@ -0,0 +1,205 @@
+from typing import Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+'''
+Local HTTPS stand-in for the parts of the FreeIPA JSON-RPC API GateKeeper
+uses: password login, ping, user_find, user_mod and group_show. Requests
+without a session from a login are answered with HTTP 401, as are requests
+with a session older than `session_lifetime`.
+
+python_freeipa always talks HTTPS, so the server creates a throwaway
+self-signed certificate with the `openssl` command line tool. Point
+credentials.host at `127.0.0.1:<port>` with verify_ssl = false.
+
+Users are generated: user i has uid `user<i>`, card ID 10000000 + i, LCC 01
+and is a member of `users`, except every tenth user, who is only a member of
+`guests`.
+'''
+
+class FakeIPAServer:
+    '''
+    Runs the fake IPA server on a background thread.
+    '''
+
+    def __init__(self, users: int = 1000, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, port: int = 0, session_lifetime: float = 0.0) -> None:
+        # seconds added to every JSON-RPC request, plus up to `jitter` more
+        self.latency = latency
+        self.jitter = jitter
+        # fraction of JSON-RPC requests answered with HTTP 500
+        self.error_rate = error_rate
+        # seconds after login that requests with the session are answered
+        # with HTTP 401, 0 for sessions that never expire
+        self.session_lifetime = session_lifetime
+        # session cookie value -> time.monotonic() it was issued
+        self.sessions: Dict[str, float] = {}
+
+        self.users: Dict[str, dict] = {}
+        for i in range(users):
+            self.add_user(f"user{i}", f"{10000000 + i:08d}", '01', ['guests'] if i % 10 == 0 else ['users'])
+
+        self.requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self._tmpdir = tempfile.TemporaryDirectory()
+        cert = os.path.join(self._tmpdir.name, 'cert.pem')
+        key = os.path.join(self._tmpdir.name, 'key.pem')
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+            check=True, capture_output=True,
+        )
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-ipa', daemon=True)
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self) -> 'FakeIPAServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._tmpdir.cleanup()
+
+    def add_user(self, uid: str, employeenumber: str, employeetype: str, groups: List[str]) -> None:
+        self.users[uid] = {
+            'uid': [uid],
+            'employeenumber': [employeenumber],
+            'employeetype': [employeetype],
+            'memberof_group': list(groups),
+        }
+
+    def count(self, method: str) -> None:
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    # JSON-RPC methods. Each returns the `result` member of the response.
+
+    def user_find(self, args: list, params: dict) -> dict:
+        matches = list(self.users.values())
+        if 'employeenumber' in params:
+            matches = [u for u in matches if u['employeenumber'][0] == params['employeenumber']]
+        if 'uid' in params:
+            matches = [u for u in matches if u['uid'][0] == params['uid']]
+        if 'in_group' in params:
+            groups = params['in_group'] if isinstance(params['in_group'], list) else [params['in_group']]
+            matches = [u for u in matches if set(u['memberof_group']) & set(groups)]
+        count = len(matches)
+        if params.get('sizelimit'):
+            matches = matches[:params['sizelimit']]
+        return {
+            'result': matches,
+            'count': len(matches),
+            'truncated': len(matches) < count,
+            'summary': f"{len(matches)} user matched" if len(matches) == 1 else f"{len(matches)} users matched",
+        }
+
+    def ping(self, args: list, params: dict) -> dict:
+        return {'summary': 'IPA server version 4.9.8. API version 2.245'}
+
+    def user_mod(self, args: list, params: dict) -> dict:
+        uid = args[0]
+        if 'employeetype' in params:
+            self.users[uid]['employeetype'] = [params['employeetype']]
+        return {'result': self.users[uid], 'summary': f'Modified user "{uid}"', 'value': uid}
+
+    def group_show(self, args: list, params: dict) -> dict:
+        cn = args[0]
+        members = [u['uid'][0] for u in self.users.values() if cn in u['memberof_group']]
+        return {'result': {'cn': [cn], 'member_user': members}, 'summary': None, 'value': cn}
+
+def _make_handler(server: FakeIPAServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body go out in separate writes, don't let Nagle hold the body back
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes, content_type: str = 'application/json', headers: Optional[dict] = None) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            if self.path == '/ipa/session/login_password':
+                server.count('login')
+                with server._lock:
+                    session = f"fake{len(server.sessions)}"
+                    server.sessions[session] = time.monotonic()
+                self._reply(200, b'', 'text/plain', {'Set-Cookie': f'ipa_session={session}; Path=/ipa; Secure; HttpOnly'})
+                return
+
+            if self.path != '/ipa/session/json':
+                self._reply(404, b'')
+                return
+
+            session = self.headers.get('Cookie', '').partition('ipa_session=')[2].split(';')[0]
+            issued = server.sessions.get(session)
+            if issued is None or (server.session_lifetime and time.monotonic() - issued > server.session_lifetime):
+                server.count('unauthorized')
+                self._reply(401, b'', 'text/plain')
+                return
+
+            request = json.loads(body)
+            method = request['method']
+            args, params = request['params']
+            server.count(method)
+
+            if server.latency or server.jitter:
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+
+            if random.random() < server.error_rate:
+                self._reply(500, b'injected error', 'text/plain')
+                return
+
+            handler = getattr(server, method, None)
+            if handler is None:
+                response = {'result': None, 'error': {'code': 4001, 'name': 'CommandError', 'message': f"unknown command '{method}'"}, 'id': None}
+            else:
+                response = {'result': handler(args, params), 'error': None, 'id': None}
+            self._reply(200, json.dumps(response).encode())
+
+    return Handler
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a fake FreeIPA JSON-RPC server.")
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail with HTTP 500.')
+    parser.add_argument('--session-lifetime', type=float, default=0.0, help='Seconds until a session expires, 0 for never.')
+    args = parser.parse_args()
+
+    server = FakeIPAServer(users=args.users, latency=args.latency, error_rate=args.error_rate, port=args.port, session_lifetime=args.session_lifetime).start()
+    print(f"Fake IPA listening on {server.host}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
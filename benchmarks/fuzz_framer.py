@@ -0,0 +1,189 @@
+from typing import List, Optional, Tuple
+import argparse
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cardreader import EVENT, KEY_GAP, KEYS, MAX_FRAME, TY_KEY, VL_KEYDOWN, VL_KEYUP, InvalidDataEvent, RawKbdReader, SwipeEvent, SwipeFramer
+from evdev_dump import KEYCODES
+
+'''
+Fuzz test and throughput benchmark for SwipeFramer over synthetic keystroke
+streams, as RawKbdReader sees them.
+
+The fuzzed streams mix swipes with bursts of random keys, long enough to
+overflow a frame at times, and drop the end sentinel and newline of some
+swipes. A swipe that lost both is followed by a pause or by the next swipe,
+as it is at a real reader, so every swipe is expected back exactly once, with
+the time of its first key, and no swipe is made up from the garbage. Each
+stream is framed in one call, in random chunks like reads return them, and
+through RawKbdReader from an evdev dump of it; the three have to agree.
+
+    python3 benchmarks/fuzz_framer.py --streams 200
+    python3 benchmarks/fuzz_framer.py --streams 0 --swipes 100000   # throughput only
+'''
+
+Key = Tuple[str, Optional[float]]
+SWIPE_LIKE = re.compile(r';9\d{10}')
+# KEYS turns shift into ' ', which the reader presses for the '?' sentinel
+SHIFT = 42
+
+def swipe_keys(id: str, lcc: str, t: float, interval: float, end: str) -> List[Key]:
+    text = f";9{id}{lcc}00000" + {'full': ' /\n', 'newline': '\n', 'sentinel': ' /', 'none': ''}[end]
+    return [(char, t + i * interval) for i, char in enumerate(text)]
+
+def garbage(rng: random.Random, length: int) -> str:
+    while True:
+        text = ''.join(rng.choice(KEYS) for _ in range(length))
+        if not SWIPE_LIKE.search(text):
+            return text
+
+def fuzz_stream(rng: random.Random, count: int) -> Tuple[List[Key], List[Tuple[str, str, float]]]:
+    '''
+    A stream of about `count` swipes and garbage bursts, and the swipes
+    expected from it as (id, lcc, time of the first key).
+    '''
+    keys: List[Key] = []
+    expected = []
+    t = 1_700_000_000.0
+    last_end = 'full'
+    for _ in range(count):
+        interval = rng.uniform(0.001, 0.008)
+        if rng.random() < 0.3 and last_end != 'none':
+            # garbage right after the last frame or after a pause; a swipe
+            # that lost both ends would absorb it
+            text = garbage(rng, rng.choice([1, 3, rng.randrange(1, 3 * MAX_FRAME)]))
+            keys += [(char, t + i * interval) for i, char in enumerate(text)]
+            t += len(text) * interval + rng.choice([interval, KEY_GAP * 2])
+
+        id, lcc = f"{rng.randrange(10 ** 8):08d}", f"{rng.randrange(100):02d}"
+        last_end = rng.choices(['full', 'newline', 'sentinel', 'none'], [85, 5, 5, 5])[0]
+        swipe = swipe_keys(id, lcc, t, interval, last_end)
+        keys += swipe
+        expected.append((id, lcc, t))
+        # a swipe that lost both ends is ended by a pause or the next swipe
+        t = swipe[-1][1] + rng.choice([interval, KEY_GAP * 2, rng.uniform(0.5, 5)])
+    return keys, expected
+
+def frame(framer: SwipeFramer, chunks: List[List[Key]]) -> List:
+    events = []
+    for chunk in chunks:
+        events += framer.feed(chunk)
+        assert len(framer._frame) <= framer.max_frame, 'frame buffer grew past max_frame'
+    return events + framer.flush()
+
+def chunked(rng: random.Random, keys: List[Key]) -> List[List[Key]]:
+    chunks = []
+    i = 0
+    while i < len(keys):
+        n = rng.randrange(1, 40)
+        chunks.append(keys[i:i + n])
+        i += n
+    return chunks
+
+def write_keys(path: str, keys: List[Key]) -> None:
+    data = bytearray()
+    for char, t in keys:
+        code = SHIFT if char == ' ' else KEYCODES[char]
+        sec, usec = int(t), round((t % 1) * 1_000_000)
+        data += EVENT.pack(sec, usec, TY_KEY, code, VL_KEYDOWN)
+        data += EVENT.pack(sec, usec, TY_KEY, code, VL_KEYUP)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def summary(events: List) -> List[tuple]:
+    return [(e.id, e.lcc) if isinstance(e, SwipeEvent) else (type(e).__name__, e.data) for e in events]
+
+def keyed_at(events: List) -> List[float]:
+    return [e.keyed_at for e in events if isinstance(e, SwipeEvent)]
+
+def close(a: List[float], b: List[float], tolerance: float) -> bool:
+    return len(a) == len(b) and all(abs(x - y) < tolerance for x, y in zip(a, b))
+
+def fuzz(rng: random.Random, count: int, path: str, logger: logging.Logger) -> Tuple[int, int]:
+    keys, expected = fuzz_stream(rng, count)
+
+    events = frame(SwipeFramer(), [keys])
+    swipes = [(e.id, e.lcc) for e in events if isinstance(e, SwipeEvent)]
+    assert swipes == [e[:2] for e in expected], 'swipes lost or made up'
+    assert close(keyed_at(events), [e[2] for e in expected], 1e-6), 'wrong keyed_at'
+
+    assert summary(frame(SwipeFramer(), chunked(rng, keys))) == summary(events), 'framing depends on the reads'
+
+    write_keys(path, keys)
+    reader = RawKbdReader(path, logger, batch_events=rng.randrange(1, 128))
+    read = list(reader.events())
+    assert summary(read) == summary(events), 'RawKbdReader disagrees with the framer'
+    # evdev times are in microseconds
+    assert close(keyed_at(read), keyed_at(events), 2e-6), 'RawKbdReader got keyed_at wrong'
+    reader.close()
+
+    return len(swipes), sum(isinstance(e, InvalidDataEvent) for e in events)
+
+def random_bytes(rng: random.Random, path: str, logger: logging.Logger) -> None:
+    '''
+    RawKbdReader over arbitrary bytes, with keys for most of them.
+    '''
+    data = bytearray(rng.randbytes(EVENT.size * rng.randrange(1, 2000)))
+    for i in range(0, len(data), EVENT.size):
+        if rng.random() < 0.8:
+            data[i:i + EVENT.size] = EVENT.pack(rng.randrange(2 ** 31), rng.randrange(1_000_000), TY_KEY, rng.randrange(len(KEYS) + 8), VL_KEYDOWN)
+    with open(path, 'wb') as f:
+        f.write(data)
+    reader = RawKbdReader(path, logger)
+    for evt in reader.events():
+        assert isinstance(evt, (SwipeEvent, InvalidDataEvent))
+    reader.close()
+
+def throughput(name: str, keys: List[Key], swipes: int) -> None:
+    framer = SwipeFramer()
+    start = time.perf_counter()
+    events = framer.feed(keys) + framer.flush()
+    elapsed = time.perf_counter() - start
+    found = sum(isinstance(e, SwipeEvent) for e in events)
+    assert found == swipes, f"{found} of {swipes} swipes"
+    print(f"{name:>8}: {len(keys) / elapsed:12,.0f} keys/s  {elapsed / swipes * 1e6:6.2f} us/swipe  ({swipes} swipes)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuzz and benchmark SwipeFramer with synthetic keystroke streams.")
+    parser.add_argument('--streams', type=int, default=200, help='Fuzzed streams to check.')
+    parser.add_argument('--length', type=int, default=200, help='Swipes per fuzzed stream.')
+    parser.add_argument('--swipes', type=int, default=50000, help='Swipes in the throughput streams.')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    logger = logging.getLogger('fuzz_framer')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    try:
+        swipes = invalid = 0
+        for _ in range(args.streams):
+            found, rejected = fuzz(rng, rng.randrange(1, args.length + 1), path, logger)
+            swipes += found
+            invalid += rejected
+            random_bytes(rng, path, logger)
+        if args.streams:
+            print(f"fuzz: {args.streams} streams (seed {seed}) framed the same three ways, {swipes} swipes recovered, {invalid} garbage frames rejected")
+    finally:
+        os.unlink(path)
+
+    clean = []
+    for i in range(args.swipes):
+        clean += swipe_keys(f"{i:08d}", '01', float(i), 0.002, 'full')
+    throughput('clean', clean, args.swipes)
+    noisy, expected = fuzz_stream(random.Random(seed), args.swipes)
+    throughput('fuzzed', noisy, len(expected))
+
+if __name__ == '__main__':
+    main()
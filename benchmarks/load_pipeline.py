@@ -0,0 +1,110 @@
+from typing import Dict, List
+import argparse
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cardreader import SwipeEvent
+from config import load_config
+from decision import Decider, Decision
+from ipa_sync import SyncWorker
+from pipeline import SwipePipeline
+from snapshot import AccessSnapshot
+from fake_ipa import FakeIPAServer
+
+'''
+Load test for SwipePipeline. Feeds synthetic swipes from several doors
+through the real decision path against a local fake IPA server, once with a
+single lookup worker (equivalent to handling swipes one after another) and
+once with the configured number of workers, and reports p50/p99 latency from
+swipe to decision.
+
+The access cache is left out so every swipe costs an IPA lookup.
+
+    python3 benchmarks/load_pipeline.py --swipes 500 --latency 0.05 --workers 8
+'''
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.example.cfg')
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(server: FakeIPAServer, workers: int, swipes: List[SwipeEvent], rate: float, logger: logging.Logger) -> None:
+    config = load_config(CONFIG_PATH)
+    config.credentials.hosts = [server.host]
+    config.credentials.verify_ssl = False
+
+    snapshot = AccessSnapshot(logger, None)
+    sync = SyncWorker(logger, config, None, snapshot)
+    sync.connect()
+    decider = Decider(logger, config, None, snapshot, sync)
+
+    submitted_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    delivered: Dict[str, List[int]] = {}
+    done = threading.Event()
+
+    def on_decision(evt: SwipeEvent, decision: Decision) -> None:
+        latencies.append(time.perf_counter() - submitted_at[id(evt)])
+        delivered.setdefault(evt.reader, []).append(evt.seq)
+        if len(latencies) == len(swipes):
+            done.set()
+
+    pipeline = SwipePipeline(logger, decider.decide, on_decision, workers=workers, max_pending=max(workers * 4, 16))
+
+    start = time.perf_counter()
+    for i, evt in enumerate(swipes):
+        if rate:
+            # open loop: swipes arrive on schedule even if the pipeline is behind
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        submitted_at[id(evt)] = time.perf_counter()
+        pipeline.submit(evt)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    pipeline.shutdown()
+
+    in_order = all(seqs == sorted(seqs) for seqs in delivered.values())
+    print(f"workers={workers:<3} {len(swipes) / elapsed:8.1f} swipes/s  p50 {percentile(latencies, 0.5) * 1000:8.1f}ms  p99 {percentile(latencies, 0.99) * 1000:8.1f}ms  coalesced {pipeline.coalesced:<4} per-door order kept: {in_order}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the swipe pipeline against a fake IPA server.")
+    parser.add_argument('--swipes', type=int, default=300)
+    parser.add_argument('--doors', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.03, help='Base IPA latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.03, help='Extra random IPA latency in seconds.')
+    parser.add_argument('--rate', type=float, default=50.0, help='Swipes per second, 0 for as fast as possible.')
+    args = parser.parse_args()
+
+    urllib3.disable_warnings()
+
+    logger = logging.getLogger('load_pipeline')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    rng = random.Random(1)
+    swipes = []
+    for seq in range(args.swipes):
+        evt = SwipeEvent(id=f"{10000000 + rng.randrange(args.users):08d}", lcc='01', reader=f"door{rng.randrange(args.doors)}")
+        evt.seq = seq
+        swipes.append(evt)
+
+    server = FakeIPAServer(users=args.users, latency=args.latency, jitter=args.jitter).start()
+    try:
+        run(server, 1, swipes, args.rate, logger)
+        run(server, args.workers, swipes, args.rate, logger)
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+from typing import Dict, List, Tuple
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import tempfile
+import time
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as gatekeeper
+from cardreader import SwipeEvent
+from config import load_config
+from remote import MSG_DECISION, DecisionServer, _split_frames, decode_decision, encode_swipe, handshake, parse_address
+from replay import CONFIG_PATH, percentile, serve_fake_ipa
+
+'''
+Load test for the decision daemon. Runs `main.run()` as a daemon, pinned to
+one CPU, in its own process against the fake IPA server, and opens one
+connection per simulated door node to it. Swipes are spread over the doors at
+a fixed total rate and pipelined on each connection.
+
+Reports throughput, round-trip latency from sending a swipe to reading its
+decision, and the CPU time the daemon spent. A first pass over all users warms
+the access cache, so the timed run measures the daemon rather than IPA.
+
+    python3 benchmarks/load_remote.py --doors 300 --swipes 20000 --rate 2000
+    python3 benchmarks/load_remote.py --tcp
+'''
+
+# frames are signed as on a real network, where remote.secret is required
+SECRET = 'load-remote-benchmark-secret'
+
+def serve_daemon(host: str, address: str, cpu: int, conn) -> None:
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    urllib3.disable_warnings()
+
+    logger = logging.getLogger('load_remote')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    config = load_config(CONFIG_PATH)
+    config.credentials.hosts = [host]
+    config.credentials.verify_ssl = False
+    config.cache.path = None
+    config.offline.snapshot = None
+    config.writeback.path = None
+    config.audit.path = None
+    config.metrics.port = 0
+    config.pipeline.debounce = 0
+    config.ratelimit.reader_rate = config.ratelimit.card_rate = 0
+    config.remote.role = 'daemon'
+    config.remote.secret = SECRET
+
+    server = DecisionServer(logger, address, config.remote.secret)
+    conn.send(server.bound_address)
+    gatekeeper.run(config, logger, None, server)
+
+def cpu_seconds(pid: int) -> float:
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rpartition(')')[2].split()
+    # utime and stime, fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def drive(address, doors: int, swipes: List[Tuple[int, str]], rate: float) -> Tuple[float, List[float], Dict[str, int]]:
+    '''
+    Send `swipes` as (door, card ID) at `rate` per second, 0 for as fast as
+    the daemon answers. Returns the elapsed time, the round trips and the
+    count of decisions per source.
+    '''
+    family, sockaddr = parse_address(address) if isinstance(address, str) else (socket.AF_INET, address)
+    socks = []
+    keys = {}
+    buffers = {}
+    for _ in range(doors):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(sockaddr)
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        keys[sock], buffers[sock] = handshake(sock, SECRET.encode())
+        sock.setblocking(False)
+        socks.append(sock)
+
+    selector = selectors.DefaultSelector()
+    for sock in socks:
+        selector.register(sock, selectors.EVENT_READ)
+
+    sent_at: Dict[int, float] = {}
+    round_trips: List[float] = []
+    sources: Dict[str, int] = {}
+    # unanswered swipes a door may have outstanding, like pipeline.max_pending
+    window = 64
+    outstanding = [0] * doors
+
+    begin = time.perf_counter()
+    next_swipe = 0
+    while len(round_trips) < len(swipes):
+        now = time.perf_counter()
+        while next_swipe < len(swipes) and (not rate or begin + next_swipe / rate <= now):
+            door, id = swipes[next_swipe]
+            if outstanding[door] >= window:
+                break
+            sent_at[next_swipe] = time.perf_counter()
+            socks[door].sendall(encode_swipe(keys[socks[door]], next_swipe + 1, SwipeEvent(id=id, lcc='01', reader=f"door{door}")))
+            outstanding[door] += 1
+            next_swipe += 1
+
+        timeout = 0.001
+        if rate and next_swipe < len(swipes):
+            timeout = max(0.0, min(timeout, begin + next_swipe / rate - time.perf_counter()))
+        for key, _ in selector.select(timeout):
+            sock = key.fileobj
+            buf = buffers[sock]
+            buf += sock.recv(65536)
+            for type, request_id, body in _split_frames(buf, keys[sock]):
+                assert type == MSG_DECISION
+                round_trips.append(time.perf_counter() - sent_at.pop(request_id - 1))
+                outstanding[swipes[request_id - 1][0]] -= 1
+                source = decode_decision(body).source
+                sources[source] = sources.get(source, 0) + 1
+    elapsed = time.perf_counter() - begin
+
+    selector.close()
+    for sock in socks:
+        sock.close()
+    return elapsed, round_trips, sources
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the decision daemon with many door connections.")
+    parser.add_argument('--doors', type=int, default=300)
+    parser.add_argument('--swipes', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=2000.0, help='Swipes per second over all doors, 0 for as fast as possible.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.005, help='Base IPA latency in seconds.')
+    parser.add_argument('--tcp', action='store_true', help='Connect over TCP on localhost instead of a Unix socket.')
+    parser.add_argument('--cpu', type=int, default=0, help='CPU the daemon is pinned to.')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    ipa_conn, child_conn = multiprocessing.Pipe()
+    ipa = multiprocessing.Process(target=serve_fake_ipa, args=(args.users, args.latency, args.latency, 0.0, child_conn), daemon=True)
+    ipa.start()
+    host = ipa_conn.recv()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        address = '127.0.0.1:0' if args.tcp else f"unix:{os.path.join(tmp, 'gatekeeper.sock')}"
+        daemon_conn, child_conn = multiprocessing.Pipe()
+        daemon = multiprocessing.Process(target=serve_daemon, args=(host, address, args.cpu, child_conn), daemon=True)
+        daemon.start()
+        bound = daemon_conn.recv()
+        if args.tcp:
+            address = bound
+
+        rng = random.Random(args.seed)
+        warm = [(user % args.doors, f"{10000000 + user:08d}") for user in range(args.users)]
+        drive(address, args.doors, warm, 0)
+
+        swipes = [(rng.randrange(args.doors), f"{10000000 + rng.randrange(args.users):08d}") for _ in range(args.swipes)]
+        cpu_before = cpu_seconds(daemon.pid)
+        elapsed, round_trips, sources = drive(address, args.doors, swipes, args.rate)
+        cpu = cpu_seconds(daemon.pid) - cpu_before
+
+        daemon.terminate()
+        ipa_conn.send('stop')
+
+    print(f"{len(swipes)} swipes from {args.doors} doors over {'TCP' if args.tcp else 'a Unix socket'} in {elapsed:.2f}s: {len(swipes) / elapsed:.1f} swipes/s, decided by {sources}")
+    print(f"round trip: p50 {percentile(round_trips, 0.5) * 1000:.2f}ms  p99 {percentile(round_trips, 0.99) * 1000:.2f}ms  max {max(round_trips) * 1000:.2f}ms")
+    print(f"daemon CPU: {cpu:.2f}s, {cpu / elapsed * 100:.0f}% of one core, {cpu / len(swipes) * 1e6:.0f}us per swipe")
+
+if __name__ == '__main__':
+    main()
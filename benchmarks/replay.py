@@ -0,0 +1,285 @@
+from typing import List
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cardreader
+import main as gatekeeper
+from cardreader import EVENT, KEYMAP, TY_KEY, VL_KEYDOWN
+from config import load_config
+from strike import Strike
+from evdev_dump import encode, swipe_line
+from fake_ipa import FakeIPAServer
+
+'''
+End-to-end replay benchmark. Feeds a synthetic or recorded stream of swipes
+through a card reader (StdinReader on a pipe, or RawKbdReader on a FIFO
+carrying evdev events) into `main.run()`, the same code path as a real door,
+with IPA served by `fake_ipa.py` in a separate process and the fake strike
+recording when each grant reached it.
+
+Reports throughput, swipe-to-strike latency (last byte of the swipe written
+to strike engaged) and memory. The decisions are read back from the audit
+log, which also checks that every swipe was decided.
+
+    python3 benchmarks/replay.py --swipes 2000 --rate 200 --reader rawkbd
+    python3 benchmarks/replay.py --cold --latency 0.02 --error-rate 0.05
+    python3 benchmarks/replay.py --input swipes.txt          # one ';9...' line per swipe
+    python3 benchmarks/replay.py --dump recorded.evdev       # recorded /dev/input/event* data
+
+With --max-p99-ms, --min-throughput or --max-rss-mb it exits with status 1
+when a limit is exceeded, so it can gate CI. --json writes the results for
+comparison between runs.
+'''
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.example.cfg')
+
+class TimingStrike(Strike):
+    '''
+    The fake strike, remembering the time of every grant it received.
+    '''
+
+    def __init__(self, logger: logging.Logger, hold_time: float) -> None:
+        super().__init__(logger, hold_time)
+        self.engaged_at: List[float] = []
+
+    def _engage(self) -> bool:
+        self.engaged_at.append(time.perf_counter())
+        return super()._engage()
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+def serve_fake_ipa(users: int, latency: float, jitter: float, error_rate: float, conn) -> None:
+    server = FakeIPAServer(users=users, latency=latency, jitter=jitter, error_rate=error_rate).start()
+    conn.send(server.host)
+    conn.recv()
+    conn.send(server.requests)
+    server.stop()
+
+def read_dump(path: str) -> List[str]:
+    '''
+    Lines typed in a recorded evdev dump.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    lines, line = [], []
+    for (_, _, type, code, value) in EVENT.iter_unpack(data[:len(data) - len(data) % EVENT.size]):
+        if type != TY_KEY or value != VL_KEYDOWN or code not in KEYMAP:
+            continue
+        if KEYMAP[code] == '\n':
+            lines.append(''.join(line) + '\n')
+            line.clear()
+        else:
+            line.append(KEYMAP[code])
+    return lines
+
+def synthetic_swipes(count: int, users: int, unknown: float, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        if rng.random() < unknown:
+            # not in IPA
+            id = f"{90000000 + rng.randrange(1000000):08d}"
+        else:
+            id = f"{10000000 + rng.randrange(users):08d}"
+        lines.append(swipe_line(id, '01'))
+    return lines
+
+def feed(fd: int, lines: List[str], rate: float, raw: bool, sent_at: List[float], start: threading.Event) -> None:
+    start.wait()
+    begin = time.perf_counter()
+    for i, line in enumerate(lines):
+        if rate:
+            # open loop: swipes arrive on schedule even if GateKeeper is behind
+            delay = begin + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if raw:
+            # keys typed at the reader's pace, ending now
+            data = encode(line, start=time.time() - len(line) * 0.002)
+        else:
+            data = line.encode()
+        os.write(fd, data)
+        sent_at.append(time.perf_counter())
+    os.close(fd)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay swipes through GateKeeper end to end against a fake IPA server.")
+    parser.add_argument('--reader', choices=['stdin', 'rawkbd'], default='stdin')
+    parser.add_argument('--swipes', type=int, default=1000)
+    parser.add_argument('--input', help='Replay these swipe lines instead of synthetic ones.')
+    parser.add_argument('--dump', help='Replay the swipes in this recorded evdev dump instead of synthetic ones.')
+    parser.add_argument('--rate', type=float, default=100.0, help='Swipes per second, 0 for as fast as possible.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--unknown', type=float, default=0.05, help='Fraction of synthetic swipes with cards IPA does not know.')
+    parser.add_argument('--latency', type=float, default=0.005, help='Base IPA latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.005, help='Extra random IPA latency in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of IPA requests that fail.')
+    parser.add_argument('--cold', action='store_true', help='Expire cached accounts immediately, so every swipe is looked up in IPA.')
+    parser.add_argument('--workers', type=int, help='Override pipeline.workers.')
+    parser.add_argument('--debounce', type=float, help='Override pipeline.debounce.')
+    parser.add_argument('--rate-limits', action='store_true', help='Keep the rate limits of the example config. By default they are off, since the replay swipes far faster than a door.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Write the results to this file.')
+    parser.add_argument('--max-p99-ms', type=float, help='Fail if the p99 swipe-to-strike latency is higher.')
+    parser.add_argument('--min-throughput', type=float, help='Fail if fewer swipes per second were decided.')
+    parser.add_argument('--max-rss-mb', type=float, help='Fail if the peak resident memory is higher.')
+    args = parser.parse_args()
+
+    urllib3.disable_warnings()
+
+    logger = logging.getLogger('replay')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    if args.input:
+        with open(args.input) as f:
+            lines = [line.strip() + '\n' for line in f]
+    elif args.dump:
+        lines = read_dump(args.dump)
+    else:
+        lines = synthetic_swipes(args.swipes, args.users, args.unknown, args.seed)
+    # only swipes are decided and audited
+    lines = [line for line in lines if line.startswith(';9')]
+
+    ipa_conn, child_conn = multiprocessing.Pipe()
+    ipa = multiprocessing.Process(target=serve_fake_ipa, args=(args.users, args.latency, args.jitter, args.error_rate, child_conn), daemon=True)
+    ipa.start()
+    host = ipa_conn.recv()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = load_config(CONFIG_PATH)
+        config.credentials.hosts = [host]
+        config.credentials.verify_ssl = False
+        config.cache.path = None
+        if args.cold:
+            config.cache.ttl = 1e-9
+        config.offline.snapshot = os.path.join(tmp, 'snapshot.bin')
+        config.writeback.path = None
+        config.audit.path = os.path.join(tmp, 'audit.ndjson')
+        config.audit.flush_interval = 0.1
+        config.metrics.port = 0
+        if args.workers:
+            config.pipeline.workers = args.workers
+        if args.debounce is not None:
+            config.pipeline.debounce = args.debounce
+        if not args.rate_limits:
+            config.ratelimit.reader_rate = config.ratelimit.card_rate = 0
+
+        if args.reader == 'stdin':
+            read_fd, write_fd = os.pipe()
+            os.dup2(read_fd, sys.stdin.fileno())
+            os.close(read_fd)
+            reader = cardreader.StdinReader(logger, name='default')
+        else:
+            device = os.path.join(tmp, 'event0')
+            os.mkfifo(device)
+            # opening either end of a FIFO waits for the other
+            opener = threading.Thread(target=lambda: setattr(opener, 'fd', os.open(device, os.O_WRONLY)))
+            opener.start()
+            reader = cardreader.RawKbdReader(device, logger, name='default')
+            opener.join()
+            write_fd = opener.fd
+
+        strike = TimingStrike(logger, config.strike.hold_time)
+        sent_at: List[float] = []
+        start = threading.Event()
+        feeder = threading.Thread(target=feed, args=(write_fd, lines, args.rate, args.reader == 'rawkbd', sent_at, start), daemon=True)
+        feeder.start()
+
+        def start_when_synced() -> None:
+            # the first sync writes the snapshot; before that swipes would be
+            # decided offline
+            deadline = time.monotonic() + 60
+            while not os.path.exists(config.offline.snapshot) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            if not os.path.exists(config.offline.snapshot):
+                print("warning: no sync with the fake IPA after 60s, starting anyway", file=sys.stderr)
+            start.set()
+        threading.Thread(target=start_when_synced, daemon=True).start()
+
+        rss_before = rss_mb()
+        gatekeeper.run(config, logger, strike, reader)
+        finished = time.perf_counter()
+        rss_after = rss_mb()
+
+        with open(config.audit.path) as f:
+            records = [json.loads(line) for line in f]
+
+    ipa_conn.send('stop')
+    ipa_requests = ipa_conn.recv()
+    ipa.join()
+
+    if len(records) != len(lines):
+        print(f"error: {len(lines)} swipes sent but {len(records)} decided", file=sys.stderr)
+        sys.exit(1)
+
+    granted = [i for i, r in enumerate(records) if r['decision'] == 'granted']
+    # repeat swipes while the door is open do not actuate the strike
+    actuated = [i for i in granted if 'actuation' in records[i]['ms']]
+    if len(actuated) != len(strike.engaged_at):
+        print(f"error: {len(actuated)} grants actuated the strike but it was engaged {len(strike.engaged_at)} times", file=sys.stderr)
+        sys.exit(1)
+    # decisions are acted on in swipe order, so the n-th engagement belongs to the n-th actuating grant
+    latencies = [engaged - sent_at[i] for i, engaged in zip(actuated, strike.engaged_at)]
+    lookups = [r['ms']['lookup'] / 1000 for r in records if 'lookup' in r['ms']]
+    elapsed = finished - sent_at[0]
+
+    results = {
+        'reader': args.reader,
+        'swipes': len(lines),
+        'granted': len(granted),
+        'sources': {source: sum(r['source'] == source for r in records) for source in sorted({r['source'] for r in records})},
+        'throughput': len(lines) / elapsed,
+        'strike_p50_ms': percentile(latencies, 0.5) * 1000,
+        'strike_p95_ms': percentile(latencies, 0.95) * 1000,
+        'strike_p99_ms': percentile(latencies, 0.99) * 1000,
+        'lookup_p50_ms': percentile(lookups, 0.5) * 1000,
+        'lookup_p99_ms': percentile(lookups, 0.99) * 1000,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rss_growth_mb': rss_after - rss_before,
+        'ipa_requests': ipa_requests,
+    }
+
+    print(f"{results['swipes']} swipes ({results['granted']} granted, {results['sources']}) via {args.reader} in {elapsed:.2f}s: {results['throughput']:.1f} swipes/s")
+    print(f"swipe to strike: p50 {results['strike_p50_ms']:.2f}ms  p95 {results['strike_p95_ms']:.2f}ms  p99 {results['strike_p99_ms']:.2f}ms")
+    print(f"lookup:          p50 {results['lookup_p50_ms']:.2f}ms  p99 {results['lookup_p99_ms']:.2f}ms")
+    print(f"memory: peak RSS {results['peak_rss_mb']:.1f} MiB, grew {results['rss_growth_mb']:.1f} MiB during the run")
+    print(f"IPA requests: {ipa_requests}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failures = []
+    if args.max_p99_ms is not None and results['strike_p99_ms'] > args.max_p99_ms:
+        failures.append(f"p99 swipe-to-strike latency {results['strike_p99_ms']:.2f}ms exceeds {args.max_p99_ms}ms")
+    if args.min_throughput is not None and results['throughput'] < args.min_throughput:
+        failures.append(f"throughput {results['throughput']:.1f}/s is below {args.min_throughput}/s")
+    if args.max_rss_mb is not None and results['peak_rss_mb'] > args.max_rss_mb:
+        failures.append(f"peak RSS {results['peak_rss_mb']:.1f} MiB exceeds {args.max_rss_mb} MiB")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,83 @@
-from typing import Callable, Literal, NoReturn, Iterator
-from dataclasses import dataclass
+from typing import Callable, Iterable, List, Literal, NoReturn, Iterator, Optional, Tuple
+from dataclasses import dataclass, field
+from itertools import repeat
+import codecs
+import errno
 import os
+import re
 import sys
 import struct
 import io
+import selectors
+import threading
+import time
 from logging import Logger
 from config import Reader as ReaderConfig
 
 '''
 Module for reading data from a MODEL:ET-MS90 ETEKJOY card reader.
 
-Use StdinReader or RawKbdReader for reading from the card. Once created, call
-read_loop on them and pass in a callback to handle events.
+Use StdinReader or RawKbdReader for reading from the card. Once created,
+iterate over events() on them to handle events. MultiReader reads from
+several of them at once in the same thread.
 
-The get_cardreader(reader_config) may be used to create the correct CardReader
-class based on the configuration settings.
+The get_cardreader(reader_configs) may be used to create the correct
+CardReader class based on the configuration settings.
 
 Example code:
 
-    def handle_cardreader_event(evt: ReaderEvent):
-        if isinstance(evt, SwipeEvent):
-            # do something with evt.id and evt.lcc
-
     config = load_config("config.cfg")
-    cardreader = get_cardreader(config.reader)
-    cardreader.read_loop(handle_cardreader_event)
+    cardreader = get_cardreader(config.readers, logger)
+    for evt in cardreader.events():
+        if isinstance(evt, SwipeEvent):
+            # do something with evt.id, evt.lcc and evt.reader
 
 Data Format:
 
 The MODEL:ET-MS90 ETEKJOY card reader sends data in the following format:
 
-    ;9<id:\d{8}><lcc:\d{2}><garbage>NEWLINE
+    ;9<id:\d{8}><lcc:\d{2}><garbage>?NEWLINE
+
+';' and '?' are the start and end sentinels of the card's track. Over rawkbd
+the '?' is typed as shift+'/', which arrives as ' /'.
+
+SwipeFramer splits the keystrokes into swipes. It does not rely on the
+newline alone: a swipe also ends at its end sentinel, at the start sentinel of
+the next one and, for rawkbd, when the next key comes more than `key_gap`
+seconds after the previous one (the reader types a whole swipe in well under
+that). Frames are capped at `max_frame` keys, so keys from a stuck or
+misbehaving reader are dropped instead of piling up, and reading picks up
+again at the next start sentinel.
 '''
 
+# struct input_event from linux/input.h: struct timeval (two native longs),
+# __u16 type, __u16 code, __s32 value
+EVENT = struct.Struct('llHHi')
+
+# kinda cursed way for parsing keyboard events. index the keycode into here
+# and you'll get something reasonable. this doesnt cover all keycodes.
+#
+# control keys are replaced with space.
+#
+# reference: https://github.com/torvalds/linux/blob/v5.5-rc5/include/uapi/linux/input-event-codes.h
+TY_KEY = 1
+KEYS = "  1234567890-= \tqwertyuiop[]\n asdfghjkl;'` \\zxcvbnm,./ "
+VL_KEYDOWN = 1
+VL_KEYUP = 0
+
+# keycode -> character, so decoding a key press is a single dict lookup
+KEYMAP = dict(enumerate(KEYS))
+
+# a whole frame from the start sentinel on, checked with a single fullmatch
+SWIPE = re.compile(r';9(\d{8})(\d{2})[^;]*')
+START_SENTINEL = ';'
+END_SENTINELS = '?/'
+
+# longest pause between the keys of one swipe, in seconds
+KEY_GAP = 0.1
+# longest frame in keys, a swipe is about 20
+MAX_FRAME = 64
+
 class ReaderEvent:
     pass
 
@@ -43,6 +88,18 @@ class SwipeEvent(ReaderEvent):
     '''
     id: str
     lcc: str
+    # name of the reader the card was swiped at
+    reader: Optional[str] = None
+    # time.time() of the swipe's first keystroke, if the reader knows it
+    keyed_at: Optional[float] = None
+    # time.monotonic() at which the swipe was parsed
+    received_at: float = field(default_factory=time.monotonic)
+    # seconds from the first keystroke to the parsed swipe, if the reader knows it
+    read_seconds: Optional[float] = None
+
+    def __post_init__(self):
+        if self.keyed_at is not None and self.read_seconds is None:
+            self.read_seconds = time.time() - self.keyed_at
 
 @dataclass
 class InvalidDataEvent(ReaderEvent):
@@ -51,6 +108,7 @@ class InvalidDataEvent(ReaderEvent):
     '''
     data: str
     exc_info: Exception
+    reader: Optional[str] = None
 
 class CouldNotInitializeReader(Exception):
     '''
@@ -67,51 +125,164 @@ ReaderEventHandler = Callable[[ReaderEvent], None]
 class CardReader:
     '''
     Base class for card reader implementations.
+
+    Readers backed by a file descriptor implement `fileno()` and
+    `read_events()`, which lets `MultiReader` wait on several of them at once.
     '''
+    name: Optional[str] = None
 
-    def events() -> Iterator[ReaderEvent]:
+    def fileno(self) -> int:
         '''
-        Returns an iterator that yields events from the card reader, in order.
+        Returns the file descriptor to wait on for new data.
+        '''
+        raise NotImplementedError
+
+    def read_events(self) -> Optional[List[ReaderEvent]]:
+        '''
+        Reads whatever data is ready with a single read and returns the events
+        it completed, which may be none. Returns None once the input is closed.
+        '''
+        raise NotImplementedError
+
+    def close(self) -> None:
+        '''
+        Releases the reader's input, if it owns it.
         '''
         pass
 
+    def events(self) -> Iterator[ReaderEvent]:
+        '''
+        Returns an iterator that yields events from the card reader, in order.
+        '''
+        while True:
+            events = self.read_events()
+            if events is None:
+                break
+            yield from events
+
 
-def _parse_reader_line(data: str) -> ReaderEvent:
+def _parse_reader_line(data: str, reader: Optional[str] = None, keyed_at: Optional[float] = None) -> ReaderEvent:
     '''
     Private function to parse lines of input from the card reader. See this
     module's doc comment for a description of the expected format.
     '''
-    try:
-        if data.startswith(";9"):
-            # swipe received
-            id = data[2:10]
-            lcc = data[10:12]
-            return SwipeEvent(id=id, lcc=lcc)
-        else:
-            return InvalidDataEvent(data=data, exc_info=None)
-    except Exception as e:
-        return InvalidDataEvent(data=data, exc_info=e)
+    match = SWIPE.fullmatch(data)
+    if match is None:
+        return InvalidDataEvent(data=data, exc_info=None, reader=reader)
+    return SwipeEvent(id=match[1], lcc=match[2], reader=reader, keyed_at=keyed_at)
 
-class StdinReader(CardReader):
+class SwipeFramer:
     '''
-    Reads card data from stdin.
+    Splits the keystrokes of one reader into frames and parses them, see this
+    module's doc comment. Keeps the partly read frame between calls to
+    `feed()`.
     '''
 
-    def __init__(self, logger: Logger):
-        self.logger = logger
+    def __init__(self, reader: Optional[str] = None, key_gap: float = KEY_GAP, max_frame: int = MAX_FRAME):
+        self.reader = reader
+        self.key_gap = key_gap
+        self.max_frame = max_frame
 
-    def events(self) -> Iterator[ReaderEvent]:
-        logger = self.logger
+        self._frame: List[str] = []
+        # time of the first key of the frame and of the last key
+        self._started: Optional[float] = None
+        self._last = float('-inf')
+        # the frame was too long and reported already, its keys are dropped
+        # until it ends
+        self._dropping = False
 
-        while True:
-            data = None
-            try:
-                data = input()
-            except EOFError:
-                logger.info(f"stdin closed: no more events from the card reader will be received")
-                break
+    def feed(self, keys: Iterable[Tuple[str, Optional[float]]]) -> List[ReaderEvent]:
+        '''
+        Frames `keys`, pairs of a character and the time.time() it was typed
+        at, if known, and returns the events for the frames they completed.
+        '''
+        events = []
+        frame = self._frame
+        key_gap, max_frame = self.key_gap, self.max_frame
+        # the state lives in locals while the keys are framed
+        started, last, dropping = self._started, self._last, self._dropping
+
+        for char, t in keys:
+            if t is not None:
+                if t - last > key_gap and (frame or dropping):
+                    # the frame lost its end, the reader is done with it
+                    self._end(events, started, dropping)
+                    dropping = False
+                last = t
+
+            if char == '\n':
+                self._end(events, started, dropping)
+                dropping = False
+            elif char == START_SENTINEL:
+                if frame or dropping:
+                    # a new swipe started, whatever came before is garbage
+                    # or a swipe that lost its end
+                    self._end(events, started, dropping)
+                    dropping = False
+                started = t
+                frame.append(char)
+            elif dropping:
+                pass
+            elif len(frame) >= max_frame:
+                events.append(InvalidDataEvent(data=''.join(frame), exc_info=ValueError(f"frame longer than {max_frame} keys"), reader=self.reader))
+                frame.clear()
+                dropping = True
+            else:
+                if not frame:
+                    started = t
+                frame.append(char)
+                if char in END_SENTINELS:
+                    self._end(events, started, dropping)
+
+        self._started, self._last, self._dropping = started, last, dropping
+        return events
+
+    def flush(self) -> List[ReaderEvent]:
+        '''
+        Ends the current frame, e.g. once the input is closed.
+        '''
+        events = []
+        self._end(events, self._started, self._dropping)
+        self._dropping = False
+        return events
+
+    def _end(self, events: List[ReaderEvent], started: Optional[float], dropping: bool) -> None:
+        frame = self._frame
+        if frame and not dropping:
+            data = ''.join(frame)
+            # stray control keys, which KEYS turns into whitespace
+            if not data.isspace():
+                events.append(_parse_reader_line(data, self.reader, started))
+        frame.clear()
 
-            yield _parse_reader_line(data)
+class StdinReader(CardReader):
+    '''
+    Reads card data from stdin.
+    '''
+
+    def __init__(self, logger: Logger, name: Optional[str] = None):
+        self.logger = logger
+        self.name = name
+        # a read may end in the middle of a character
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._framer = SwipeFramer(name)
+
+    def fileno(self) -> int:
+        return sys.stdin.fileno()
+
+    def read_events(self) -> Optional[List[ReaderEvent]]:
+        # read the file descriptor directly: sys.stdin's own buffering would
+        # hide data that is ready from select()
+        data = os.read(self.fileno(), 4096)
+        if not data:
+            events = self._framer.feed(zip(self._decoder.decode(b'', final=True), repeat(None))) + self._framer.flush()
+            if events:
+                return events
+            self.logger.info(f"stdin closed: no more events from the card reader will be received")
+            return None
+
+        # no key times: stdin is framed by sentinels and newlines only
+        return self._framer.feed(zip(self._decoder.decode(data), repeat(None)))
 
 class RawKbdReader(CardReader):
     '''
@@ -120,8 +291,10 @@ class RawKbdReader(CardReader):
     device: io.BytesIO
     logger: Logger
 
-    def __init__(self, device: str, logger: Logger):
+    def __init__(self, device: str, logger: Logger, batch_events: int = 64, name: Optional[str] = None, key_gap: float = KEY_GAP, max_frame: int = MAX_FRAME):
         self.logger = logger
+        self.batch_events = batch_events
+        self.name = name
 
         try:
             self.device = open(device, mode='rb', buffering=0)
@@ -134,59 +307,213 @@ class RawKbdReader(CardReader):
                 message=f"Lacking permission to open keyboard device file '{device}'"
             )
 
-    def events(self) -> Iterator[ReaderEvent]:
-        EVENT_FORMAT = 'llHHi'
-        EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
-
-        # kinda cursed way for parsing keyboard events. index the keycode into here
-        # and you'll get something reasonable. this doesnt cover all keycodes.
-        #
-        # control keys are replaced with space.
-        #
-        # reference: https://github.com/torvalds/linux/blob/v5.5-rc5/include/uapi/linux/input-event-codes.h
-        TY_KEY = 1
-        KEYS = "  1234567890-= \tqwertyuiop[]\n asdfghjkl;'` \\zxcvbnm,./ "
-        VL_KEYDOWN = 1
-        VL_KEYUP = 0
+        # read as many events per syscall as the device has ready, up to
+        # batch_events, into a buffer that is reused for every read
+        self._buf = bytearray(EVENT.size * batch_events)
+        self._view = memoryview(self._buf)
+        self._filled = 0
 
-        logger = self.logger
+        self._framer = SwipeFramer(name, key_gap, max_frame)
 
-        buf = ''
+    def fileno(self) -> int:
+        return self.device.fileno()
 
-        while True:
-            event = self.device.read(EVENT_SIZE)
-            if not event:
-                logger.info(f"no more data from rawkbd: no more events from the card reader will be received")
-                break
+    def close(self) -> None:
+        self.device.close()
 
+    def read_events(self) -> Optional[List[ReaderEvent]]:
+        logger = self.logger
+        keymap_get = KEYMAP.get
+        buf, view = self._buf, self._view
+
+        n = self.device.readinto(view[self._filled:])
+        if not n:
+            events = self._framer.flush()
+            if events:
+                return events
+            logger.info(f"no more data from rawkbd: no more events from the card reader will be received")
+            return None
+
+        filled = self._filled + n
+        # evdev only returns whole events, but a recorded dump read from a
+        # regular file may end a read mid-event
+        usable = filled - filled % EVENT.size
+
+        keys = []
+        keys_append = keys.append
+        for (tv_sec, tv_usec, type, code, value) in EVENT.iter_unpack(view[:usable]):
+            if type != TY_KEY or value != VL_KEYDOWN:
+                continue
+
+            # key was just pressed
+            # https://github.com/torvalds/linux/blob/v5.5-rc5/include/uapi/linux/input-event-codes.h#L39
+            char = keymap_get(code)
+            if char is None:
+                logger.warning(f"received out-of-bounds keycode {code} while reading rawkbd device")
+                continue
+            # the kernel stamps events as the keys come in, so the gaps
+            # between keys hold however late this read is
+            keys_append((char, tv_sec + tv_usec / 1_000_000))
+
+        rest = filled - usable
+        if rest:
+            buf[:rest] = buf[usable:filled]
+        self._filled = rest
+
+        if not keys:
+            return []
+        return self._framer.feed(keys)
+
+class MultiReader(CardReader):
+    '''
+    Reads from several card readers in one thread, waiting on all of their
+    file descriptors at once with `selectors` (epoll on Linux). Events are
+    yielded as soon as any reader completes them, tagged with that reader's
+    name. Readers epoll refuses to wait on, like stdin redirected from a
+    regular file, never block on a read and are read between waits instead.
+
+    If it was created from `configs`, `reconfigure()` changes the set of
+    readers while `events()` is running.
+    '''
+
+    def __init__(self, readers: List[CardReader], logger: Logger, configs: Optional[List[ReaderConfig]] = None):
+        self.readers = readers
+        self.logger = logger
+        self.configs = configs
+
+        # guards readers, configs and _closing
+        self._lock = threading.Lock()
+        # readers removed by reconfigure() that events() still has to close
+        self._closing: List[CardReader] = []
+        # written to by reconfigure() to wake events() from select()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+    def reconfigure(self, configs: List[ReaderConfig]) -> None:
+        '''
+        Switch to the readers for `configs`. Readers whose config did not
+        change are kept, with any partly read swipe. New readers are opened
+        before anything is switched, so if one raises CouldNotInitializeReader
+        the current readers stay in use.
+        '''
+        with self._lock:
+            if self.configs is None:
+                raise TypeError('MultiReader was not created from reader configs')
+            current = dict(zip(map(_config_key, self.configs), self.readers))
+            opened = []
             try:
-                (tv_sec, tv_usec, type, code, value) = struct.unpack(EVENT_FORMAT, event)
-            except Exception as e:
-                logger.warning("failed to read key event", exc_info=e)
-
-            if type == TY_KEY and value == VL_KEYDOWN:
-                # key was just pressed
-                # https://github.com/torvalds/linux/blob/v5.5-rc5/include/uapi/linux/input-event-codes.h#L39
-                if code < len(KEYS):
-                    # convert keycode to character
-                    buf += KEYS[code]
-                else:
-                    logger.warn(f"received out-of-bounds keycode {code} while reading rawkbd device")
-
-            if buf.endswith('\n'):
-                # entire line has been read, parse it and yield it.
-                yield _parse_reader_line(buf[0:-1])
-                buf = ''
-
-def get_cardreader(config: ReaderConfig, logger: Logger) -> CardReader:
+                for config in configs:
+                    if _config_key(config) not in current:
+                        opened.append((config, _get_single_cardreader(config, self.logger)))
+            except CouldNotInitializeReader:
+                for _, reader in opened:
+                    reader.close()
+                raise
+            opened = {_config_key(config): reader for config, reader in opened}
+
+            readers = [current.get(_config_key(config)) or opened[_config_key(config)] for config in configs]
+            self._closing.extend(reader for reader in self.readers if reader not in readers)
+            self.readers = readers
+            self.configs = configs
+
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # a wakeup is pending already
+            pass
+
+    def events(self) -> Iterator[ReaderEvent]:
+        logger = self.logger
+        registered = set()
+        # readers on regular files, whose reads do not block, read every turn
+        polled = set()
+        # readers that hit the end of their input, never registered again
+        finished = set()
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wake_r, selectors.EVENT_READ)
+
+            def update():
+                with self._lock:
+                    closing, self._closing = self._closing, []
+                    readers = list(self.readers)
+                for reader in closing:
+                    if reader in registered:
+                        selector.unregister(reader)
+                        registered.discard(reader)
+                    polled.discard(reader)
+                    logger.info(f"reader {reader.name} removed")
+                    reader.close()
+                for reader in readers:
+                    if reader not in registered and reader not in polled and reader not in finished:
+                        try:
+                            selector.register(reader, selectors.EVENT_READ)
+                        except OSError as e:
+                            if e.errno == errno.EPERM:
+                                # a regular file, which epoll refuses
+                                polled.add(reader)
+                                continue
+                            logger.error(f"reader {reader.name} can not be waited on, ignoring it", exc_info=e)
+                            finished.add(reader)
+                            continue
+                        registered.add(reader)
+
+            update()
+            while registered or polled:
+                for key, _ in selector.select(0 if polled else None):
+                    reader = key.fileobj
+                    if reader == self._wake_r:
+                        try:
+                            while os.read(self._wake_r, 64):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        update()
+                        # the other keys may belong to readers just removed
+                        break
+                    events = reader.read_events()
+                    if events is None:
+                        logger.info(f"reader {reader.name} closed")
+                        selector.unregister(reader)
+                        registered.discard(reader)
+                        finished.add(reader)
+                        continue
+                    yield from events
+                for reader in list(polled):
+                    events = reader.read_events()
+                    if events is None:
+                        logger.info(f"reader {reader.name} closed")
+                        polled.discard(reader)
+                        finished.add(reader)
+                        continue
+                    yield from events
+
+        logger.info("all readers closed: no more events from the card readers will be received")
+
+def _config_key(config: ReaderConfig) -> tuple:
+    return (config.name, config.mode, config.device)
+
+def _get_single_cardreader(config: ReaderConfig, logger: Logger) -> CardReader:
     if config.mode == "stdin":
-        return StdinReader(logger)
+        return StdinReader(logger, name=config.name)
     elif config.mode == "rawkbd":
-        return RawKbdReader(config.device, logger)
+        return RawKbdReader(config.device, logger, name=config.name)
     else:
         # unreachable
         return None
 
+def get_cardreader(configs: List[ReaderConfig], logger: Logger, reloadable: bool = False) -> CardReader:
+    '''
+    Create the card reader for the configured readers. With more than one
+    reader, or if `reloadable`, their events are multiplexed through a
+    MultiReader that can be reconfigured.
+    '''
+    readers = [_get_single_cardreader(config, logger) for config in configs]
+    if len(readers) == 1 and not reloadable:
+        return readers[0]
+    return MultiReader(readers, logger, configs)
+
 # RAW KBD INPUT TESTING CODE
 if __name__ == '__main__':
     import logging
@@ -197,7 +524,8 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     logger.addHandler(handler)
 
-    device = sys.argv[1]
-    reader = RawKbdReader(device, logger)
+    # pass several devices to test reading from all of them at once
+    readers = [RawKbdReader(device, logger, name=device) for device in sys.argv[1:]]
+    reader = readers[0] if len(readers) == 1 else MultiReader(readers, logger)
     for evt in reader.events():
         logger.info(f"EVENT: {evt}")
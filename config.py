@@ -1,6 +1,8 @@
-from typing import Union
+from typing import List, Union
 import os
 import configparser
+import ipaddress
+import socket
 import sys
 from dataclasses import dataclass
 
@@ -11,25 +13,161 @@ class Logging:
 
 @dataclass
 class Credentials:
-    host: str
+    # IPA servers (the replicas of one realm), from a comma separated list
+    hosts: List[str]
     verify_ssl: bool
     username: str
     password: str
 
+    @property
+    def host(self) -> str:
+        # for log messages
+        return ', '.join(self.hosts)
+
     def __repr__(self):
         # Custom repr to prevent accidentally printing the password
-        return f"Credentials(host={repr(self.host)}, verify_ssl={repr(self.verify_ssl)}, username={repr(self.username)}, password=*****)"
+        return f"Credentials(hosts={repr(self.hosts)}, verify_ssl={repr(self.verify_ssl)}, username={repr(self.username)}, password=*****)"
+
+@dataclass
+class Ipa:
+    # seconds to wait for IPA to answer a lookup
+    timeout: float
+    # seconds to wait for a connection to IPA
+    connect_timeout: float
+    # seconds to wait for IPA during a background sync, which fetches many accounts at once
+    sync_timeout: float
+    # times a request is retried after a connection error, timeout or server error
+    retries: int
+    # seconds before the first retry, doubled for every further one
+    retry_backoff: float
+    # seconds an IPA session is valid for (IPA's session_auth_duration), and how long
+    # before that it is renewed in the background
+    session_lifetime: float
+    refresh_margin: float
+    # seconds without requests after which the session is pinged to keep it and its
+    # connection alive. 0 disables
+    keepalive: float
+    # consecutive failed requests that open the circuit breaker, and seconds until it
+    # lets a request through again
+    breaker_failures: int
+    breaker_reset: float
+    # HTTP connections to each IPA server kept open for reuse
+    pool_size: int
+    # seconds after which a lookup still unanswered is also sent to the next
+    # fastest server, the first answer wins. 0 disables
+    hedge_after: float
 
 @dataclass
 class Access:
     # comma separated list of groups to grant access to
     allowed_groups: set()
+    # access policy file with per-door, scheduled rules, see policy.py. Optional,
+    # replaces allowed_groups if set
+    policy: os.PathLike = None
+
+@dataclass
+class Cache:
+    # seconds a cached account stays valid before it is looked up in IPA again
+    ttl: float
+    # maximum number of cached accounts, the least recently refreshed are evicted first
+    max_entries: int
+    # path to the on-disk copy of the cache. Optional, the cache is memory-only if unset
+    path: os.PathLike
+
+@dataclass
+class NegativeCache:
+    # seconds a card denied by an IPA lookup is denied again without a lookup. 0 disables
+    ttl: float
+    # maximum number of remembered denials, the oldest are evicted first
+    max_entries: int
+
+@dataclass
+class RateLimit:
+    # IPA lookups per second allowed for each reader. 0 (default) disables
+    reader_rate: float
+    # lookups a reader may make at once after being idle
+    reader_burst: float
+    # IPA lookups per second allowed for each card ID. 0 (default) disables
+    card_rate: float
+    # lookups of a card ID at once after being idle
+    card_burst: float
+
+@dataclass
+class Sync:
+    # seconds between background syncs of the access cache with IPA
+    interval: float
+    # every full_every-th sync re-fetches all accounts instead of only membership changes
+    full_every: int
+    # upper bound in seconds for the retry delay after failed syncs
+    max_backoff: float
+    # random spread applied to every delay, as a fraction of the delay
+    jitter: float
+
+@dataclass
+class Offline:
+    # Keep these two lists in sync
+    POLICIES = ['snapshot', 'open', 'closed']
+    # how swipes are decided while IPA is unreachable:
+    # snapshot: grant cards found in the snapshot, open: grant every card, closed: deny every card
+    policy: Union['snapshot', 'open', 'closed']
+    # path to the snapshot of authorized cards. Optional, required for policy=snapshot to grant anyone
+    snapshot: os.PathLike
+
+@dataclass
+class Writeback:
+    # file holding LCC updates not yet written to IPA. Optional, pending updates are lost on restart if unset
+    path: os.PathLike
+    # upper bound in seconds for the retry delay of failed LCC updates
+    max_backoff: float
+
+@dataclass
+class Pipeline:
+    # number of threads looking up swipes concurrently
+    workers: int
+    # maximum number of swipes being processed before the readers are paused
+    max_pending: int
+    # seconds during which repeat swipes of a card at the same reader reuse its decision. 0 disables
+    debounce: float
+
+@dataclass
+class Metrics:
+    # address the Prometheus metrics endpoint listens on
+    host: str
+    # port of the metrics endpoint. 0 disables it
+    port: int
+
+@dataclass
+class Audit:
+    # NDJSON file every access decision is appended to. Optional, no audit log if unset
+    path: os.PathLike
+    # SQLite database gatekeeper_audit.py and rotation ingest the audit log
+    # into. Defaults to the audit log path with .sqlite3 appended
+    db: os.PathLike
+    # secret mixed into the card ID hashes in the audit log
+    salt: str
+    # size in bytes after which the audit log is rotated
+    max_bytes: int
+    # seconds after which the audit log is rotated regardless of size. 0 disables
+    rotate_interval: float
+    # number of rotated audit logs to keep
+    backup_count: int
+    # seconds between writes of queued audit records
+    flush_interval: float
 
 @dataclass
 class Strike:
     # Make sure to keep these two lists in sync
     METHODS = ['fake', 'arduino', 'pi']
     method: Union['fake', 'arduino', 'pi']
+    # seconds the strike is held open after a grant
+    hold_time: float
+
+    # Arduino only: serial port to use instead of scanning all ports. Optional
+    arduino_port: str
+    # Arduino only: file remembering the USB port the Arduino was last found on. Optional
+    arduino_state: os.PathLike
+    # Arduino only: seconds between heartbeat queries
+    arduino_heartbeat: float
 
 @dataclass
 class Reader:
@@ -40,13 +178,125 @@ class Reader:
     # Path to keyboard device file. Required only when mode=rawkbd
     device: os.PathLike
 
+    # Name the reader's swipes are tagged with: 'default' for the [reader]
+    # section, NAME for a [reader:NAME] section
+    name: str = 'default'
+
+@dataclass
+class Remote:
+    # Keep these two lists in sync
+    ROLES = ['standalone', 'daemon', 'door']
+    # standalone: decide swipes in this process. daemon: decide the swipes of door
+    # nodes, no card readers or strike. door: send swipes to the daemon, see remote.py
+    role: Union['standalone', 'daemon', 'door']
+    # address the daemon listens on, host:port or unix:/path
+    listen: str
+    # address of the daemon a door node connects to, host:port or unix:/path
+    connect: str
+    # name the door node's [reader] section is reported to the daemon as. [reader:NAME]
+    # sections keep their name, which must be unique across all door nodes
+    door: str
+    # seconds a door node waits for a decision before deciding offline
+    timeout: float
+    # upper bound in seconds for the delay between attempts to reach the daemon
+    max_backoff: float
+    # shared secret authenticating the frames between door nodes and the daemon.
+    # Required unless the daemon is reached over a Unix socket or loopback
+    secret: str
+
+    def __repr__(self):
+        # Custom repr to prevent accidentally printing the secret
+        return f"Remote(role={repr(self.role)}, listen={repr(self.listen)}, connect={repr(self.connect)}, door={repr(self.door)}, timeout={repr(self.timeout)}, max_backoff={repr(self.max_backoff)}, secret=*****)"
+
+@dataclass
+class Replication:
+    # address replication listens on for peers, host:port. Optional, replication is off if unset
+    listen: str
+    # the other nodes, from a comma separated list of host:port
+    peers: List[str]
+    # name of this node, unique among the peers. The live node with the lowest name polls IPA
+    node: str
+    # shared secret authenticating the peers' messages
+    secret: str
+    # seconds between exchanges with every peer
+    interval: float
+    # seconds without hearing from a peer after which it counts as down
+    peer_timeout: float
+
+    def __repr__(self):
+        # Custom repr to prevent accidentally printing the secret
+        return f"Replication(listen={repr(self.listen)}, peers={repr(self.peers)}, node={repr(self.node)}, secret=*****, interval={repr(self.interval)}, peer_timeout={repr(self.peer_timeout)})"
+
+@dataclass
+class Diagnostics:
+    # seconds a swipe may spend in the reader loop, a lookup or acting on its decision
+    # before the stack of the thread handling it is logged. 0 disables
+    stall_threshold: float
+    # seconds a profile started by SIGUSR1 samples for
+    profile_seconds: float
+    # seconds between the samples of a profile
+    profile_interval: float
+    # directory SIGUSR1 profiles are written to. Optional, defaults to the log file's directory
+    profile_dir: os.PathLike
+    # whether the metrics endpoint also serves profiles at /debug/profile?seconds=N
+    profile_endpoint: bool
+
 @dataclass
 class Config:
     logging: Logging
     credentials: Credentials
+    ipa: Ipa
     access: Access
+    cache: Cache
+    negative_cache: NegativeCache
+    ratelimit: RateLimit
+    sync: Sync
+    offline: Offline
+    writeback: Writeback
+    pipeline: Pipeline
+    metrics: Metrics
+    audit: Audit
     strike: Strike
-    reader: Reader
+    # one entry per [reader] or [reader:NAME] section
+    readers: List[Reader]
+    remote: Remote
+    replication: Replication
+    diagnostics: Diagnostics
+
+def _is_local_address(address: str) -> bool:
+    '''
+    Whether `address` (unix:/path or host:port) can only be reached from this host.
+    '''
+    if address.startswith('unix:'):
+        return True
+    host = address.rpartition(':')[0].strip('[]')
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def _load_reader(cfg: configparser.ConfigParser, section: str) -> Reader:
+    reader_mode = cfg.get(section, 'mode')
+    if reader_mode not in Reader.MODES:
+        raise TypeError(f'Expected {section}.mode to be one of {Reader.MODES}')
+    reader_device = None
+    if reader_mode == 'rawkbd':
+        try:
+            reader_device = cfg.get(section, 'device')
+        except Exception:
+            raise Exception(f"Option 'device' in section '{section}' is missing. This setting is required because {section}.mode='rawkbd'")
+    return Reader(
+        mode=reader_mode,
+        device=reader_device,
+        name=section.partition(':')[2] or 'default'
+    )
+
+class ConfigError(Exception):
+    '''
+    Raised by parse_config when the config file cannot be read or is invalid.
+    '''
 
 def load_config(config_path: os.PathLike) -> Config:
     '''
@@ -56,57 +306,242 @@ def load_config(config_path: os.PathLike) -> Config:
     # NOTE: This method logs directly to stderr instead of using the proper
     # logger, because the logger is not available before the config is loaded.
 
+    try:
+        return parse_config(config_path)
+    except ConfigError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+
+def parse_config(config_path: os.PathLike) -> Config:
+    '''
+    Load and validate the config file. Raises ConfigError if the config is
+    invalid, which lets a running GateKeeper keep its current config.
+    '''
+
     try:
         cfg = configparser.ConfigParser()
-        cfg.read(config_path)
+        if not cfg.read(config_path):
+            raise FileNotFoundError(f"No such file: {config_path}")
     except Exception as e:
-        print(f"Failed to load config file from {config_path}: {e}", file=sys.stderr)
-        exit(1)
+        raise ConfigError(f"Failed to load config file from {config_path}: {e}")
 
     try:
         logging = Logging(log=cfg.get("logging", "log"))
 
+        remote_role = cfg.get('remote', 'role', fallback='standalone')
+        if remote_role not in Remote.ROLES:
+            raise TypeError(f'Expected remote.role to be one of {Remote.ROLES}')
+        remote = Remote(
+            role=remote_role,
+            listen=cfg.get('remote', 'listen', fallback='127.0.0.1:7300'),
+            connect=cfg.get('remote', 'connect', fallback=None),
+            door=cfg.get('remote', 'door', fallback=socket.gethostname()),
+            timeout=cfg.getfloat('remote', 'timeout', fallback=5.0),
+            max_backoff=cfg.getfloat('remote', 'max_backoff', fallback=30.0),
+            secret=cfg.get('remote', 'secret', fallback='')
+        )
+        if remote.role == 'door' and not remote.connect:
+            raise TypeError("Expected remote.connect to be set because remote.role='door'")
+        if remote.secret and len(remote.secret) < 16:
+            raise TypeError('Expected remote.secret to be at least 16 characters')
+        remote_address = {'daemon': remote.listen, 'door': remote.connect}.get(remote.role)
+        if remote_address and not remote.secret and not _is_local_address(remote_address):
+            raise TypeError(f"Expected remote.secret to be set because {remote_address} is neither a unix: socket nor loopback")
+        if remote.timeout <= 0 or remote.max_backoff <= 0:
+            raise TypeError('Expected remote.timeout and remote.max_backoff to be positive')
+        # door nodes never talk to IPA, the daemon does, so these are optional for them
+        is_door = remote.role == 'door'
+        door_optional = {'fallback': ''} if is_door else {}
+
         credentials = Credentials(
-            host=cfg.get('credentials', 'host'),
-            verify_ssl=cfg.getboolean('credentials', 'verify_ssl'),
-            username=cfg.get('credentials', 'username'),
-            password=cfg.get('credentials', 'password')
+            hosts=[host.strip() for host in cfg.get('credentials', 'host', **door_optional).split(',') if host.strip()],
+            verify_ssl=cfg.getboolean('credentials', 'verify_ssl', **({'fallback': True} if is_door else {})),
+            username=cfg.get('credentials', 'username', **door_optional),
+            password=cfg.get('credentials', 'password', **door_optional)
         )
+        if not credentials.hosts and not is_door:
+            raise TypeError('Expected credentials.host to list at least one IPA server')
+
+        ipa = Ipa(
+            timeout=cfg.getfloat('ipa', 'timeout', fallback=3.0),
+            connect_timeout=cfg.getfloat('ipa', 'connect_timeout', fallback=2.0),
+            sync_timeout=cfg.getfloat('ipa', 'sync_timeout', fallback=120.0),
+            retries=cfg.getint('ipa', 'retries', fallback=1),
+            retry_backoff=cfg.getfloat('ipa', 'retry_backoff', fallback=0.1),
+            session_lifetime=cfg.getfloat('ipa', 'session_lifetime', fallback=1200.0),
+            refresh_margin=cfg.getfloat('ipa', 'refresh_margin', fallback=120.0),
+            keepalive=cfg.getfloat('ipa', 'keepalive', fallback=60.0),
+            breaker_failures=cfg.getint('ipa', 'breaker_failures', fallback=5),
+            breaker_reset=cfg.getfloat('ipa', 'breaker_reset', fallback=30.0),
+            pool_size=cfg.getint('ipa', 'pool_size', fallback=8),
+            hedge_after=cfg.getfloat('ipa', 'hedge_after', fallback=0.0)
+        )
+        if ipa.timeout <= 0 or ipa.connect_timeout <= 0 or ipa.sync_timeout <= 0:
+            raise TypeError('Expected ipa.timeout, ipa.connect_timeout and ipa.sync_timeout to be positive')
+        if ipa.retries < 0 or ipa.retry_backoff < 0 or ipa.keepalive < 0 or ipa.hedge_after < 0:
+            raise TypeError('Expected ipa.retries, ipa.retry_backoff, ipa.keepalive and ipa.hedge_after not to be negative')
+        if not 0 <= ipa.refresh_margin < ipa.session_lifetime:
+            raise TypeError('Expected ipa.refresh_margin to be less than ipa.session_lifetime')
+        if ipa.breaker_failures <= 0 or ipa.breaker_reset <= 0 or ipa.pool_size <= 0:
+            raise TypeError('Expected ipa.breaker_failures, ipa.breaker_reset and ipa.pool_size to be positive')
 
         access = Access(
-            allowed_groups=set(cfg.get('access', 'allowed_groups').split(','))
+            allowed_groups=set(cfg.get('access', 'allowed_groups', **door_optional).split(',')),
+            policy=cfg.get('access', 'policy', fallback=None)
         )
 
-        strike_method = cfg.get('strike', 'method')
+        cache = Cache(
+            ttl=cfg.getfloat('cache', 'ttl', fallback=3600.0),
+            max_entries=cfg.getint('cache', 'max_entries', fallback=10000),
+            path=cfg.get('cache', 'path', fallback=None)
+        )
+        if cache.ttl <= 0 or cache.max_entries <= 0:
+            raise TypeError('Expected cache.ttl and cache.max_entries to be positive')
+
+        negative_cache = NegativeCache(
+            ttl=cfg.getfloat('negative_cache', 'ttl', fallback=60.0),
+            max_entries=cfg.getint('negative_cache', 'max_entries', fallback=10000)
+        )
+        if negative_cache.ttl < 0 or negative_cache.max_entries <= 0:
+            raise TypeError('Expected negative_cache.ttl not to be negative and negative_cache.max_entries to be positive')
+
+        ratelimit = RateLimit(
+            reader_rate=cfg.getfloat('ratelimit', 'reader_rate', fallback=0.0),
+            reader_burst=cfg.getfloat('ratelimit', 'reader_burst', fallback=20.0),
+            card_rate=cfg.getfloat('ratelimit', 'card_rate', fallback=0.0),
+            card_burst=cfg.getfloat('ratelimit', 'card_burst', fallback=5.0)
+        )
+        if ratelimit.reader_rate < 0 or ratelimit.card_rate < 0:
+            raise TypeError('Expected ratelimit.reader_rate and ratelimit.card_rate not to be negative')
+        if ratelimit.reader_burst < 1 or ratelimit.card_burst < 1:
+            raise TypeError('Expected ratelimit.reader_burst and ratelimit.card_burst to be at least 1')
+
+        sync = Sync(
+            interval=cfg.getfloat('sync', 'interval', fallback=300.0),
+            full_every=cfg.getint('sync', 'full_every', fallback=12),
+            max_backoff=cfg.getfloat('sync', 'max_backoff', fallback=600.0),
+            jitter=cfg.getfloat('sync', 'jitter', fallback=0.1)
+        )
+        if sync.interval <= 0 or sync.full_every <= 0 or sync.max_backoff <= 0:
+            raise TypeError('Expected sync.interval, sync.full_every and sync.max_backoff to be positive')
+        if not 0 <= sync.jitter < 1:
+            raise TypeError('Expected sync.jitter to be between 0 and 1')
+
+        offline_policy = cfg.get('offline', 'policy', fallback='snapshot')
+        if offline_policy not in Offline.POLICIES:
+            raise TypeError(f'Expected offline.policy to be one of {Offline.POLICIES}')
+        offline = Offline(
+            policy=offline_policy,
+            snapshot=cfg.get('offline', 'snapshot', fallback=None)
+        )
+
+        writeback = Writeback(
+            path=cfg.get('writeback', 'path', fallback=None),
+            max_backoff=cfg.getfloat('writeback', 'max_backoff', fallback=300.0)
+        )
+        if writeback.max_backoff <= 0:
+            raise TypeError('Expected writeback.max_backoff to be positive')
+
+        pipeline = Pipeline(
+            workers=cfg.getint('pipeline', 'workers', fallback=4),
+            max_pending=cfg.getint('pipeline', 'max_pending', fallback=32),
+            debounce=cfg.getfloat('pipeline', 'debounce', fallback=3.0)
+        )
+        if pipeline.workers <= 0 or pipeline.max_pending <= 0:
+            raise TypeError('Expected pipeline.workers and pipeline.max_pending to be positive')
+        if pipeline.debounce < 0:
+            raise TypeError('Expected pipeline.debounce not to be negative')
+
+        metrics = Metrics(
+            host=cfg.get('metrics', 'host', fallback='127.0.0.1'),
+            port=cfg.getint('metrics', 'port', fallback=0)
+        )
+
+        audit = Audit(
+            path=cfg.get('audit', 'path', fallback=None),
+            db=cfg.get('audit', 'db', fallback=None),
+            salt=cfg.get('audit', 'salt', fallback=''),
+            max_bytes=cfg.getint('audit', 'max_bytes', fallback=10 * 1024 * 1024),
+            rotate_interval=cfg.getfloat('audit', 'rotate_interval', fallback=86400.0),
+            backup_count=cfg.getint('audit', 'backup_count', fallback=30),
+            flush_interval=cfg.getfloat('audit', 'flush_interval', fallback=1.0)
+        )
+        if audit.max_bytes <= 0 or audit.flush_interval <= 0:
+            raise TypeError('Expected audit.max_bytes and audit.flush_interval to be positive')
+        if audit.rotate_interval < 0 or audit.backup_count < 0:
+            raise TypeError('Expected audit.rotate_interval and audit.backup_count not to be negative')
+        if audit.path and not audit.db:
+            audit.db = f"{audit.path}.sqlite3"
+
+        # the daemon has no strike, door nodes act on its decisions
+        strike_method = cfg.get('strike', 'method', **({'fallback': 'fake'} if remote.role == 'daemon' else {}))
         if strike_method not in Strike.METHODS:
             raise TypeError(f'Expected strike.method to be one of {Strike.METHODS}')
         strike = Strike(
-            method=strike_method
+            method=strike_method,
+            hold_time=cfg.getfloat('strike', 'hold_time', fallback=5.0),
+            arduino_port=cfg.get('strike', 'arduino_port', fallback=None),
+            arduino_state=cfg.get('strike', 'arduino_state', fallback=None),
+            arduino_heartbeat=cfg.getfloat('strike', 'arduino_heartbeat', fallback=30.0)
         )
+        if strike.hold_time <= 0 or strike.arduino_heartbeat <= 0:
+            raise TypeError('Expected strike.hold_time and strike.arduino_heartbeat to be positive')
 
-        reader_mode = cfg.get('reader', 'mode')
-        if reader_mode not in Reader.MODES:
-            raise TypeError(f'Expected reader.mode to be one of {Reader.MODES}')
-        reader_device = None
-        if reader_mode == 'rawkbd':
-            try:
-                reader_device = cfg.get('reader', 'device')
-            except Exception:
-                raise Exception("Option 'device' in section 'reader' is missing. This setting is required because reader.mode='rawkbd'")
-        reader = Reader(
-            mode=reader_mode,
-            device=reader_device
+        reader_sections = [section for section in cfg.sections() if section == 'reader' or section.startswith('reader:')]
+        if not reader_sections and remote.role != 'daemon':
+            raise Exception("At least one [reader] or [reader:NAME] section is required")
+        readers = [_load_reader(cfg, section) for section in reader_sections]
+        if sum(reader.mode == 'stdin' for reader in readers) > 1:
+            raise TypeError("Only one reader may use mode='stdin'")
+
+        replication = Replication(
+            listen=cfg.get('replication', 'listen', fallback=None),
+            peers=[peer.strip() for peer in cfg.get('replication', 'peers', fallback='').split(',') if peer.strip()],
+            node=cfg.get('replication', 'node', fallback=socket.gethostname()),
+            secret=cfg.get('replication', 'secret', fallback=''),
+            interval=cfg.getfloat('replication', 'interval', fallback=5.0),
+            peer_timeout=cfg.getfloat('replication', 'peer_timeout', fallback=15.0)
+        )
+        if replication.listen and remote.role == 'door':
+            raise TypeError("Door nodes have no access cache to replicate, remove [replication] or change remote.role")
+        if replication.listen and len(replication.secret) < 16:
+            raise TypeError('Expected replication.secret to be at least 16 characters because replication.listen is set')
+        if replication.interval <= 0 or replication.peer_timeout <= replication.interval:
+            raise TypeError('Expected replication.interval to be positive and less than replication.peer_timeout')
+
+        diagnostics = Diagnostics(
+            stall_threshold=cfg.getfloat('diagnostics', 'stall_threshold', fallback=2.0),
+            profile_seconds=cfg.getfloat('diagnostics', 'profile_seconds', fallback=30.0),
+            profile_interval=cfg.getfloat('diagnostics', 'profile_interval', fallback=0.005),
+            profile_dir=cfg.get('diagnostics', 'profile_dir', fallback=os.path.dirname(os.path.abspath(logging.log))),
+            profile_endpoint=cfg.getboolean('diagnostics', 'profile_endpoint', fallback=False)
         )
+        if diagnostics.stall_threshold < 0:
+            raise TypeError('Expected diagnostics.stall_threshold not to be negative')
+        if diagnostics.profile_interval <= 0 or diagnostics.profile_seconds <= diagnostics.profile_interval:
+            raise TypeError('Expected diagnostics.profile_interval to be positive and less than diagnostics.profile_seconds')
 
         config = Config(
             logging=logging,
             credentials=credentials,
+            ipa=ipa,
             access=access,
+            cache=cache,
+            negative_cache=negative_cache,
+            ratelimit=ratelimit,
+            sync=sync,
+            offline=offline,
+            writeback=writeback,
+            pipeline=pipeline,
+            metrics=metrics,
+            audit=audit,
             strike=strike,
-            reader=reader,
+            readers=readers,
+            remote=remote,
+            replication=replication,
+            diagnostics=diagnostics,
         )
     except Exception as e:
-        print(f"Error in config file {config_path}: {e}", file=sys.stderr)
-        exit(1)
+        raise ConfigError(f"Error in config file {config_path}: {e}")
 
     return config
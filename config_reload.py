@@ -0,0 +1,131 @@
+from typing import Callable, List
+from dataclasses import fields
+from config import Config, ConfigError, parse_config
+import logging
+import os
+import threading
+
+'''
+Module for applying config changes to a running GateKeeper.
+
+`ConfigReloader` watches the config file for changes and also reloads it on
+request, which main.py wires to SIGHUP. A new config is parsed and validated
+completely before anything is changed; an invalid one is logged and the
+current config stays in effect. A valid one is handed to an `apply` callback
+together with the old one, which rebuilds only the components whose sections
+changed (see `changed_sections`). If `apply` raises, the reload counts as
+failed and the next change of the file is tried again from the old config.
+If some sections took effect before it failed, `apply` raises
+ConfigPartlyApplied, and the next reload is compared against the config
+actually in effect, so the sections that failed are applied again.
+'''
+
+def changed_sections(old: Config, new: Config) -> List[str]:
+    '''
+    Names of the Config fields (config file sections) that differ.
+    '''
+    return [f.name for f in fields(Config) if getattr(old, f.name) != getattr(new, f.name)]
+
+class ConfigPartlyApplied(Exception):
+    '''
+    Raised by an `apply` callback that failed after some sections took
+    effect. `config` has the new values of those and the old values of the
+    rest.
+    '''
+
+    def __init__(self, config: Config) -> None:
+        super().__init__('Config only partly applied')
+        self.config = config
+
+class ConfigReloader(threading.Thread):
+    '''
+    Polls the config file's mtime every `check_interval` seconds and reloads
+    it when it changes or when `request()` is called.
+    '''
+
+    def __init__(self, logger: logging.Logger, path: os.PathLike, config: Config, apply: Callable[[Config, Config], None], check_interval: float = 5.0) -> None:
+        super().__init__(name='config-reload', daemon=True)
+        self.logger = logger
+        self.path = path
+        self.config = config
+        self.apply = apply
+        self.check_interval = check_interval
+
+        self._stop_event = threading.Event()
+        self._requested = threading.Event()
+        try:
+            self._mtime = os.stat(path).st_mtime
+        except OSError:
+            self._mtime = None
+
+        self.reloads = 0
+        self.reload_failures = 0
+
+    def request(self) -> None:
+        '''
+        Reload the config as soon as possible. Only sets a flag, so it is safe
+        to call from a signal handler.
+        '''
+        self._requested.set()
+
+    def reload(self) -> bool:
+        '''
+        Parse the config file and apply it if it changed. Returns False if it
+        is invalid or could not be applied.
+        '''
+        try:
+            self._mtime = os.stat(self.path).st_mtime
+            new = parse_config(self.path)
+        except (OSError, ConfigError) as e:
+            self.reload_failures += 1
+            self.logger.error(f"Keeping the current config, the new one is invalid: {e}")
+            return False
+
+        old = self.config
+        changed = changed_sections(old, new)
+        if not changed:
+            self.logger.info(f"Config file {self.path} reloaded, nothing changed")
+            return True
+
+        self.logger.info(f"Config file {self.path} changed, applying sections: {', '.join(changed)}")
+        try:
+            self.apply(old, new)
+        except ConfigPartlyApplied as e:
+            self.config = e.config
+            self.reload_failures += 1
+            self.logger.error(f"Applying the new config failed, sections not applied: {', '.join(changed_sections(e.config, new))}", exc_info=e.__cause__)
+            return False
+        except Exception as e:
+            self.reload_failures += 1
+            self.logger.error("Keeping the current config, applying the new one failed", exc_info=e)
+            return False
+
+        self.config = new
+        self.reloads += 1
+        return True
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._requested.set()
+
+    def run(self) -> None:
+        while True:
+            requested = self._requested.wait(self.check_interval)
+            if self._stop_event.is_set():
+                return
+            self._requested.clear()
+
+            if not requested:
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                except OSError:
+                    continue
+                if mtime == self._mtime:
+                    continue
+            self.reload()
+
+    def stats(self) -> dict:
+        return {
+            'reloads': self.reloads,
+            'reload_failures': self.reload_failures,
+        }
@@ -0,0 +1,126 @@
+from typing import Optional
+from dataclasses import dataclass
+from access_cache import AccessCache
+from snapshot import AccessSnapshot
+from ipa_sync import SyncWorker
+from lcc_writeback import LCCWriteback
+from cardreader import SwipeEvent
+from config import Config
+from utils import Utils
+from metrics import Metrics
+from ratelimit import NegativeCache, RateLimiter
+from policy import PolicyEngine
+import logging
+import time
+
+'''
+Module for deciding whether a swipe opens the door.
+
+A swipe is answered from the access cache if possible, then by looking the
+account up in IPA, and if IPA is unreachable by the offline policy.
+
+Before a swipe the cache can not answer is looked up in IPA, recent denials
+of the card are checked in the negative cache and the reader's and card's
+rate limits are applied. Cards the offline snapshot authorizes skip both, so
+they are never turned away before IPA or the offline policy had a say.
+'''
+
+@dataclass
+class Decision:
+    '''
+    Outcome of a swipe.
+    '''
+    granted: bool
+    # netid of the matched account. None if the swipe was decided offline or
+    # did not match an account
+    netid: Optional[str] = None
+    # 'account' if decided from the IPA account (live or cached), 'offline' if
+    # decided by the offline policy, 'error' if the lookup itself crashed,
+    # 'duplicate' if repeated from an earlier swipe of the card, 'negative' if
+    # repeated from a recent denial, 'limited' if denied by a rate limit
+    source: str = 'account'
+    # why, e.g. 'allowed', 'old_lcc', 'not_in_allowed_group' or 'offline_snapshot'
+    reason: Optional[str] = None
+    # seconds spent in Decider.decide(), set once decided
+    lookup_seconds: Optional[float] = None
+
+class Decider:
+    '''
+    Decides swipes. Safe to call from several lookup threads at once.
+    '''
+
+    def __init__(self, logger: logging.Logger, config: Config, cache: AccessCache, snapshot: AccessSnapshot, sync: SyncWorker, writeback: Optional[LCCWriteback] = None, metrics: Optional[Metrics] = None,
+                 negative_cache: Optional[NegativeCache] = None, reader_limiter: Optional[RateLimiter] = None, card_limiter: Optional[RateLimiter] = None, policy: Optional[PolicyEngine] = None) -> None:
+        self.logger = logger
+        self.config = config
+        self.cache = cache
+        self.snapshot = snapshot
+        self.writeback = writeback
+        self.metrics = metrics or Metrics()
+        self.negative_cache = negative_cache
+        # token buckets per reader name and per card ID for IPA lookups
+        self.reader_limiter = reader_limiter
+        self.card_limiter = card_limiter
+        # None to allow access.allowed_groups at every door
+        self.policy = policy
+        # owns the IPA session shared with the sync thread
+        self.sync = sync
+
+
+    def decide(self, evt: SwipeEvent) -> Decision:
+        start = time.perf_counter()
+        decision = self._decide(evt)
+        decision.lookup_seconds = time.perf_counter() - start
+        self.metrics.lookup_seconds.observe(decision.lookup_seconds)
+        return decision
+
+    def _decide(self, evt: SwipeEvent) -> Decision:
+        id, lcc = evt.id, evt.lcc
+        logger, config, cache = self.logger, self.config, self.cache
+
+        if cache is None or not cache.contains(id):
+            # this swipe would cost an IPA lookup
+            denied = self._deny_without_lookup(evt)
+            if denied is not None:
+                return denied
+
+        # the policy in effect when the swipe is decided, even if it is reloaded meanwhile
+        policy = self.policy.policy if self.policy is not None else None
+
+        # None until the first login; sessions are renewed in the background,
+        # so a failed lookup is decided offline instead of waiting on a login
+        client = self.sync.client
+        account = Utils.get_account_from_ipa(id, lcc, logger, client, config, cache, self.writeback, policy, evt.reader)
+
+        if account:
+            # a denial outside a rule's hours may be a grant a minute later
+            if not account.has_access and account.entry is None and self.negative_cache is not None and account.reason != 'no_matching_rule':
+                self.negative_cache.put(id, lcc, account.reason)
+            return Decision(granted=account.has_access, netid=getattr(account, 'netid', None), reason=account.reason)
+
+        granted = Utils.decide_offline(id, lcc, logger, config, self.snapshot)
+        return Decision(granted=granted, source='offline', reason=f"offline_{config.offline.policy}")
+
+    def _deny_without_lookup(self, evt: SwipeEvent) -> Optional[Decision]:
+        '''
+        A denial if the card was denied recently or a rate limit is exceeded,
+        otherwise None.
+        '''
+        if self.snapshot is not None and self.snapshot.allows(evt.id, evt.lcc):
+            # the limits protect IPA from unknown cards; during an outage this
+            # one is granted by the offline snapshot
+            return None
+
+        if self.negative_cache is not None:
+            reason = self.negative_cache.get(evt.id, evt.lcc)
+            if reason is not None:
+                self.logger.info(f"ID: {evt.id} LCC: {evt.lcc} was denied recently ({reason}), not looking it up again")
+                return Decision(granted=False, source='negative', reason=reason)
+
+        if self.reader_limiter is not None and not self.reader_limiter.allow(evt.reader):
+            self.logger.warning(f"Too many lookups from reader {evt.reader}, denying ID: {evt.id} without a lookup")
+            return Decision(granted=False, source='limited', reason='reader_rate_limited')
+        if self.card_limiter is not None and not self.card_limiter.allow(evt.id):
+            self.logger.warning(f"Too many lookups of ID: {evt.id}, denying it without a lookup")
+            return Decision(granted=False, source='limited', reason='card_rate_limited')
+        return None
@@ -0,0 +1,205 @@
+from typing import Dict, Optional, Tuple
+from contextlib import contextmanager
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+import traceback
+
+'''
+Module for finding out where a slow swipe spent its time.
+
+StallWatchdog: the reader loop, the lookups and the code acting on decisions
+mark what they are doing with `busy(label)`. A background thread checks the
+marks every fraction of `stall_threshold`; once one is older than the
+threshold, the stack of the thread holding it is logged, and once it is done
+how long it took. The stack says whether the time goes to the strike's
+sleep, an IPA request, a serial write or the log. Marking costs a few
+microseconds, and while no swipe is handled the thread only wakes up to find
+nothing marked.
+
+SamplingProfiler: takes the stacks of all threads every `interval` seconds
+for a while and counts them, in the folded format flamegraph.pl and
+speedscope read:
+
+    MainThread;serve (main.py:139);events (cardreader.py:128) 1520
+
+Samples are wall-clock: a thread waiting on IPA or sleeping shows up as much
+as one using the CPU, which is what matters for a slow swipe. Nothing runs
+while no profile is being taken. Profiles are started by SIGUSR1 (see main.py)
+or requested from the metrics endpoint.
+'''
+
+class StallWatchdog(threading.Thread):
+    '''
+    Logs the stack of a thread that stays `busy()` for longer than
+    `threshold` seconds. A threshold of 0 disables the checks; it may be
+    changed while running.
+    '''
+
+    def __init__(self, logger: logging.Logger, threshold: float) -> None:
+        super().__init__(name='watchdog', daemon=True)
+        self.logger = logger
+        self.threshold = threshold
+
+        # thread ident -> (label, time.monotonic() it became busy)
+        self._busy: Dict[int, Tuple[str, float]] = {}
+        # thread ident -> start of the busy mark whose stall was logged
+        self._reported: Dict[int, float] = {}
+        self._stop_event = threading.Event()
+
+        self.stalls = 0
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    @contextmanager
+    def busy(self, label: str):
+        '''
+        Marks the current thread as busy with `label` until the block ends.
+        Nested marks keep the outer one's start, the thread is busy with
+        that all along.
+        '''
+        ident = threading.get_ident()
+        outer = self._busy.get(ident)
+        started = time.monotonic()
+        if outer is None:
+            self._busy[ident] = (label, started)
+        try:
+            yield
+        finally:
+            if outer is None:
+                del self._busy[ident]
+                if self._reported.pop(ident, None) == started:
+                    self.logger.warning(f"{label} finished after {time.monotonic() - started:.1f}s")
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            threshold = self.threshold
+            if threshold:
+                self._check(threshold)
+            # a stall is logged at most a quarter threshold late
+            self._stop_event.wait(min(max(threshold / 4, 0.05), 1.0) if threshold else 1.0)
+
+    def _check(self, threshold: float) -> None:
+        now = time.monotonic()
+        frames = None
+        for ident, (label, started) in list(self._busy.items()):
+            if now - started < threshold or self._reported.get(ident) == started:
+                continue
+            if frames is None:
+                frames = sys._current_frames()
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            self._reported[ident] = started
+            self.stalls += 1
+            stack = ''.join(traceback.format_stack(frame))
+            self.logger.warning(f"{label} has not finished after {now - started:.1f}s, thread {names.get(ident, ident)} is at:\n{stack.rstrip()}")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        busy = list(self._busy.values())
+        return {
+            'stalls': self.stalls,
+            'busy': len(busy),
+            'longest_busy_seconds': max((now - started for _, started in busy), default=0.0),
+        }
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of all threads, one profile at a time.
+    '''
+
+    def __init__(self, logger: logging.Logger, interval: float, seconds: float, directory: Optional[os.PathLike] = None) -> None:
+        self.logger = logger
+        self.interval = interval
+        # default length of a profile, and where `profile_to_file` writes
+        self.seconds = seconds
+        self.directory = directory
+
+        self._running = threading.Lock()
+        # code object -> frame label
+        self._labels: Dict[object, str] = {}
+
+        self.profiles = 0
+        self.samples = 0
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def profile(self, seconds: Optional[float] = None) -> Optional[Dict[str, int]]:
+        '''
+        Sample for `seconds` (default: `self.seconds`) on the calling thread
+        and return the count of every folded stack. Returns None if another
+        profile is being taken.
+        '''
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            seconds = self.seconds if seconds is None else seconds
+            interval = self.interval
+            own = threading.get_ident()
+            counts: Dict[str, int] = {}
+            samples = 0
+            self.logger.info(f"Profiling for {seconds:g}s, sampling every {interval * 1000:g}ms")
+
+            deadline = time.monotonic() + seconds
+            next_sample = time.monotonic()
+            while next_sample < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)).replace(';', ':'))
+                    key = ';'.join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+                samples += 1
+                next_sample += interval
+                time.sleep(max(0.0, next_sample - time.monotonic()))
+
+            self.profiles += 1
+            self.samples += samples
+            return counts
+        finally:
+            self._running.release()
+
+    def profile_to_file(self, seconds: Optional[float] = None) -> None:
+        '''
+        Take a profile in the background and write it to `self.directory`.
+        '''
+        def run():
+            counts = self.profile(seconds)
+            if counts is None:
+                self.logger.warning("A profile is already being taken, not starting another")
+                return
+            try:
+                pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+                path = os.path.join(self.directory, time.strftime('gatekeeper-%Y%m%d-%H%M%S.folded'))
+                with open(path, 'w') as f:
+                    f.write(format_folded(counts))
+                self.logger.info(f"Wrote profile of {sum(counts.values())} stacks to {path}")
+            except OSError as e:
+                self.logger.error(f"Unable to write profile to {self.directory}", exc_info=e)
+
+        threading.Thread(target=run, name='profiler', daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            'profiles': self.profiles,
+            'samples': self.samples,
+        }
+
+def format_folded(counts: Dict[str, int]) -> str:
+    return ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
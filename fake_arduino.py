@@ -0,0 +1,127 @@
+from typing import List
+import argparse
+import logging
+import os
+import select
+import sys
+import threading
+import time
+
+'''
+Pseudo-terminal stand-in for the strike's Arduino, for testing ArduinoStrike
+and ArduinoConnection without hardware.
+
+It answers the same serial protocol as arduino_strike.ino: `Q` is answered
+with `Arduino_Online`, `1` opens the strike and `0` closes it. Point
+strike.arduino_port at the printed device to use it with GateKeeper.
+
+Usage:
+
+    python3 fake_arduino.py             # serve until CTRL-C
+    python3 fake_arduino.py --selftest  # check connect, heartbeat and reconnect
+'''
+
+class FakeArduino:
+    '''
+    Serves the Arduino serial protocol on a new pty from a background thread.
+    '''
+
+    def __init__(self) -> None:
+        self._master, self._slave = os.openpty()
+        # path to open with pyserial
+        self.device = os.ttyname(self._slave)
+
+        # set to False to stop answering heartbeats, like an unplugged Arduino
+        self.online = True
+        # time.monotonic() of every '1' received
+        self.strikes: List[float] = []
+        self.is_open = False
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name='fake-arduino', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self) -> None:
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 64)
+            except OSError:
+                continue
+
+            for byte in data:
+                char = chr(byte)
+                if not self.online:
+                    continue
+                if char == '1':
+                    self.strikes.append(time.monotonic())
+                    self.is_open = True
+                    os.write(self._master, b'striking...\n\r\n')
+                elif char == '0':
+                    self.is_open = False
+                elif char == 'Q':
+                    os.write(self._master, b'Arduino_Online\r\n')
+
+def _wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def selftest(logger: logging.Logger) -> bool:
+    from arduino import ArduinoConnection
+
+    fake = FakeArduino()
+    conn = ArduinoConnection(logger, port=fake.device, heartbeat=0.2, reset_delay=0)
+
+    start = time.monotonic()
+    conn.start()
+    ok = _wait_for(lambda: conn.connected, 5)
+    logger.info(f"connect: {ok} after {(time.monotonic() - start) * 1000:.0f}ms")
+
+    ok = ok and conn.write(b'1') and _wait_for(lambda: len(fake.strikes) == 1, 1)
+    logger.info(f"strike received: {ok}")
+
+    fake.online = False
+    ok = ok and _wait_for(lambda: not conn.connected, 5)
+    logger.info(f"heartbeat noticed the Arduino going away: {ok}")
+
+    fake.online = True
+    start = time.monotonic()
+    ok = ok and _wait_for(lambda: conn.connected, 10)
+    logger.info(f"reconnect: {ok} after {(time.monotonic() - start) * 1000:.0f}ms")
+
+    conn.stop()
+    fake.close()
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake Arduino strike on a pseudo-terminal.")
+    parser.add_argument('--selftest', action='store_true', help='Run ArduinoConnection against the fake and exit.')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('fake_arduino')
+    handler = logging.StreamHandler(stream=sys.stdout)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    if args.selftest:
+        sys.exit(0 if selftest(logger) else 1)
+
+    fake = FakeArduino()
+    logger.info(f"Fake Arduino listening on {fake.device}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.close()
@@ -0,0 +1,309 @@
+from typing import Callable, Iterator, List, Optional, Tuple
+from audit import ROTATED_SUFFIX, hash_card_id
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+'''
+gatekeeper-audit: query the history of access decisions.
+
+Decisions are ingested from the audit log written by `audit.AuditLog` (and
+from its rotated files) into an SQLite database indexed by time, netid, card
+hash and decision, so queries take milliseconds no matter how much history
+the database holds. Ingestion is incremental: the byte offset reached in
+every file is remembered per inode, which survives rotation, and every query
+first picks up whatever was appended since the last one. The first bytes of
+each file are remembered too, to tell a new file that reused a deleted
+one's inode. AuditLog also ingests its rotated files before deleting old
+ones.
+
+Text logs from before the audit log existed can be imported once with
+`import-log`. Their card IDs are hashed like the audit log's.
+
+    python3 gatekeeper_audit.py query --since 2024-05-01 --until 2024-06-01 --hours 2-4 --decision granted
+    python3 gatekeeper_audit.py query --netid abc1234 --limit 20
+    python3 gatekeeper_audit.py query --card 12345678 --json
+    python3 gatekeeper_audit.py import-log /var/log/gatekeeper/debug.log*
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS decisions (
+    ts REAL NOT NULL,
+    card TEXT,
+    netid TEXT,
+    reader TEXT,
+    granted INTEGER NOT NULL,
+    reason TEXT,
+    source TEXT,
+    ms TEXT
+);
+CREATE INDEX IF NOT EXISTS decisions_ts ON decisions (ts);
+CREATE INDEX IF NOT EXISTS decisions_netid ON decisions (netid, ts);
+CREATE INDEX IF NOT EXISTS decisions_card ON decisions (card, ts);
+CREATE INDEX IF NOT EXISTS decisions_granted ON decisions (granted, ts);
+CREATE TABLE IF NOT EXISTS ingested (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    head BLOB,
+    PRIMARY KEY (dev, ino)
+);
+'''
+
+# bytes from the start of a file compared to tell whether it is the same file
+HEAD_BYTES = 256
+
+ROW = Tuple[float, Optional[str], Optional[str], Optional[str], int, Optional[str], Optional[str], Optional[str]]
+
+# decisions as logged by main.py, from the first version on:
+#   [2024-05-01 02:13:04] INFO     Access granted to abc1234 at reader default
+#   [2024-05-01 02:13:04] INFO     Access granted to ID: 12345678 at reader default
+#   [2024-05-01 02:13:04] INFO     Denied access to ID: 12345678 LCC: 01
+TEXT_LOG_LINE = re.compile(
+    r'^\[(?P<time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\] INFO +'
+    r'(?:Access granted to (?:ID: (?P<granted_id>\S*)|(?P<netid>\S+))|Denied access to ID: (?P<denied_id>\S*) LCC: \S*)'
+    r'(?: at reader (?P<reader>\S+))?$'
+)
+
+def parse_time(value: str) -> float:
+    '''
+    Parses a point in time given as local ISO date/time ('2024-05-01',
+    '2024-05-01 02:00') or relative to now ('90m', '12h', '30d').
+    '''
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', value)
+    if match:
+        unit = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        return time.time() - float(match.group(1)) * unit
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+def parse_hours(value: str) -> Tuple[int, int]:
+    '''
+    Parses a local time-of-day window 'FROM-TO' in whole hours, e.g. '2-4'
+    for 02:00 until 04:00. Windows may wrap around midnight ('22-6').
+    '''
+    start, _, end = value.partition('-')
+    start, end = int(start), int(end)
+    if not (0 <= start <= 23 and 0 <= end <= 24):
+        raise ValueError(f"Invalid hour window {value}")
+    return start, end
+
+class AuditStore:
+    '''
+    SQLite database of access decisions.
+    '''
+
+    def __init__(self, path: os.PathLike) -> None:
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        if 'head' not in [column[1] for column in self.db.execute('PRAGMA table_info(ingested)')]:
+            # databases from before files were told apart by their head
+            self.db.execute('ALTER TABLE ingested ADD COLUMN head BLOB')
+
+    def close(self) -> None:
+        self.db.close()
+
+    def ingest_audit_log(self, path: os.PathLike) -> int:
+        '''
+        Ingest new records from the audit log at `path` and its rotated files.
+        Returns the number of records added.
+        '''
+        # rotated files as named by AuditLog, oldest first, so records are
+        # inserted roughly in time order
+        rotated = [f for f in glob.glob(f"{glob.escape(str(path))}.*") if ROTATED_SUFFIX.search(f)]
+        files = sorted(rotated) + [str(path)]
+        return sum(self._ingest_file(f, self._parse_audit_lines) for f in files if os.path.isfile(f))
+
+    def import_text_log(self, path: os.PathLike, salt: str = '') -> int:
+        '''
+        Import the decisions from a text log written by `Utils.setup_custom_logger`.
+        Lines at or after the first audit log record are skipped, those
+        decisions are already in the database. Returns the number of
+        decisions added.
+        '''
+        before = self.db.execute("SELECT MIN(ts) FROM decisions WHERE source IS NOT 'textlog'").fetchone()[0]
+        return self._ingest_file(path, lambda lines: self._parse_text_lines(lines, salt, before))
+
+    def _ingest_file(self, path: os.PathLike, parse: Callable[[List[str]], Iterator[ROW]]) -> int:
+        st = os.stat(path)
+        row = self.db.execute('SELECT offset, head FROM ingested WHERE dev = ? AND ino = ?', (st.st_dev, st.st_ino)).fetchone()
+        offset, head = row if row else (0, None)
+
+        with open(path, 'rb') as f:
+            if offset > st.st_size or (head and f.read(len(head)) != head):
+                # truncated, or a new file that reused the inode
+                offset = 0
+            if offset == st.st_size:
+                return 0
+            f.seek(offset)
+            data = f.read()
+            # a line still being written is picked up next time
+            end = data.rfind(b'\n') + 1
+            f.seek(0)
+            head = f.read(min(HEAD_BYTES, offset + end))
+        lines = data[:end].decode(errors='replace').splitlines()
+
+        with self.db:
+            cursor = self.db.executemany('INSERT INTO decisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', parse(lines))
+            self.db.execute('INSERT OR REPLACE INTO ingested (dev, ino, offset, head) VALUES (?, ?, ?, ?)', (st.st_dev, st.st_ino, offset + end, head))
+        return cursor.rowcount
+
+    def _parse_audit_lines(self, lines: List[str]) -> Iterator[ROW]:
+        for line in lines:
+            try:
+                r = json.loads(line)
+                yield (r['ts'], r.get('card'), r.get('netid'), r.get('reader'), int(r['decision'] == 'granted'),
+                       r.get('reason'), r.get('source'), json.dumps(r['ms'], separators=(',', ':')) if r.get('ms') else None)
+            except Exception as e:
+                print(f"Skipping malformed audit record: {line!r} ({e})", file=sys.stderr)
+
+    def _parse_text_lines(self, lines: List[str], salt: str, before: Optional[float]) -> Iterator[ROW]:
+        for line in lines:
+            match = TEXT_LOG_LINE.match(line)
+            if not match:
+                continue
+            ts = time.mktime(time.strptime(match['time'], '%Y-%m-%d %H:%M:%S'))
+            if before is not None and ts >= before:
+                continue
+            granted = match['denied_id'] is None
+            id = match['granted_id'] if granted else match['denied_id']
+            card = hash_card_id(id, salt) if id else None
+            yield (ts, card, match['netid'], match['reader'], int(granted), None, 'textlog', None)
+
+    def query(self, limit: Optional[int] = None, newest_first: bool = False, **filters) -> List[sqlite3.Row]:
+        '''
+        Decisions matching all of the given filters (see `_where`), in time order.
+        '''
+        where, params = self._where(**filters)
+        sql = 'SELECT * FROM decisions' + where
+        sql += ' ORDER BY ts DESC' if newest_first else ' ORDER BY ts'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        self.db.row_factory = sqlite3.Row
+        try:
+            return self.db.execute(sql, params).fetchall()
+        finally:
+            self.db.row_factory = None
+
+    def count(self, **filters) -> int:
+        where, params = self._where(**filters)
+        return self.db.execute('SELECT COUNT(*) FROM decisions' + where, params).fetchone()[0]
+
+    def _where(self, since: Optional[float] = None, until: Optional[float] = None, netid: Optional[str] = None,
+               card: Optional[str] = None, granted: Optional[bool] = None, reader: Optional[str] = None,
+               hours: Optional[Tuple[int, int]] = None) -> Tuple[str, list]:
+        '''
+        WHERE clause and parameters for the filters. `card` is the hashed card
+        ID as stored, `hours` a local time-of-day window from `parse_hours`.
+        '''
+        where, params = [], []
+        for clause, value in (('ts >= ?', since), ('ts < ?', until), ('netid = ?', netid), ('card = ?', card), ('reader = ?', reader)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        if granted is not None:
+            where.append('granted = ?')
+            params.append(int(granted))
+        if hours is not None:
+            hour = "CAST(strftime('%H', ts, 'unixepoch', 'localtime') AS INTEGER)"
+            start, end = hours
+            where.append(f'({hour} >= ? AND {hour} < ?)' if start < end else f'({hour} >= ? OR {hour} < ?)')
+            params += [start, end]
+        return (' WHERE ' + ' AND '.join(where) if where else ''), params
+
+def format_row(row: sqlite3.Row) -> str:
+    when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['ts']))
+    decision = 'granted' if row['granted'] else 'denied'
+    return f"{when}  {decision:<7}  {row['netid'] or '-':<10}  {row['reader'] or '-':<10}  {row['card'] or '-':<16}  {row['reason'] or '-'} ({row['source'] or '-'})"
+
+def main():
+    parser = argparse.ArgumentParser(prog='gatekeeper-audit', description="Query the history of GateKeeper access decisions.")
+    parser.add_argument('--config', '-c', help='Path to GateKeeper config file, for the audit log path and salt.', default=os.path.join(os.path.abspath(os.path.dirname(__file__)), 'config.cfg'))
+    parser.add_argument('--db', help='Path to the database. Defaults to audit.db from the config, or the audit log path with .sqlite3 appended.')
+    parser.add_argument('--audit-log', help='Path to the audit log. Defaults to audit.path from the config.')
+    parser.add_argument('--no-ingest', action='store_true', help='Do not ingest new audit log records first.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('ingest', help='Ingest new audit log records.')
+
+    import_log = commands.add_parser('import-log', help='Import decisions from old text logs, once.')
+    import_log.add_argument('logs', nargs='+')
+
+    query = commands.add_parser('query', help='List decisions.')
+    query.add_argument('--since', type=parse_time, help="Start, e.g. '2024-05-01', '2024-05-01 02:00' or '30d' ago.")
+    query.add_argument('--until', type=parse_time, help='End (exclusive), same formats as --since.')
+    query.add_argument('--hours', type=parse_hours, help="Only decisions in this local time of day, e.g. '2-4'.")
+    query.add_argument('--netid')
+    query.add_argument('--card', help='Card ID, hashed with audit.salt before searching.')
+    query.add_argument('--card-hash', help='Card hash as shown in the audit log.')
+    query.add_argument('--decision', choices=['granted', 'denied'])
+    query.add_argument('--reader')
+    query.add_argument('--limit', type=int)
+    query.add_argument('--newest-first', action='store_true')
+    query.add_argument('--count', action='store_true', help='Only print the number of matching decisions.')
+    query.add_argument('--json', action='store_true', help='Print one JSON object per decision.')
+
+    args = parser.parse_args()
+
+    audit_log, db_path, salt = args.audit_log, args.db, ''
+    if os.path.exists(args.config):
+        from config import load_config
+        audit_config = load_config(args.config).audit
+        audit_log = audit_log or audit_config.path
+        db_path = db_path or audit_config.db
+        salt = audit_config.salt
+    if not db_path:
+        if not audit_log:
+            parser.error('Either --db, --audit-log or a config with audit.path is required')
+        db_path = f"{audit_log}.sqlite3"
+
+    store = AuditStore(db_path)
+    try:
+        # also before importing text logs, so their overlap with the audit log is known
+        if audit_log and (args.command == 'ingest' or not args.no_ingest):
+            added = store.ingest_audit_log(audit_log)
+            if args.command == 'ingest':
+                print(f"Ingested {added} records from {audit_log}")
+                return
+
+        if args.command == 'import-log':
+            for log in args.logs:
+                print(f"{log}: imported {store.import_text_log(log, salt)} decisions")
+            return
+
+        filters = dict(
+            since=args.since, until=args.until, netid=args.netid, reader=args.reader, hours=args.hours,
+            card=hash_card_id(args.card, salt) if args.card else args.card_hash,
+            granted=None if args.decision is None else args.decision == 'granted',
+        )
+        start = time.perf_counter()
+        if args.count:
+            print(store.count(**filters))
+            print(f"Counted in {(time.perf_counter() - start) * 1000:.1f}ms", file=sys.stderr)
+            return
+        rows = store.query(limit=args.limit, newest_first=args.newest_first, **filters)
+        elapsed = time.perf_counter() - start
+
+        if args.json:
+            for row in rows:
+                record = dict(row)
+                record['ms'] = json.loads(record['ms']) if record['ms'] else None
+                print(json.dumps(record))
+        else:
+            for row in rows:
+                print(format_row(row))
+        print(f"{len(rows)} decisions in {elapsed * 1000:.1f}ms", file=sys.stderr)
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from config import Credentials, Ipa as IpaConfig
+import functools
+import logging
+import random
+import threading
+import time
+
+if TYPE_CHECKING:
+    from python_freeipa import ClientMeta
+
+'''
+Module for talking to IPA without ever making a swipe wait on a login.
+
+`IPAClient` stands in for python_freeipa's `ClientMeta`: `client.user_find(...)`
+and every other `ClientMeta` method work the same, so `Account`, `AccessCache`,
+`SyncWorker` and `LCCWriteback` use it unchanged. Behind that it
+
+- keeps a logged-in session on every configured IPA server (replica), each
+  with a pool of persistent HTTPS connections, so lookups reuse open TLS
+  connections instead of handshaking each time,
+- sends each request to the replica with the lowest moving average latency
+  among those that are logged in and whose circuit breaker is closed, and
+  fails over to the next one if it fails,
+- optionally hedges: a read still unanswered after `ipa.hedge_after`
+  seconds is also sent to the next fastest replica, and the first answer
+  is used,
+- applies a connect and read timeout to every request (`timeout()` changes
+  it for the current thread, e.g. for bulk syncs),
+- retries requests that failed with a connection error, a timeout or an
+  HTTP 5xx on another replica, or after an exponential backoff once every
+  replica was tried,
+- counts those failures in a `CircuitBreaker` per replica. While all of
+  them are open, requests fail at once with `IPAUnavailable` and swipes go
+  to the offline policy instead of each waiting out a timeout,
+- renews each session from a background thread before it expires, pings
+  idle replicas so their sessions and connections stay alive (which also
+  keeps their latency current), and logs in again in the background if a
+  replica rejects its session. A new session is swapped in once it is
+  logged in; requests keep using the old one, or other replicas, until then.
+
+python_freeipa and requests make up most of GateKeeper's import time, so
+they are only imported by the first login, which runs in the background.
+'''
+
+# ClientMeta methods that only read, and may be sent to two replicas at once
+HEDGED = frozenset(['user_find', 'user_show', 'group_find', 'group_show', 'ping'])
+
+# weight of the newest request in a replica's moving average latency
+EWMA_ALPHA = 0.3
+
+class IPAUnavailable(ConnectionError):
+    '''
+    Raised instead of sending a request while no replica is logged in with a
+    closed circuit breaker.
+    '''
+
+class CircuitBreaker:
+    '''
+    Opens after `failures` failures in a row. While open, `allow()` is False
+    for `reset_timeout` seconds; after that one request is let through, which
+    closes the breaker if it succeeds and opens it again if it fails.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures: int, reset_timeout: float) -> None:
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+        self.opened = 0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # the caller is the probe, everyone else keeps failing fast
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self) -> None:
+        with self._lock:
+            self._consecutive = 0
+            self.state = self.CLOSED
+
+    def failure(self) -> None:
+        with self._lock:
+            self._consecutive += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._consecutive >= self.failures):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+
+@functools.lru_cache(maxsize=None)
+def _timeout_adapter_class() -> type:
+    from requests.adapters import HTTPAdapter
+
+    class TimeoutAdapter(HTTPAdapter):
+        '''
+        HTTPAdapter that applies a default timeout to requests sent without
+        one, which is every request python_freeipa sends.
+        '''
+
+        def __init__(self, timeout: tuple, local: threading.local, pool_size: int) -> None:
+            # retries are done by IPAClient, which knows which requests failed
+            super().__init__(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            self.timeout = timeout
+            self.local = local
+
+        def send(self, request, timeout=None, **kwargs):
+            if timeout is None:
+                timeout = getattr(self.local, 'timeout', None) or self.timeout
+            return super().send(request, timeout=timeout, **kwargs)
+
+    return TimeoutAdapter
+
+def _is_transient(e: Exception) -> bool:
+    '''
+    Whether a failed request may succeed if it is sent again.
+    '''
+    from python_freeipa.exceptions import FreeIPAError
+    from requests.exceptions import ConnectionError, Timeout
+
+    if isinstance(e, (ConnectionError, Timeout)):
+        return True
+    code = getattr(e, 'code', None)
+    return isinstance(e, FreeIPAError) and isinstance(code, int) and 500 <= code < 600
+
+def _session_expired(e: Exception) -> bool:
+    '''
+    Whether IPA rejected the session itself (HTTP 401). Subclasses of
+    Unauthorized, e.g. Denied for an ACI error or PasswordExpired, are errors
+    of the request or the account that logging in again does not fix.
+    '''
+    from python_freeipa.exceptions import Unauthorized
+
+    return type(e) is Unauthorized
+
+class Replica:
+    '''
+    One IPA server: its session, circuit breaker and latency.
+    '''
+
+    def __init__(self, host: str, settings: IpaConfig) -> None:
+        self.host = host
+        self.breaker = CircuitBreaker(settings.breaker_failures, settings.breaker_reset)
+
+        # logged-in ClientMeta, replaced as a whole by IPAClient.login(). None
+        # before the first login and after IPA rejected the session
+        self.session: Optional['ClientMeta'] = None
+        # time.time() the session expires at
+        self.expires_at = 0.0
+        self.last_used = time.monotonic()
+        # time.monotonic() of the next login attempt while there is no session
+        self.next_login = 0.0
+        self.login_backoff = 1.0
+        # moving average of request seconds, None until the first request
+        self.latency: Optional[float] = None
+
+        self.requests = 0
+        self.errors = 0
+        self.logins = 0
+        self.login_failures = 0
+
+    def observe(self, seconds: float) -> None:
+        latency = self.latency
+        self.latency = seconds if latency is None else latency + EWMA_ALPHA * (seconds - latency)
+
+    def stats(self) -> dict:
+        return {
+            'logged_in': int(self.session is not None),
+            'breaker_open': int(self.breaker.state != CircuitBreaker.CLOSED),
+            'breaker_opened': self.breaker.opened,
+            'latency_ms': (self.latency or 0.0) * 1000,
+            'requests': self.requests,
+            'errors': self.errors,
+            'logins': self.logins,
+            'login_failures': self.login_failures,
+        }
+
+class IPAClient:
+    '''
+    Logged-in sessions on the configured IPA replicas with timeouts, retries,
+    failover, circuit breakers and background renewal. Call `login()` once,
+    then `start()`.
+    '''
+
+    def __init__(self, logger: logging.Logger, credentials: Credentials, settings: IpaConfig) -> None:
+        self.logger = logger
+        self.credentials = credentials
+        self.settings = settings
+        self.replicas = [Replica(host, settings) for host in credentials.hosts]
+
+        self._local = threading.local()
+        self._login_lock = threading.Lock()
+        # runs hedged requests, created on first use
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        self._stop_event = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @property
+    def logged_in(self) -> bool:
+        return any(replica.session is not None for replica in self.replicas)
+
+    def login(self) -> None:
+        '''
+        Log in to every replica at once, swapping in the new sessions. Raises
+        if no replica could be logged in to; the current sessions stay in use
+        on the replicas that failed.
+        '''
+        with ThreadPoolExecutor(max_workers=len(self.replicas), thread_name_prefix='ipa-login') as executor:
+            futures = [executor.submit(self._login, replica) for replica in self.replicas]
+        errors = [future.exception() for future in futures]
+        if all(errors):
+            raise errors[0]
+
+    def _login(self, replica: Replica) -> None:
+        from python_freeipa import ClientMeta
+
+        credentials, settings = self.credentials, self.settings
+        if not credentials.verify_ssl:
+            import urllib3
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        session = ClientMeta(replica.host, verify_ssl=credentials.verify_ssl)
+        adapter = _timeout_adapter_class()((settings.connect_timeout, settings.timeout), self._local, settings.pool_size)
+        session._session.mount('https://', adapter)
+        try:
+            session.login(credentials.username, credentials.password)
+        except Exception as e:
+            replica.login_failures += 1
+            replica.next_login = time.monotonic() + replica.login_backoff
+            replica.login_backoff = min(replica.login_backoff * 2, settings.breaker_reset)
+            session._session.close()
+            self.logger.warning(f"Unable to log in to IPA at {replica.host}: {e}")
+            raise
+
+        # IPA usually sends a session cookie without an expiry, in which
+        # case the configured session lifetime is all there is to go on
+        expires_at = time.time() + settings.session_lifetime
+        for cookie in session._session.cookies:
+            if cookie.name == 'ipa_session' and cookie.expires:
+                expires_at = min(expires_at, cookie.expires)
+
+        with self._login_lock:
+            old, replica.session = replica.session, session
+            replica.expires_at = expires_at
+            replica.login_backoff = 1.0
+            replica.logins += 1
+        self.logger.info(f"Logged in to IPA at {replica.host} as: {credentials.username}")
+        if old is not None:
+            old._session.close()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='ipa-session', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+        for replica in self.replicas:
+            session, replica.session = replica.session, None
+            if session is not None:
+                session._session.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    @contextmanager
+    def timeout(self, seconds: float) -> Iterator[None]:
+        '''
+        Use a read timeout of `seconds` for requests made by this thread.
+        '''
+        previous = getattr(self._local, 'timeout', None)
+        self._local.timeout = (self.settings.connect_timeout, seconds)
+        try:
+            yield
+        finally:
+            self._local.timeout = previous
+
+    def _pick(self, tried: List[Replica], reuse: bool) -> Optional[Replica]:
+        '''
+        The fastest logged-in replica not in `tried` whose breaker lets a
+        request through, or if `reuse` and there is none, the fastest of
+        `tried`. Replicas without a latency yet are tried first.
+        '''
+        replicas = sorted((r for r in self.replicas if r.session is not None), key=lambda r: r.latency or 0.0)
+        candidates = [r for r in replicas if r not in tried]
+        if reuse:
+            candidates += [r for r in replicas if r in tried]
+        for replica in candidates:
+            # allow() lets the caller probe a replica whose breaker is half open
+            if replica.breaker.allow():
+                return replica
+        return None
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        '''
+        Call the ClientMeta method `method` on the fastest replica, failing
+        over to the others.
+        '''
+        settings = self.settings
+        timeout = getattr(self._local, 'timeout', None)
+        hedge = settings.hedge_after and len(self.replicas) > 1 and method in HEDGED
+        self.requests += 1
+
+        tried: List[Replica] = []
+        error: Optional[Exception] = None
+        for attempt in range(settings.retries + 1):
+            replica = self._pick(tried, reuse=True)
+            if replica is None:
+                self.rejected += 1
+                raise IPAUnavailable(f"No IPA server available ({self.credentials.host}), not sending {method}") from error
+            if replica in tried:
+                # every replica failed already, give them a moment
+                time.sleep(settings.retry_backoff * 2 ** attempt * random.uniform(0.5, 1.0))
+            if attempt:
+                self.retries += 1
+            tried.append(replica)
+
+            try:
+                if hedge:
+                    return self._hedged(replica, tried, timeout, method, args, kwargs)
+                return self._send(replica, timeout, method, args, kwargs)
+            except Exception as e:
+                if _session_expired(e):
+                    # renewed in the background, another replica may still answer
+                    error = e
+                    continue
+                if not _is_transient(e):
+                    raise
+                error = e
+                self.logger.debug(f"IPA {method} failed at {replica.host} ({e}), retrying")
+        raise error
+
+    def _send(self, replica: Replica, timeout: Optional[tuple], method: str, args: tuple, kwargs: dict) -> Any:
+        session = replica.session
+        if session is None:
+            raise IPAUnavailable(f"Not logged in to IPA at {replica.host}")
+
+        # the calling thread's timeout, also when sent from a hedging thread
+        previous = getattr(self._local, 'timeout', None)
+        self._local.timeout = timeout
+        replica.requests += 1
+        replica.last_used = start = time.monotonic()
+        try:
+            result = getattr(session, method)(*args, **kwargs)
+        except Exception as e:
+            if _session_expired(e):
+                # the session ended before it was renewed; the server itself is fine
+                replica.breaker.success()
+                with self._login_lock:
+                    if replica.session is session:
+                        replica.session = None
+                        replica.next_login = 0.0
+                self.logger.warning(f"IPA at {replica.host} rejected the session, logging in again in the background")
+                self._wake.set()
+                raise
+            replica.observe(time.monotonic() - start)
+            if not _is_transient(e):
+                # IPA answered, e.g. with NotFound
+                replica.breaker.success()
+                raise
+            replica.errors += 1
+            self.failures += 1
+            replica.breaker.failure()
+            raise
+        else:
+            replica.observe(time.monotonic() - start)
+            replica.breaker.success()
+            return result
+        finally:
+            self._local.timeout = previous
+
+    def _hedged(self, first: Replica, tried: List[Replica], timeout: Optional[tuple], method: str, args: tuple, kwargs: dict) -> Any:
+        '''
+        Send to `first`, and also to the next fastest replica if `first` has
+        not answered within ipa.hedge_after seconds. Returns the first answer.
+        '''
+        if self._executor is None:
+            with self._login_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.settings.pool_size * len(self.replicas), thread_name_prefix='ipa-hedge')
+
+        primary = self._executor.submit(self._send, first, timeout, method, args, kwargs)
+        futures = [primary]
+        done, _ = wait(futures, timeout=self.settings.hedge_after)
+        if not done:
+            second = self._pick(tried, reuse=False)
+            if second is not None:
+                tried.append(second)
+                self.hedged += 1
+                futures.append(self._executor.submit(self._send, second, timeout, method, args, kwargs))
+
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is not primary:
+                self.hedge_wins += 1
+            return result
+        raise error
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def _run(self) -> None:
+        settings = self.settings
+        while not self._stop_event.is_set():
+            wait = settings.keepalive or settings.session_lifetime
+            for replica in self.replicas:
+                if self._stop_event.is_set():
+                    return
+                if replica.session is None or replica.expires_at - settings.refresh_margin <= time.time():
+                    # no session yet, rejected, or about to expire
+                    login_in = replica.next_login - time.monotonic()
+                    if login_in > 0:
+                        wait = min(wait, login_in)
+                        continue
+                    try:
+                        self._login(replica)
+                    except Exception:
+                        pass
+                    wait = 0
+                    continue
+                wait = min(wait, replica.expires_at - settings.refresh_margin - time.time())
+
+                if settings.keepalive:
+                    idle = time.monotonic() - replica.last_used
+                    if idle >= settings.keepalive:
+                        if replica.breaker.allow():
+                            try:
+                                self._send(replica, None, 'ping', (), {})
+                            except Exception as e:
+                                self.logger.debug(f"IPA keepalive to {replica.host} failed: {e}")
+                        # ping again after keepalive seconds even if it failed
+                        replica.last_used = time.monotonic()
+                        idle = 0.0
+                    wait = min(wait, settings.keepalive - idle)
+
+            if wait > 0:
+                self._wake.wait(wait)
+                self._wake.clear()
+
+    def stats(self) -> dict:
+        return {
+            'logged_in': sum(replica.session is not None for replica in self.replicas),
+            'breaker_open': sum(replica.breaker.state != CircuitBreaker.CLOSED for replica in self.replicas),
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'logins': sum(replica.logins for replica in self.replicas),
+            'login_failures': sum(replica.login_failures for replica in self.replicas),
+        }
+
+    def replica_stats(self) -> Dict[str, dict]:
+        return {replica.host: replica.stats() for replica in self.replicas}
@@ -0,0 +1,274 @@
+from typing import Callable, Dict, Optional, Set
+from ipa_client import IPAClient
+from access_cache import GROUPS, AccessCache, AccessEntry
+from snapshot import AccessSnapshot
+from lcc_writeback import LCCWriteback
+from policy import PolicyEngine
+from config import Config
+from utils import Utils
+import logging
+import random
+import threading
+import time
+
+'''
+Module for keeping the AccessCache in sync with IPA from a background thread.
+
+A full sync rebuilds the index with a bulk `user_find` per allowed group. In
+between full syncs, an incremental sync only lists the members of the allowed
+groups with `group_show` and compares them to the members already in the
+cache. Only users that joined an allowed group are fetched; users that left
+are dropped from the index. All changes are applied to the cache in a single
+atomic swap, so lookups from the swipe loop never wait on the sync.
+
+IPA has no way to search for users by modifyTimestamp through the JSON-RPC
+API, so LCC changes made directly in IPA are picked up by the periodic full
+sync (every sync.full_every rounds). LCC changes made by swiping a newer card
+update the cache immediately.
+
+The worker also owns the IPA session. It logs in on its first round, so
+startup never waits on IPA, and logs in again after a failed sync. After
+every successful sync the authorized cards are written to the offline
+snapshot.
+
+Loading the on-disk cache is also left to the worker, before its first
+round, so a large cache file does not hold up the card readers. Until then
+swipes are decided by IPA lookups and the offline snapshot.
+
+With replication (see replication.py), only the elected leader's worker
+syncs with IPA; on the other nodes it only keeps the session for lookups,
+and writes the snapshot when replication changed the cache.
+'''
+
+class SyncWorker(threading.Thread):
+    '''
+    Background thread that periodically refreshes the AccessCache from IPA.
+    '''
+
+    def __init__(self, logger: logging.Logger, config: Config, cache: AccessCache, snapshot: AccessSnapshot, writeback: Optional[LCCWriteback] = None, policy: Optional[PolicyEngine] = None) -> None:
+        super().__init__(name='ipa-sync', daemon=True)
+        self.logger = logger
+        self.config = config
+        self.cache = cache
+        self.snapshot = snapshot
+        # LCC updates not yet written to IPA, laid over every sync result
+        self.writeback = writeback
+        # decides which groups are synced, access.allowed_groups if None
+        self.policy = policy
+        # returns whether this node syncs with IPA, None to always sync. Set
+        # by main.py to Replicator.is_leader
+        self.leader: Optional[Callable[[], bool]] = None
+
+        # client from Utils.setup_ipa_client shared with the swipe loop. None
+        # until the first connect(), which sets it even if the login failed,
+        # replaced when the credentials or [ipa] settings change; assigning
+        # the attribute is atomic.
+        self.client: Optional[IPAClient] = None
+        self._reconnect = True
+
+        self._stop_event = threading.Event()
+        # wakes the worker before its next round is due, see refresh()
+        self._wake = threading.Event()
+        self._full = False
+        # allowed groups as of the last full sync. Cached entries only hold
+        # the groups that were allowed when they were fetched, so a newly
+        # allowed group needs a full sync
+        self._synced_groups: Set[str] = set()
+        # set once the on-disk cache is loaded and once the first sync succeeded
+        self.cache_loaded = threading.Event()
+        self.ready = threading.Event()
+        self.started_at = None
+
+        self.syncs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.last_fetched = 0
+        self.last_removed = 0
+        self.last_success = None
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def refresh(self, reconnect: bool = False) -> None:
+        '''
+        Run a full sync now instead of waiting for the next round, logging in
+        again first if `reconnect`. The current session keeps serving lookups
+        until the new login succeeds.
+        '''
+        if reconnect:
+            self._reconnect = True
+        self._full = True
+        self._wake.set()
+
+    def run(self) -> None:
+        self.started_at = time.monotonic()
+        # entries from the cache file keep only the numbered groups
+        GROUPS.register(self.allowed_groups())
+        self.cache.load()
+        self.cache_loaded.set()
+
+        consecutive_failures = 0
+        # the first round is always a full sync, the on-disk cache may be old
+        rounds_until_full = 0
+
+        while not self._stop_event.is_set():
+            # read every round, the config may have been reloaded
+            sync_config = self.config.sync
+            try:
+                if self._reconnect or self.client is None:
+                    self.connect()
+                if self.leader is not None and not self.leader():
+                    # the leader syncs and replicates the result here; start
+                    # with a full sync after taking over
+                    rounds_until_full = 0
+                    self._full = False
+                    self._wake.wait(sync_config.interval)
+                    self._wake.clear()
+                    continue
+                with self.client.timeout(self.config.ipa.sync_timeout):
+                    if rounds_until_full <= 0 or self._full or not self.allowed_groups() <= self._synced_groups:
+                        # this sync answers a refresh() that came in meanwhile
+                        self._full = False
+                        self._wake.clear()
+                        self.sync_full()
+                        rounds_until_full = sync_config.full_every
+                    else:
+                        self.sync_incremental()
+                rounds_until_full -= 1
+                consecutive_failures = 0
+                delay = sync_config.interval
+            except Exception as e:
+                self.failures += 1
+                consecutive_failures += 1
+                # the session may have expired, log in again before the next try
+                self._reconnect = True
+                delay = min(sync_config.max_backoff, sync_config.interval * 2 ** (consecutive_failures - 1))
+                self.logger.warning(f"IPA sync failed ({consecutive_failures} in a row), retrying in about {delay:.0f}s", exc_info=e)
+
+            # spread out the syncs of several door nodes hitting the same server
+            delay *= random.uniform(1 - sync_config.jitter, 1 + sync_config.jitter)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def connect(self) -> None:
+        client = self.client
+        if client is not None and client.credentials == self.config.credentials and client.settings == self.config.ipa:
+            # swaps in a new session once it is logged in, lookups keep
+            # using the current one meanwhile
+            client.login()
+        else:
+            client = Utils.setup_ipa_client(self.logger, self.config)
+            if client is None:
+                raise ConnectionError(f"Unable to set up the IPA client for {self.config.credentials.host}")
+            old, self.client = self.client, client
+            if old is not None:
+                old.close()
+        self._reconnect = False
+
+    def allowed_groups(self) -> Set[str]:
+        '''
+        Groups the policy grants access to at some door at some time.
+        '''
+        if self.policy is not None:
+            return self.policy.policy.groups
+        return self.config.access.allowed_groups
+
+    def sync_full(self) -> None:
+        start = time.monotonic()
+        allowed_groups = set(self.allowed_groups())
+
+        count = self.cache.load_from_ipa(self.client, allowed_groups)
+        self._synced_groups = allowed_groups
+
+        self._finish('full', start, fetched=count, removed=0)
+
+    def sync_incremental(self) -> None:
+        start = time.monotonic()
+        client = self.client
+        allowed_groups = self.allowed_groups()
+
+        members: Set[str] = set()
+        for group in allowed_groups:
+            result = client.group_show(a_cn=group, o_no_members=False)['result']
+            members.update(result.get('member_user', []))
+
+        allowed_mask = GROUPS.register(allowed_groups)
+        known: Dict[str, AccessEntry] = {}
+        for entry in self.cache.entries():
+            if entry.group_mask & allowed_mask:
+                known[entry.uid] = entry
+
+        now = time.time()
+        upserts = []
+        for uid in members - known.keys():
+            users = client.user_find(o_uid=uid)
+            for user in users['result']:
+                entry = AccessEntry.from_ipa_user(user, now)
+                if entry is not None:
+                    upserts.append(entry)
+        fetched = len(upserts)
+
+        # membership of everyone else was just confirmed
+        for uid in members & known.keys():
+            upserts.append(known[uid].replace(fetched_at=now))
+
+        removals = [known[uid].id for uid in known.keys() - members]
+
+        self.cache.apply(upserts, removals)
+
+        self._finish('incremental', start, fetched=fetched, removed=len(removals))
+
+    def _apply_pending_lcc(self) -> None:
+        '''
+        IPA does not know about LCC updates still waiting in the write-back
+        queue, so put them back over what the sync fetched.
+        '''
+        if self.writeback is None:
+            return
+        pending = self.writeback.pending()
+        if pending:
+            self.cache.apply([e.replace(lcc=pending[e.uid]) for e in self.cache.entries() if e.uid in pending])
+
+    def _finish(self, kind: str, start: float, fetched: int, removed: int) -> None:
+        self._apply_pending_lcc()
+
+        self.syncs += 1
+        self.last_duration = time.monotonic() - start
+        self.last_fetched = fetched
+        self.last_removed = removed
+        self.last_success = time.time()
+
+        self.cache.save()
+        authorized = self.write_snapshot()
+
+        self.logger.info(f"IPA {kind} sync took {self.last_duration * 1000:.0f}ms: fetched {fetched} accounts, removed {removed}, cache holds {len(self.cache)}, snapshot holds {authorized}")
+        if not self.ready.is_set():
+            self.ready.set()
+            self.logger.info(f"First IPA sync finished {(time.monotonic() - self.started_at) * 1000:.0f}ms after the worker started")
+
+    def write_snapshot(self) -> int:
+        # the snapshot only knows groups, not doors or schedules
+        entries = self.cache.entries()
+        if self.policy is not None:
+            policy = self.policy.policy
+            entries = [entry for entry in entries if not policy.always_denied(entry.uid)]
+        return self.snapshot.write(entries, self.allowed_groups())
+
+    def replicated(self) -> None:
+        '''
+        Called after replication changed the cache.
+        '''
+        self._apply_pending_lcc()
+        self.cache.save()
+        self.write_snapshot()
+
+    def stats(self) -> dict:
+        return {
+            'syncs': self.syncs,
+            'failures': self.failures,
+            'last_duration': self.last_duration,
+            'last_fetched': self.last_fetched,
+            'last_removed': self.last_removed,
+            'last_success': self.last_success,
+        }
@@ -0,0 +1,161 @@
+from typing import Callable, Dict, Optional
+from ipa_client import IPAClient
+import json
+import logging
+import os
+import pathlib
+import threading
+
+'''
+Module for writing swiped LCCs back to IPA outside of the access decision.
+
+When a card with a newer LCC is swiped, Account.has_access() grants access
+right away and hands the new LCC to LCCWriteback. A background thread then
+calls `user_mod` for it, retrying with exponential backoff until it works.
+
+Pending updates are kept per uid, so several swipes before a write lands
+collapse into a single `user_mod` with the highest LCC. They are also written
+to disk by the background thread before each attempt, so updates survive a
+restart.
+'''
+
+# IPA error code for a `user_mod` that would not change anything
+EMPTY_MODLIST = 4202
+
+class LCCWriteback(threading.Thread):
+    '''
+    Background queue of LCC updates for IPA.
+    '''
+
+    def __init__(self, logger: logging.Logger, path: Optional[os.PathLike], get_client: Callable[[], Optional[IPAClient]], max_backoff: float = 300.0) -> None:
+        super().__init__(name='lcc-writeback', daemon=True)
+        self.logger = logger
+        self.path = path
+        # returns the current IPA session, None while logged out
+        self.get_client = get_client
+        self.max_backoff = max_backoff
+
+        # uid -> LCC to write
+        self._pending: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+        self.written = 0
+        self.collapsed = 0
+        self.failures = 0
+
+        self._load()
+
+    def enqueue(self, uid: str, lcc: str) -> None:
+        '''
+        Schedule the LCC of the user to be set to `lcc`. Does not block.
+        '''
+        with self._lock:
+            current = self._pending.get(uid)
+            if current is not None:
+                self.collapsed += 1
+                if int(current) >= int(lcc):
+                    return
+            self._pending[uid] = lcc
+        self._wake.set()
+
+    def pending(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._pending)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._wake.set()
+
+    def run(self) -> None:
+        backoff = 1.0
+        # wait for work, or retry after `delay` while updates are failing
+        delay = 0.0 if self._pending else None
+
+        while not self._stop_event.is_set():
+            self._wake.wait(delay)
+            self._wake.clear()
+
+            self._save()
+            if self._flush():
+                backoff = 1.0
+                delay = None
+            else:
+                delay = backoff
+                backoff = min(backoff * 2, self.max_backoff)
+                self.logger.info(f"{len(self._pending)} LCC updates pending, retrying in {delay:.0f}s")
+
+        self._save()
+
+    def _flush(self) -> bool:
+        '''
+        Try to write every pending update. Returns False if any must be retried.
+        '''
+        # imported here to keep python_freeipa out of startup, see ipa_client.py
+        from python_freeipa.exceptions import BadRequest, NotFound
+
+        ok = True
+        for uid, lcc in self.pending().items():
+            client = self.get_client()
+            if client is None:
+                return False
+
+            try:
+                client.user_mod(a_uid=uid, o_employeetype=lcc)
+                self.logger.info(f"The LCC change for user {uid} to {lcc} succeeded.")
+            except NotFound:
+                self.logger.warning(f"User {uid} no longer exists, dropping the LCC change to {lcc}.")
+            except BadRequest as e:
+                if getattr(e, 'code', None) != EMPTY_MODLIST:
+                    self.failures += 1
+                    self.logger.warning(f"The attempt to change the LCC of user {uid} to {lcc} failed.", exc_info=e)
+                    ok = False
+                    continue
+            except Exception as e:
+                self.failures += 1
+                self.logger.warning(f"The attempt to change the LCC of user {uid} to {lcc} failed.", exc_info=e)
+                ok = False
+                continue
+
+            with self._lock:
+                # a newer LCC may have been swiped in the meantime
+                if self._pending.get(uid) == lcc:
+                    del self._pending[uid]
+            self.written += 1
+
+        self._save()
+        return ok
+
+    def _load(self) -> None:
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self._pending = json.load(f)
+            if self._pending:
+                self.logger.info(f"Loaded {len(self._pending)} pending LCC updates from {self.path}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f"Unable to load pending LCC updates from {self.path}", exc_info=e)
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        try:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.pending(), f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.warning(f"Unable to save pending LCC updates to {self.path}", exc_info=e)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'written': self.written,
+            'collapsed': self.collapsed,
+            'failures': self.failures,
+        }
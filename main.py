@@ -1,11 +1,30 @@
-from account import Account
+import time
+# taken before the other imports, so the startup log includes them
+STARTED_AT = time.perf_counter()
+
+from typing import Callable, List, Optional, Tuple, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
+from access_cache import AccessCache
+from audit import AuditLog
+from decision import Decider, Decision
+from pipeline import SwipePipeline
+from ratelimit import NegativeCache, RateLimiter
+from policy import PolicyEngine, default_policy, load_policy
+from metrics import Metrics, MetricsServer
+from ipa_sync import SyncWorker
+from lcc_writeback import LCCWriteback
+from snapshot import AccessSnapshot
 from strike import Strike, get_strike_for_method
 from utils import Utils
-from python_freeipa import ClientMeta
 from config import load_config, Config
+from config_reload import ConfigPartlyApplied, ConfigReloader, changed_sections
+from remote import DecisionServer, RemoteDecider, RemoteSwipeEvent
+from replication import Replicator
+from diagnostics import SamplingProfiler, StallWatchdog
 import cardreader
 import signal
-import urllib3
 import logging
 import argparse
 import os
@@ -15,14 +34,45 @@ DEFAULT_CFG_PATH = os.path.join(SCRIPT_PATH, "config.cfg")
 EXIT_TOKENS = ['q', 'exit', 'quit']
 LOGGER_NAME = 'lab_swipe'
 
-urllib3.disable_warnings()
-
 def signal_handler(sig, frame):
     Utils.exit(logging.getLogger(LOGGER_NAME), msg = "Exiting due to CTRL-C...")
 
 signal.signal(signal.SIGINT, signal_handler)
 
+T = TypeVar('T')
+
+class StartupTimer:
+    '''
+    Times the phases of startup for the "Ready for swipes" log line. Phases
+    timed with `call` may run concurrently on different threads.
+    '''
+
+    def __init__(self, started_at: Optional[float] = None) -> None:
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def call(self, name: str, fn: Callable[..., T], *args) -> T:
+        with self.phase(name):
+            return fn(*args)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def summary(self) -> str:
+        return ', '.join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.phases)
+
 def main():
+    timer = StartupTimer(STARTED_AT)
+    timer.phases.append(('imports', timer.elapsed()))
+
     parser = argparse.ArgumentParser(description="GateKeeper program for controlling an electronic door strike with a card reader.")
     parser.add_argument('--strike', '-s', help='Method used for controlling the door strike. Fake is used for testing purposes.', choices=['fake', 'arduino', 'pi'], default=None)
     parser.add_argument('--config', '-c', help='Path to GateKeeper config file.', default=DEFAULT_CFG_PATH)
@@ -30,46 +80,382 @@ def main():
     args = parser.parse_args()
 
     path_to_cfg = args.config
-    config: Config = load_config(path_to_cfg)
+    with timer.phase('config'):
+        config: Config = load_config(path_to_cfg)
 
-    logger: logging.Logger = Utils.setup_custom_logger(LOGGER_NAME, log_file=config.logging.log)
+    with timer.phase('logger'):
+        logger: logging.Logger = Utils.setup_custom_logger(LOGGER_NAME, log_file=config.logging.log)
     logger.info(f"Loaded configuration from {path_to_cfg}: {repr(config)}")
 
+    if config.remote.role == 'daemon':
+        # swipes come from the door nodes, which also drive the strikes
+        with timer.phase('listen'):
+            server = DecisionServer(logger, config.remote.listen, config.remote.secret)
+        run(config, logger, None, server, config_path=path_to_cfg, strike_method=args.strike, timer=timer)
+        Utils.exit(logger)
+
     strike_method = config.strike.method
     if args.strike:
         strike_method = args.strike
-    strike = get_strike_for_method(strike_method, logger)
 
-    client = Utils.setup_ipa_client(logger, config)
+    # neither depends on the other, and both may wait on hardware
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='startup') as pool:
+        strike_future = pool.submit(timer.call, 'strike', get_strike_for_method, strike_method, logger, config.strike)
+        reader_future = pool.submit(timer.call, 'readers', cardreader.get_cardreader, config.readers, logger, True)
+        strike, reader = strike_future.result(), reader_future.result()
+
+    if config.remote.role == 'door':
+        run_door(config, logger, strike, reader, timer=timer)
+    else:
+        run(config, logger, strike, reader, config_path=path_to_cfg, strike_method=args.strike, timer=timer)
+    Utils.exit(logger)
+
+def make_audit_log(logger: logging.Logger, config: Config) -> Optional[AuditLog]:
+    if not config.audit.path:
+        return None
+    return AuditLog(logger, config.audit.path, db=config.audit.db, salt=config.audit.salt, max_bytes=config.audit.max_bytes, rotate_interval=config.audit.rotate_interval, backup_count=config.audit.backup_count, flush_interval=config.audit.flush_interval)
+
+def make_limiters(config: Config) -> Tuple[Optional[NegativeCache], Optional[RateLimiter], Optional[RateLimiter]]:
+    negative_cache = NegativeCache(config.negative_cache.ttl, config.negative_cache.max_entries) if config.negative_cache.ttl else None
+    reader_limiter = RateLimiter(config.ratelimit.reader_rate, config.ratelimit.reader_burst) if config.ratelimit.reader_rate else None
+    card_limiter = RateLimiter(config.ratelimit.card_rate, config.ratelimit.card_burst) if config.ratelimit.card_rate else None
+    return negative_cache, reader_limiter, card_limiter
+
+def make_diagnostics(logger: logging.Logger, config: Config, metrics: Metrics) -> Tuple[StallWatchdog, SamplingProfiler]:
+    '''
+    Start the stall watchdog and take a profile on SIGUSR1, see diagnostics.py.
+    '''
+    watchdog = StallWatchdog(logger, config.diagnostics.stall_threshold)
+    watchdog.start()
+    profiler = SamplingProfiler(logger, config.diagnostics.profile_interval, config.diagnostics.profile_seconds, config.diagnostics.profile_dir)
+    signal.signal(signal.SIGUSR1, lambda sig, frame: profiler.profile_to_file())
+    metrics.add_collector('gatekeeper_watchdog', watchdog.stats)
+    metrics.add_collector('gatekeeper_profiler', profiler.stats)
+    return watchdog, profiler
+
+def act_on_decision(logger: logging.Logger, metrics: Metrics, strike: Optional[Strike], audit: Optional[AuditLog], evt: cardreader.SwipeEvent, decision: Decision) -> None:
+    '''
+    Open the door for a grant, log and audit the decision. On the decision
+    daemon `strike` is None, the door node opens its own door.
+    '''
+    decision_seconds = time.monotonic() - evt.received_at
+    metrics.decision_seconds.observe(decision_seconds)
+    metrics.swipes.inc('granted' if decision.granted else 'denied', decision.source)
 
-    reader = cardreader.get_cardreader(config.reader, logger)
+    actuation_seconds = None
+    if decision.granted and decision.source == 'duplicate' and strike is not None and strike.is_open:
+        # the door is still open from the first swipe
+        logger.info(f"Repeat swipe by {decision.netid or f'ID: {evt.id}'} at reader {evt.reader}, door already open")
+    elif decision.granted:
+        logger.info(f"Access granted to {decision.netid or f'ID: {evt.id}'} at reader {evt.reader}")
+        if strike is not None:
+            start = time.perf_counter()
+            strike.strike()
+            actuation_seconds = time.perf_counter() - start
+            metrics.actuation_seconds.observe(actuation_seconds)
+    else:
+        logger.info(f"Denied access to ID: {evt.id} LCC: {evt.lcc} at reader {evt.reader}")
+
+    if audit is not None:
+        audit.record(evt.id, decision.netid, evt.reader, decision.granted, decision.reason, decision.source, {
+            'read': evt.read_seconds,
+            'lookup': decision.lookup_seconds,
+            'decision': decision_seconds,
+            'actuation': actuation_seconds,
+        })
+
+def serve(logger: logging.Logger, reader: cardreader.CardReader, pipeline: SwipePipeline, metrics: Metrics, watchdog: StallWatchdog) -> None:
+    '''
+    Submit every swipe from `reader` to `pipeline` until the reader is closed.
+    '''
     for evt in reader.events():
-        if isinstance(evt, cardreader.SwipeEvent):
-            account: Account = None
-            id = evt.id
-            lcc = evt.lcc
+        with watchdog.busy(f"Reader loop handling an event from reader {evt.reader}"):
+            if isinstance(evt, cardreader.SwipeEvent):
+                if evt.read_seconds is not None:
+                    metrics.read_seconds.observe(evt.read_seconds)
+                # blocks while pipeline.max_pending swipes are in progress
+                pipeline.submit(evt)
+            elif isinstance(evt, cardreader.InvalidDataEvent):
+                metrics.invalid_reads.inc(str(evt.reader))
+                logger.warning(f"Invalid data received from card reader {evt.reader}: {evt.data}", exc_info=evt.exc_info)
+            else:
+                logger.warning(f"Ignoring unimplemented reader event {evt}")
+
+def load_snapshot(logger: logging.Logger, config: Config) -> AccessSnapshot:
+    snapshot = AccessSnapshot(logger, config.offline.snapshot)
+    snapshot.load()
+    logger.info(f"Loaded {len(snapshot)} authorized cards from the offline snapshot")
+    return snapshot
+
+def run(config: Config, logger: logging.Logger, strike: Optional[Strike], reader: cardreader.CardReader, config_path: Optional[os.PathLike] = None, strike_method: Optional[str] = None, timer: Optional[StartupTimer] = None) -> None:
+    '''
+    Serve swipes from `reader` until it is closed, then shut down every
+    background component. `benchmarks/replay.py` drives this directly.
+
+    With `config_path`, the config file is reloaded when it changes or on
+    SIGHUP (see config_reload.py). `strike_method` overrides strike.method
+    from the config, as --strike does. `timer` holds the phases of startup
+    so far, for the "Ready for swipes" log line.
+
+    The decision daemon also runs this, with a DecisionServer as `reader`
+    and no strike.
+    '''
+    if timer is None:
+        timer = StartupTimer()
+
+    # these only read their own files, so they are loaded side by side
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix='startup') as pool:
+        snapshot_future = pool.submit(timer.call, 'snapshot', load_snapshot, logger, config)
+        policy_future = pool.submit(timer.call, 'policy', PolicyEngine, logger, config.access.policy, config.access.allowed_groups)
+        writeback_future = pool.submit(timer.call, 'writeback', LCCWriteback, logger, config.writeback.path, lambda: sync.client, config.writeback.max_backoff)
+        audit_future = pool.submit(timer.call, 'audit', make_audit_log, logger, config)
+        snapshot, policy, writeback, audit = snapshot_future.result(), policy_future.result(), writeback_future.result(), audit_future.result()
+
+    policy.start()
 
-            account = Utils.get_account_from_ipa(id, lcc, logger, client, config)
+    # loads the on-disk cache, then logs in to IPA, all in the background.
+    # Swipes are served from IPA lookups and the offline snapshot until the
+    # cache is loaded, and from the cache and the snapshot until IPA is up.
+    cache = AccessCache(logger, ttl=config.cache.ttl, max_entries=config.cache.max_entries, path=config.cache.path)
+    sync = SyncWorker(logger, config, cache, snapshot, writeback, policy)
+    replicator = None
+    if config.replication.listen:
+        # only the elected node syncs with IPA, the others get its results
+        # and a restarted node catches up from its peers
+        replicator = Replicator(logger, config.replication, cache, on_merge=sync.replicated, on_leader=sync.refresh)
+        sync.leader = replicator.is_leader
+        replicator.start()
+    sync.start()
+    writeback.start()
 
-            # If the account instantiation fails, restart the connection to the IPA server and try again.
-            if not account:
-                logger.info("Restarting connection to IPA server and trying to instantiate the account again...")
+    if audit is not None:
+        audit.start()
 
-                client = Utils.setup_ipa_client(logger, config)
+    negative_cache, reader_limiter, card_limiter = make_limiters(config)
 
-                account = Utils.get_account_from_ipa(id, lcc, logger, client, config)
+    metrics = Metrics()
+    decider = Decider(logger, config, cache, snapshot, sync, writeback, metrics, negative_cache, reader_limiter, card_limiter, policy)
+    watchdog, profiler = make_diagnostics(logger, config, metrics)
 
-            if account and account.has_access:
-                logger.info(f"Access granted to {account.netid}")
-                strike.strike()
+    def decide(evt: cardreader.SwipeEvent) -> Decision:
+        with watchdog.busy(f"Lookup of ID: {evt.id} from reader {evt.reader}"):
+            return decider.decide(evt)
+
+    def handle_decision(evt: cardreader.SwipeEvent, decision: Decision) -> None:
+        with watchdog.busy(f"Acting on the decision for ID: {evt.id} at reader {evt.reader}"):
+            if isinstance(evt, RemoteSwipeEvent):
+                # the door node acts on it, everything else here is bookkeeping
+                evt.reply(decision)
+            # either may be replaced by a config reload while this runs
+            act_on_decision(logger, metrics, strike, audit, evt, decision)
+
+    pipeline = SwipePipeline(logger, decide, handle_decision, workers=config.pipeline.workers, max_pending=config.pipeline.max_pending, debounce=config.pipeline.debounce)
+
+    metrics.add_collector('gatekeeper_cache', cache.stats)
+    metrics.add_collector('gatekeeper_sync', sync.stats)
+    metrics.add_collector('gatekeeper_ipa', lambda: sync.client.stats() if sync.client else {})
+    metrics.add_collector('gatekeeper_ipa_replica', lambda: sync.client.replica_stats() if sync.client else {}, labelname='replica')
+    metrics.add_collector('gatekeeper_writeback', writeback.stats)
+    metrics.add_collector('gatekeeper_pipeline', pipeline.stats)
+    metrics.add_collector('gatekeeper_policy', policy.stats)
+    # these components may be disabled or replaced by a config reload
+    metrics.add_collector('gatekeeper_negative_cache', lambda: decider.negative_cache.stats() if decider.negative_cache else {})
+    metrics.add_collector('gatekeeper_reader_ratelimit', lambda: decider.reader_limiter.stats() if decider.reader_limiter else {})
+    metrics.add_collector('gatekeeper_card_ratelimit', lambda: decider.card_limiter.stats() if decider.card_limiter else {})
+    metrics.add_collector('gatekeeper_audit', lambda: audit.stats() if audit else {})
+    if isinstance(reader, DecisionServer):
+        metrics.add_collector('gatekeeper_daemon', reader.stats)
+    if replicator is not None:
+        metrics.add_collector('gatekeeper_replication', replicator.stats)
+    metrics_server = None
+    if config.metrics.port:
+        metrics_server = MetricsServer(metrics, logger, config.metrics.host, config.metrics.port, profiler if config.diagnostics.profile_endpoint else None)
+        metrics_server.start()
+
+    def apply_config(old: Config, new: Config) -> None:
+        '''
+        Rebuild the components whose config sections changed. Everything that
+        can fail is built first, so an error leaves the running ones alone. If
+        a later step fails anyway, the reloader is told which sections did
+        take effect.
+        '''
+        # sections of `new` in effect
+        applied = set()
+        try:
+            _apply_config(old, new, applied)
+        except Exception as e:
+            raise ConfigPartlyApplied(replace(old, **{section: getattr(new, section) for section in applied})) from e
+
+    def _apply_config(old: Config, new: Config, applied: set) -> None:
+        nonlocal strike, audit, metrics_server
+        changed = set(changed_sections(old, new))
+        method = strike_method or new.strike.method
+        # only the hold time can change without a new strike
+        rebuild_strike = 'strike' in changed and strike is not None and replace(old.strike, hold_time=0, method=strike_method or old.strike.method) != replace(new.strike, hold_time=0, method=method)
+
+        new_policy = None
+        if 'access' in changed:
+            new_policy = load_policy(new.access.policy) if new.access.policy else default_policy(frozenset(new.access.allowed_groups))
+        new_audit = make_audit_log(logger, new) if 'audit' in changed else audit
+        new_strike = None
+        if rebuild_strike and method != 'arduino':
+            # an ArduinoStrike is only created once the old one let go of the
+            # serial port, it finds the Arduino in the background and never raises
+            new_strike = get_strike_for_method(method, logger, new.strike)
+        if 'readers' in changed:
+            if isinstance(reader, DecisionServer):
+                # the card readers belong to the door nodes
+                logger.warning("[reader] sections are ignored by the decision daemon")
             else:
-                logger.info(f"Denied access to ID: {id} LCC: {lcc}")
-        elif isinstance(evt, cardreader.InvalidDataEvent):
-            logger.warning(f"Invalid data received from card reader: {evt.data}", exc_info=evt.exc_info)
-        else:
-            logger.warning(f"Ignoring unimplemented reader event {evt}")
+                reader.reconfigure(new.readers)
+            applied.add('readers')
 
-    Utils.exit(logger)
+        # from here on nothing is expected to raise
+        sync.config = decider.config = new
+        if new_policy is not None:
+            policy.replace(new.access.policy, new_policy)
+        if 'credentials' in changed or 'ipa' in changed or 'access' in changed:
+            # logs in again in the background; lookups use the current
+            # session until that succeeds
+            sync.refresh(reconnect='credentials' in changed or 'ipa' in changed)
+        if 'cache' in changed:
+            cache.ttl, cache.max_entries, cache.path = new.cache.ttl, new.cache.max_entries, new.cache.path
+        if 'negative_cache' in changed or 'ratelimit' in changed:
+            negative_cache, reader_limiter, card_limiter = make_limiters(new)
+            if 'negative_cache' in changed:
+                decider.negative_cache = negative_cache
+            if 'ratelimit' in changed:
+                decider.reader_limiter, decider.card_limiter = reader_limiter, card_limiter
+        if 'offline' in changed and new.offline.snapshot != old.offline.snapshot:
+            snapshot.path = new.offline.snapshot
+            snapshot.load()
+        if 'writeback' in changed:
+            writeback.path, writeback.max_backoff = new.writeback.path, new.writeback.max_backoff
+        if 'pipeline' in changed:
+            pipeline.debounce = new.pipeline.debounce
+            if (new.pipeline.workers, new.pipeline.max_pending) != (old.pipeline.workers, old.pipeline.max_pending):
+                logger.warning("pipeline.workers and pipeline.max_pending take effect after a restart")
+        if 'logging' in changed:
+            logger.warning("logging.log takes effect after a restart")
+        if 'remote' in changed or 'replication' in changed:
+            logger.warning("[remote] and [replication] settings take effect after a restart")
+        # including the sections the components read from the config
+        applied.update(changed - {'audit', 'strike', 'diagnostics', 'metrics'})
+
+        if 'audit' in changed:
+            if new_audit is not None:
+                new_audit.start()
+            old_audit, audit = audit, new_audit
+            if old_audit is not None:
+                old_audit.close()
+            applied.add('audit')
+
+        if rebuild_strike:
+            old_strike = strike
+            if new_strike is None:
+                old_strike.close()
+                strike = get_strike_for_method(method, logger, new.strike)
+            else:
+                strike = new_strike
+                old_strike.close()
+        elif 'strike' in changed and strike is not None:
+            strike.hold_time = new.strike.hold_time
+        applied.add('strike')
+
+        if 'diagnostics' in changed:
+            watchdog.threshold = new.diagnostics.stall_threshold
+            profiler.interval, profiler.seconds, profiler.directory = new.diagnostics.profile_interval, new.diagnostics.profile_seconds, new.diagnostics.profile_dir
+            applied.add('diagnostics')
+
+        if 'metrics' in changed or new.diagnostics.profile_endpoint != old.diagnostics.profile_endpoint:
+            if metrics_server is not None:
+                metrics_server.stop()
+                metrics_server = None
+            if new.metrics.port:
+                try:
+                    metrics_server = MetricsServer(metrics, logger, new.metrics.host, new.metrics.port, profiler if new.diagnostics.profile_endpoint else None)
+                    metrics_server.start()
+                except OSError as e:
+                    logger.error(f"Unable to serve metrics at {new.metrics.host}:{new.metrics.port}", exc_info=e)
+        applied.add('metrics')
+
+    reloader = None
+    if config_path is not None:
+        reloader = ConfigReloader(logger, config_path, config, apply_config)
+        reloader.start()
+        metrics.add_collector('gatekeeper_config', reloader.stats)
+        signal.signal(signal.SIGHUP, lambda sig, frame: reloader.request())
+
+    logger.info(f"Ready for swipes {timer.elapsed() * 1000:.0f}ms after start ({timer.summary()})")
+    serve(logger, reader, pipeline, metrics, watchdog)
+
+    if reloader is not None:
+        reloader.stop()
+    pipeline.shutdown()
+    watchdog.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    writeback.stop()
+    if replicator is not None:
+        replicator.stop()
+    sync.stop()
+    policy.stop()
+    # saving before the load finished would overwrite the file with less
+    if sync.cache_loaded.is_set():
+        cache.save()
+    if audit is not None:
+        audit.close()
+
+def run_door(config: Config, logger: logging.Logger, strike: Strike, reader: cardreader.CardReader, timer: Optional[StartupTimer] = None) -> None:
+    '''
+    Serve swipes from `reader` as a door node: the decision daemon at
+    remote.connect decides them, see remote.py. Door nodes do not reload
+    their config, restarting one takes well under a second.
+    '''
+    if timer is None:
+        timer = StartupTimer()
+
+    # decides swipes while the daemon is unreachable
+    snapshot = timer.call('snapshot', load_snapshot, logger, config)
+    remote = RemoteDecider(logger, config, snapshot)
+    remote.start()
+
+    audit = make_audit_log(logger, config)
+    if audit is not None:
+        audit.start()
+
+    metrics = Metrics()
+    watchdog, profiler = make_diagnostics(logger, config, metrics)
+
+    def decide(evt: cardreader.SwipeEvent) -> Decision:
+        with watchdog.busy(f"Remote decision for ID: {evt.id} from reader {evt.reader}"):
+            decision = remote.decide(evt)
+        metrics.lookup_seconds.observe(decision.lookup_seconds)
+        return decision
+
+    def handle_decision(evt: cardreader.SwipeEvent, decision: Decision) -> None:
+        with watchdog.busy(f"Acting on the decision for ID: {evt.id} at reader {evt.reader}"):
+            act_on_decision(logger, metrics, strike, audit, evt, decision)
+
+    pipeline = SwipePipeline(logger, decide, handle_decision, workers=config.pipeline.workers, max_pending=config.pipeline.max_pending, debounce=config.pipeline.debounce)
+
+    metrics.add_collector('gatekeeper_remote', remote.stats)
+    metrics.add_collector('gatekeeper_pipeline', pipeline.stats)
+    metrics_server = None
+    if config.metrics.port:
+        metrics_server = MetricsServer(metrics, logger, config.metrics.host, config.metrics.port, profiler if config.diagnostics.profile_endpoint else None)
+        metrics_server.start()
+
+    logger.info(f"Ready for swipes {timer.elapsed() * 1000:.0f}ms after start ({timer.summary()}), deciding them at {config.remote.connect}")
+    serve(logger, reader, pipeline, metrics, watchdog)
+
+    pipeline.shutdown()
+    watchdog.stop()
+    remote.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    if audit is not None:
+        audit.close()
 
 if __name__ == "__main__":
     # Catch any exceptions that bubble up all the way through `main` to make
@@ -0,0 +1,229 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from diagnostics import SamplingProfiler, format_folded
+import bisect
+import logging
+import math
+import threading
+
+'''
+Module for swipe timing and counters, served in the Prometheus text format.
+
+Recording is a lock, a bisect and a few additions, so the swipe path pays
+well under a microsecond per observation. Rendering happens on the metrics
+server's thread when the endpoint is scraped.
+
+Stages of a swipe:
+
+    gatekeeper_read_seconds       first keystroke -> swipe parsed (rawkbd readers only)
+    gatekeeper_lookup_seconds     cache / IPA / offline decision for the swipe
+    gatekeeper_decision_seconds   swipe parsed -> decision acted on, including queueing
+    gatekeeper_actuation_seconds  strike.strike() call
+
+Stats of other components (cache, sync, write-back, ...) are exported as
+gauges through collectors.
+'''
+
+# seconds, tuned for swipes: cache hits take microseconds, IPA round trips
+# tens of milliseconds, timeouts seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    '''
+    Monotonically increasing count, optionally split by label values.
+    '''
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], int] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues: str) -> int:
+        return self._values.get(labelvalues, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values and not self.labelnames:
+            values = [((), 0)]
+        for labelvalues, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class Histogram:
+    '''
+    Distribution of durations in fixed buckets.
+    '''
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        # one count per bucket, plus one for values above the last bound
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def render(self) -> List[str]:
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.bounds + [math.inf], counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total!r}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+class Metrics:
+    '''
+    All of GateKeeper's metrics.
+    '''
+
+    def __init__(self) -> None:
+        self.read_seconds = Histogram('gatekeeper_read_seconds', 'Time from the first keystroke of a swipe to the parsed swipe event.')
+        self.lookup_seconds = Histogram('gatekeeper_lookup_seconds', 'Time to decide a swipe from the cache, IPA or the offline policy.')
+        self.decision_seconds = Histogram('gatekeeper_decision_seconds', 'Time from the parsed swipe event to acting on its decision.')
+        self.actuation_seconds = Histogram('gatekeeper_actuation_seconds', 'Time spent in strike.strike().')
+
+        self.swipes = Counter('gatekeeper_swipes_total', 'Swipes by decision and how it was made.', ('decision', 'source'))
+        self.invalid_reads = Counter('gatekeeper_invalid_reads_total', 'Card reader input that was not a valid swipe.', ('reader',))
+
+        self._metrics = [
+            self.read_seconds, self.lookup_seconds, self.decision_seconds, self.actuation_seconds,
+            self.swipes, self.invalid_reads,
+        ]
+        self._collectors: List[Tuple[str, Callable[[], dict], Optional[str]]] = []
+
+    def add_collector(self, prefix: str, stats: Callable[[], dict], labelname: Optional[str] = None) -> None:
+        '''
+        Export every numeric value of `stats()` as a gauge named
+        `<prefix>_<key>` when the metrics are rendered. With `labelname`,
+        `stats()` returns a dict of stats per label value instead.
+        '''
+        self._collectors.append((prefix, stats, labelname))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        for prefix, stats, labelname in self._collectors:
+            try:
+                values = stats()
+            except Exception:
+                continue
+            if labelname is None:
+                values = {None: values}
+
+            samples: Dict[str, List[str]] = {}
+            for labelvalue, group in values.items():
+                labels = _format_labels((labelname,), (str(labelvalue),)) if labelname is not None else ''
+                for key, value in group.items():
+                    if isinstance(value, bool) or not isinstance(value, (int, float)):
+                        continue
+                    samples.setdefault(f"{prefix}_{key}", []).append(f"{prefix}_{key}{labels} {_format_value(value)}")
+            for name, sample_lines in samples.items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(sample_lines)
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer:
+    '''
+    Serves `Metrics.render()` at /metrics from a background thread. With a
+    `profiler`, also serves profiles at /debug/profile?seconds=N, see
+    diagnostics.py.
+    '''
+
+    # longest profile that can be requested
+    MAX_PROFILE_SECONDS = 300.0
+
+    def __init__(self, metrics: Metrics, logger: logging.Logger, host: str, port: int, profiler: Optional[SamplingProfiler] = None) -> None:
+        self.metrics = metrics
+        self.logger = logger
+
+        # http.server pulls in http.client, email and ssl, about a third of
+        # GateKeeper's import time, so it is only imported with metrics on
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlsplit
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/metrics':
+                    self.reply(metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+                elif url.path == '/debug/profile' and profiler is not None:
+                    try:
+                        seconds = float(parse_qs(url.query).get('seconds', [profiler.seconds])[0])
+                    except ValueError:
+                        self.send_error(400, 'seconds must be a number')
+                        return
+                    if not 0 < seconds <= MetricsServer.MAX_PROFILE_SECONDS:
+                        self.send_error(400, f"seconds must be between 0 and {MetricsServer.MAX_PROFILE_SECONDS:g}")
+                        return
+                    # samples on this request's thread
+                    counts = profiler.profile(seconds)
+                    if counts is None:
+                        self.send_error(409, 'A profile is already being taken')
+                        return
+                    self.reply(format_folded(counts), 'text/plain; charset=utf-8')
+                else:
+                    self.send_error(404)
+
+            def reply(self, text: str, content_type: str) -> None:
+                body = text.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+        self.profiling = profiler is not None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        host, port = self.httpd.server_address[:2]
+        self.logger.info(f"Serving metrics at http://{host}:{port}/metrics{f' and profiles at http://{host}:{port}/debug/profile' if self.profiling else ''}")
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
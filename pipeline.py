@@ -0,0 +1,166 @@
+from typing import Callable, Deque, Dict, Optional, Tuple
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
+from cardreader import SwipeEvent
+from decision import Decision
+import logging
+import threading
+import time
+
+'''
+Module for processing swipes concurrently while keeping each door in order.
+
+Swipes flow through three stages:
+
+    reader thread --submit()--> lookup workers --> in-order delivery --> on_decision
+
+- Lookups (cache, IPA, offline policy) run on a fixed pool of worker threads,
+  so a slow IPA request only holds up its own swipe.
+- While a lookup for a card (ID and LCC) at a reader is in flight, more
+  swipes of the same card there wait on that lookup instead of starting their
+  own. The policy may decide differently at another door, so swipes at other
+  readers get their own.
+- A card swiped again at the same reader within `debounce` seconds of its
+  decision, or while that decision is still pending, is a duplicate: it gets
+  the same decision without a lookup, marked with source 'duplicate'.
+- Decisions are delivered in swipe order per reader: a later swipe at a door
+  is never acted on before an earlier one. Doors do not wait on each other.
+- At most max_pending swipes are in the pipeline at a time. Beyond that,
+  submit() blocks the reader thread until a swipe is delivered.
+'''
+
+DecisionHandler = Callable[[SwipeEvent, Decision], None]
+
+class SwipePipeline:
+    '''
+    Bounded, per-door ordered pipeline from swipes to decisions.
+    '''
+
+    def __init__(self, logger: logging.Logger, decide: Callable[[SwipeEvent], Decision], on_decision: DecisionHandler, workers: int, max_pending: int, debounce: float = 0.0) -> None:
+        self.logger = logger
+        self.decide = decide
+        self.on_decision = on_decision
+        # seconds a decision answers repeat swipes of the card at its reader, 0 to disable
+        self.debounce = debounce
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lookup')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+        # guards _in_flight, _doors and _recent
+        self._lock = threading.Lock()
+        # (reader, id, lcc) -> lookup in flight
+        self._in_flight: Dict[Tuple[Optional[str], str, str], Future] = {}
+        # swipes per reader in arrival order, waiting for their lookups, and
+        # whether each is a duplicate of an earlier one
+        self._doors: Dict[Optional[str], Deque[Tuple[SwipeEvent, Future, bool]]] = defaultdict(deque)
+        # (reader, id, lcc) -> (decision, monotonic time it was made), oldest first
+        self._recent: 'OrderedDict[Tuple[Optional[str], str, str], Tuple[Decision, float]]' = OrderedDict()
+        # only one thread delivers at a time, which keeps each door in order
+        self._deliver_lock = threading.Lock()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.duplicates = 0
+
+    def submit(self, evt: SwipeEvent) -> None:
+        self._slots.acquire()
+
+        key = (evt.reader, evt.id, evt.lcc)
+        started = False
+        with self._lock:
+            self.submitted += 1
+            future = self._duplicate_of(evt) if self.debounce else None
+            duplicate = future is not None
+            if duplicate:
+                self.duplicates += 1
+            else:
+                future = self._in_flight.get(key)
+                started = future is None
+                if started:
+                    future = self._executor.submit(self.decide, evt)
+                    self._in_flight[key] = future
+                else:
+                    self.coalesced += 1
+            self._doors[evt.reader].append((evt, future, duplicate))
+
+        # outside the lock: a lookup that already finished runs its callbacks
+        # right here, and _forget takes the lock
+        if started:
+            future.add_done_callback(lambda f, key=key: self._forget(key, f))
+        future.add_done_callback(lambda _, door=evt.reader: self._drain(door))
+
+    def shutdown(self) -> None:
+        '''
+        Wait for every submitted swipe to be delivered.
+        '''
+        self._executor.shutdown(wait=True)
+
+    def _forget(self, key: Tuple[Optional[str], str, str], future: Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _drain(self, door: Optional[str]) -> None:
+        with self._deliver_lock:
+            queue = self._doors[door]
+            while queue and queue[0][1].done():
+                with self._lock:
+                    evt, future, duplicate = queue.popleft()
+                self._deliver(evt, future, duplicate)
+                self._slots.release()
+
+    def _duplicate_of(self, evt: SwipeEvent) -> Optional[Future]:
+        '''
+        If the swipe repeats one at the same reader that is still waiting to
+        be delivered or was decided within the debounce window, the future
+        of that decision. Called under _lock.
+        '''
+        for queued, future, _ in reversed(self._doors[evt.reader]):
+            if queued.id == evt.id and queued.lcc == evt.lcc:
+                return future
+
+        now = time.monotonic()
+        recent = self._recent
+        # drop expired decisions, oldest first
+        while recent:
+            _, (_, decided_at) = next(iter(recent.items()))
+            if now - decided_at < self.debounce:
+                break
+            recent.popitem(last=False)
+
+        entry = recent.get((evt.reader, evt.id, evt.lcc))
+        if entry is None:
+            return None
+        future = Future()
+        future.set_result(entry[0])
+        return future
+
+    def _deliver(self, evt: SwipeEvent, future: Future, duplicate: bool) -> None:
+        try:
+            decision = future.result()
+        except Exception as e:
+            self.logger.error(f"Lookup for ID: {evt.id} LCC: {evt.lcc} failed. Denying access.", exc_info=e)
+            decision = Decision(granted=False, source='error', reason='lookup_error')
+
+        if duplicate and decision.source != 'error':
+            decision = replace(decision, source='duplicate', lookup_seconds=None)
+        elif self.debounce and decision.source != 'error':
+            # errors are not repeated, the next swipe gets a fresh lookup
+            with self._lock:
+                key = (evt.reader, evt.id, evt.lcc)
+                self._recent.pop(key, None)
+                self._recent[key] = (decision, time.monotonic())
+
+        try:
+            self.on_decision(evt, decision)
+        except Exception as e:
+            self.logger.error(f"Handling the decision for ID: {evt.id} failed", exc_info=e)
+
+    def stats(self) -> dict:
+        return {
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'duplicates': self.duplicates,
+            'in_flight': len(self._in_flight),
+        }
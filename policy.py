@@ -0,0 +1,400 @@
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+from dataclasses import dataclass
+from access_cache import GROUPS
+import bisect
+import configparser
+import functools
+import logging
+import os
+import re
+import threading
+import time
+
+'''
+Module for the access policy: which groups and users may open which door,
+and when.
+
+The policy is an INI file:
+
+    [holidays]
+    # days on which only rules with on_holidays = yes apply
+    dates = 2024-12-25, 2025-01-01
+
+    [rule:members]
+    groups = users, admins
+    # reader names, * for every reader (default)
+    doors = *
+    # days of the week, ranges allowed (default: every day)
+    days = mon-sun
+    # local times HH:MM-HH:MM, several separated by commas (default: all day).
+    # A window ending before it starts runs past midnight into the next day.
+    hours = 00:00-24:00
+    # whether the rule also applies on holidays (default: yes)
+    on_holidays = yes
+
+    [rule:guests-daytime]
+    groups = guests
+    doors = default
+    days = mon-fri
+    hours = 08:00-22:00
+    on_holidays = no
+
+    [user:abc1234]
+    # allow or deny this user regardless of groups and schedule
+    access = deny
+    doors = *
+
+Rules only ever grant access. A swipe is allowed if an override of the user
+allows it at that door, or if no override denies it and a rule for the
+door, day and time lists one of the user's groups. Without a policy file,
+the policy is a single rule granting `access.allowed_groups` everywhere, at
+any time.
+
+Compiled form: every group named by a rule gets a bit. For every door and
+day type (the seven weekdays, and the seven weekdays as holidays) the day
+is cut into intervals at every rule boundary, and each interval holds the
+mask of groups allowed in it. The part of a window after midnight goes into
+the next day's table. A holiday only narrows the rules of its weekday to
+those with on_holidays. A decision is a bisect over the day's boundaries
+and an AND with the user's group mask, however many rules there are. The user's mask is looked
+up from their AccessEntry's group mask, once per distinct set of groups.
+'''
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# added to the weekday for the tables of holidays
+HOLIDAY = 7
+MINUTES_PER_DAY = 24 * 60
+
+class PolicyError(Exception):
+    '''
+    Raised when a policy file is invalid.
+    '''
+
+class Match(NamedTuple):
+    allowed: bool
+    # name of the rule or override that decided, None if none did
+    rule: Optional[str]
+    # e.g. 'rule:members', 'user:abc1234', 'not_in_allowed_group'
+    reason: str
+
+@dataclass
+class _Rule:
+    name: str
+    groups: List[str]
+    # None for every door
+    doors: Optional[FrozenSet[str]]
+    days: Set[int]
+    # (start, end) in minutes since midnight, end exclusive. An end past
+    # MINUTES_PER_DAY runs into the next day
+    hours: List[Tuple[int, int]]
+    on_holidays: bool
+
+@dataclass
+class _Override:
+    name: str
+    allow: bool
+    doors: Optional[FrozenSet[str]]
+
+class _DayTable(NamedTuple):
+    # start minute of every interval, the first is always 0
+    bounds: List[int]
+    # mask of the groups allowed in each interval
+    masks: List[int]
+    # per interval: bit -> name of the first rule granting that group
+    rules: List[Dict[int, str]]
+
+def _parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def _parse_doors(value: Optional[str]) -> Optional[FrozenSet[str]]:
+    doors = _parse_list(value or '*')
+    return None if '*' in doors else frozenset(doors)
+
+def _parse_days(value: Optional[str]) -> Set[int]:
+    if not value:
+        return set(range(7))
+    days = set()
+    for item in _parse_list(value.lower()):
+        first, _, last = item.partition('-')
+        if first not in DAYS or (last and last not in DAYS):
+            raise PolicyError(f"Invalid day '{item}', expected one of {DAYS} or a range like mon-fri")
+        start, end = DAYS.index(first), DAYS.index(last or first)
+        # ranges may wrap around the week, e.g. fri-mon
+        i = start
+        while True:
+            days.add(i)
+            if i == end:
+                break
+            i = (i + 1) % 7
+    return days
+
+def _parse_minutes(value: str) -> int:
+    match = re.fullmatch(r'(\d{1,2}):(\d\d)', value.strip())
+    if not match or int(match.group(1)) > 24 or int(match.group(2)) > 59 or (int(match.group(1)) == 24 and int(match.group(2))):
+        raise PolicyError(f"Invalid time '{value}', expected HH:MM")
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+def _parse_hours(value: Optional[str]) -> List[Tuple[int, int]]:
+    if not value:
+        return [(0, MINUTES_PER_DAY)]
+    hours = []
+    for item in _parse_list(value):
+        start, sep, end = item.partition('-')
+        if not sep:
+            raise PolicyError(f"Invalid hours '{item}', expected HH:MM-HH:MM")
+        start, end = _parse_minutes(start), _parse_minutes(end)
+        if start < end:
+            hours.append((start, end))
+        elif start > end:
+            hours.append((start, MINUTES_PER_DAY + end))
+    return hours
+
+class Policy:
+    '''
+    A compiled policy. Immutable, so it can be swapped while swipes are
+    being checked against the old one.
+    '''
+
+    def __init__(self, rules: List[_Rule], overrides: Dict[str, List[_Override]], holidays: Set[str], source: str) -> None:
+        self.source = source
+        self.holidays = frozenset(holidays)
+        self.overrides = overrides
+        self.rule_names = [rule.name for rule in rules]
+
+        self.group_bits: Dict[str, int] = {}
+        for rule in rules:
+            for group in rule.groups:
+                self.group_bits.setdefault(group, 1 << len(self.group_bits))
+        # every group a rule grants access to, at some door at some time
+        self.groups: Set[str] = set(self.group_bits)
+        # (GROUPS bit, policy bit) of every group, and AccessEntry.group_mask
+        # -> policy mask, filled in by the swipes
+        self._entry_bits = [(GROUPS.bit(group), bit) for group, bit in self.group_bits.items()]
+        self._entry_masks: Dict[int, int] = {}
+
+        doors = {door for rule in rules if rule.doors for door in rule.doors}
+        # None holds the table for doors no rule names
+        self._tables: Dict[Optional[str], List[_DayTable]] = {
+            door: [self._compile_day(rules, door, day) for day in range(2 * HOLIDAY)]
+            for door in list(doors) + [None]
+        }
+
+    def _compile_day(self, rules: List[_Rule], door: Optional[str], day: int) -> _DayTable:
+        # (rule, its windows on this day) of every rule open at some time of it
+        applicable = []
+        for rule in rules:
+            if not (rule.doors is None or (door is not None and door in rule.doors)):
+                continue
+            weekday = day % HOLIDAY
+            today, yesterday = weekday in rule.days, (weekday - 1) % 7 in rule.days
+            if day >= HOLIDAY and not rule.on_holidays:
+                today = yesterday = False
+            spans = [(s, min(e, MINUTES_PER_DAY)) for s, e in rule.hours] if today else []
+            if yesterday:
+                # the rest of windows that started before midnight
+                spans += [(0, e - MINUTES_PER_DAY) for s, e in rule.hours if e > MINUTES_PER_DAY]
+            if spans:
+                applicable.append((rule, spans))
+
+        bounds = sorted({0} | {m for _, spans in applicable for span in spans for m in span if m < MINUTES_PER_DAY})
+        table = _DayTable([], [], [])
+        for start in bounds:
+            mask, first_rule = 0, {}
+            for rule, spans in applicable:
+                if any(s <= start < e for s, e in spans):
+                    for group in rule.groups:
+                        bit = self.group_bits[group]
+                        mask |= bit
+                        first_rule.setdefault(bit, rule.name)
+            if table.masks and table.masks[-1] == mask and table.rules[-1] == first_rule:
+                # same as the previous interval, extend that instead
+                continue
+            table.bounds.append(start)
+            table.masks.append(mask)
+            table.rules.append(first_rule)
+        return table
+
+    def group_mask(self, groups: Iterable[str]) -> int:
+        bits = self.group_bits
+        mask = 0
+        for group in groups:
+            mask |= bits.get(group, 0)
+        return mask
+
+    def entry_mask(self, group_mask: int) -> int:
+        '''
+        The policy mask of an AccessEntry.group_mask.
+        '''
+        mask = self._entry_masks.get(group_mask)
+        if mask is None:
+            mask = 0
+            for entry_bit, bit in self._entry_bits:
+                if group_mask & entry_bit:
+                    mask |= bit
+            self._entry_masks[group_mask] = mask
+        return mask
+
+    def check(self, uid: str, groups: Union[int, Iterable[str]], door: Optional[str] = None, when: Optional[float] = None) -> Match:
+        '''
+        Whether the user may open the door at time `when` (default: now), and
+        which rule or override decided it. `groups` are group names or an
+        AccessEntry.group_mask.
+        '''
+        for override in self.overrides.get(uid, ()):
+            if override.doors is None or door in override.doors:
+                return Match(override.allow, override.name, f"user:{uid}" if override.allow else f"denied_user:{uid}")
+
+        mask = self.entry_mask(groups) if isinstance(groups, int) else self.group_mask(groups)
+        if not mask:
+            return Match(False, None, 'not_in_allowed_group')
+
+        t = time.localtime(when)
+        day = t.tm_wday + HOLIDAY if time.strftime('%Y-%m-%d', t) in self.holidays else t.tm_wday
+        table = (self._tables.get(door) or self._tables[None])[day]
+        i = bisect.bisect_right(table.bounds, t.tm_hour * 60 + t.tm_min) - 1
+
+        allowed = table.masks[i] & mask
+        if not allowed:
+            return Match(False, None, 'no_matching_rule')
+        # the rule granting the user's lowest matching group bit
+        rule = table.rules[i][allowed & -allowed]
+        return Match(True, rule, f"rule:{rule}")
+
+    def always_denied(self, uid: str) -> bool:
+        '''
+        Whether an override denies the user at every door.
+        '''
+        return any(o.doors is None and not o.allow for o in self.overrides.get(uid, ()))
+
+@functools.lru_cache(maxsize=8)
+def default_policy(allowed_groups: FrozenSet[str]) -> Policy:
+    '''
+    The policy without a policy file: `allowed_groups` at every door, at any time.
+    '''
+    rule = _Rule('allowed_groups', sorted(allowed_groups), None, set(range(7)), [(0, MINUTES_PER_DAY)], True)
+    return Policy([rule], {}, set(), 'access.allowed_groups')
+
+def load_policy(path: os.PathLike) -> Policy:
+    '''
+    Parse and compile a policy file. Raises PolicyError if it is invalid.
+    '''
+    cfg = configparser.ConfigParser()
+    try:
+        with open(path) as f:
+            cfg.read_file(f)
+    except (OSError, configparser.Error) as e:
+        raise PolicyError(f"Unable to read policy {path}: {e}")
+
+    rules: List[_Rule] = []
+    overrides: Dict[str, List[_Override]] = {}
+    holidays: Set[str] = set()
+
+    for section in cfg.sections():
+        options = cfg[section]
+        kind, _, name = section.partition(':')
+        if section == 'holidays':
+            for date in _parse_list(options.get('dates', '')):
+                if not re.fullmatch(r'\d{4}-\d\d-\d\d', date):
+                    raise PolicyError(f"Invalid holiday '{date}', expected YYYY-MM-DD")
+                holidays.add(date)
+        elif kind == 'rule' and name:
+            groups = _parse_list(options.get('groups', ''))
+            if not groups:
+                raise PolicyError(f"[{section}] needs at least one group")
+            try:
+                on_holidays = options.getboolean('on_holidays', fallback=True)
+            except ValueError:
+                raise PolicyError(f"[{section}] on_holidays must be yes or no")
+            rules.append(_Rule(name, groups, _parse_doors(options.get('doors')), _parse_days(options.get('days')), _parse_hours(options.get('hours')), on_holidays))
+        elif kind == 'user' and name:
+            access = options.get('access', '').lower()
+            if access not in ('allow', 'deny'):
+                raise PolicyError(f"[{section}] access must be allow or deny")
+            overrides.setdefault(name, []).append(_Override(section, access == 'allow', _parse_doors(options.get('doors'))))
+        else:
+            raise PolicyError(f"Unknown section [{section}], expected [holidays], [rule:NAME] or [user:NETID]")
+
+    return Policy(rules, overrides, holidays, str(path))
+
+class PolicyEngine(threading.Thread):
+    '''
+    Holds the current policy and reloads it when the file changes. A policy
+    that fails to load is logged and the previous one stays in effect.
+    '''
+
+    def __init__(self, logger: logging.Logger, path: Optional[os.PathLike], allowed_groups: Set[str], check_interval: float = 5.0) -> None:
+        super().__init__(name='policy', daemon=True)
+        self.logger = logger
+        self.path = path
+        self.check_interval = check_interval
+        self._stop_event = threading.Event()
+        self._mtime = None
+
+        self.reloads = 0
+        self.reload_failures = 0
+
+        if path is None:
+            self.policy = default_policy(frozenset(allowed_groups))
+        else:
+            # an invalid policy at startup is fatal, there is nothing to fall back to
+            self._mtime = os.stat(path).st_mtime
+            self.policy = load_policy(path)
+            self.logger.info(f"Loaded access policy from {path}: {len(self.policy.rule_names)} rules, {len(self.policy.overrides)} user overrides, {len(self.policy.holidays)} holidays")
+
+    def check(self, uid: str, groups: Iterable[str], door: Optional[str] = None, when: Optional[float] = None) -> Match:
+        return self.policy.check(uid, groups, door, when)
+
+    def reload(self) -> bool:
+        '''
+        Compile the policy file again and swap it in. Returns False if it is
+        invalid.
+        '''
+        if self.path is None:
+            return True
+        try:
+            self._mtime = os.stat(self.path).st_mtime
+            policy = load_policy(self.path)
+        except (OSError, PolicyError) as e:
+            self.reload_failures += 1
+            self.logger.error(f"Keeping the current access policy, the new one is invalid: {e}")
+            return False
+
+        self.policy = policy
+        self.reloads += 1
+        self.logger.info(f"Reloaded access policy from {self.path}: {len(policy.rule_names)} rules, {len(policy.overrides)} user overrides, {len(policy.holidays)} holidays")
+        return True
+
+    def replace(self, path: Optional[os.PathLike], policy: Policy) -> None:
+        '''
+        Swap in a policy compiled from a new path or new allowed groups, after
+        the config changed. `path` is watched from then on.
+        '''
+        try:
+            self._mtime = os.stat(path).st_mtime if path is not None else None
+        except OSError:
+            self._mtime = None
+        self.path = path
+        self.policy = policy
+        self.reloads += 1
+        self.logger.info(f"Replaced access policy{f' from {path}' if path else ''}: {len(policy.rule_names)} rules, {len(policy.overrides)} user overrides, {len(policy.holidays)} holidays")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.check_interval):
+            if self.path is None:
+                continue
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                continue
+            if mtime != self._mtime:
+                self.reload()
+
+    def stats(self) -> dict:
+        return {
+            'rules': len(self.policy.rule_names),
+            'reloads': self.reloads,
+            'reload_failures': self.reload_failures,
+        }
@@ -0,0 +1,116 @@
+from typing import Hashable, Optional, Tuple
+from collections import OrderedDict
+import threading
+import time
+
+'''
+Module for keeping unknown and denied cards, and misbehaving readers, from
+flooding IPA with lookups.
+
+- `NegativeCache` remembers recent denials of a card (ID and LCC) that came
+  from an IPA lookup, so swiping it again is denied without another
+  `user_find` until the entry expires.
+- `RateLimiter` keeps a token bucket per key (a reader name or a card ID).
+  Every IPA lookup takes a token; once a bucket is empty, swipes for its key
+  are denied without a lookup until it refills.
+
+Swipes answered from the access cache never reach either of them, so a
+flood of bad swipes at a reader does not lock out cards the cache knows.
+'''
+
+class NegativeCache:
+    '''
+    Bounded cache of recent denials, keyed by card ID and LCC.
+    '''
+
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # (id, lcc) -> (reason, time.monotonic() of the denial), oldest first
+        self._entries: 'OrderedDict[Tuple[str, str], Tuple[Optional[str], float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, id: str, lcc: str) -> Optional[str]:
+        '''
+        Returns the reason the card was denied if that happened within the
+        TTL, otherwise None.
+        '''
+        with self._lock:
+            entry = self._entries.get((id, lcc))
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[(id, lcc)]
+            self.misses += 1
+            return None
+
+    def put(self, id: str, lcc: str, reason: Optional[str]) -> None:
+        with self._lock:
+            self._entries.pop((id, lcc), None)
+            self._entries[(id, lcc)] = (reason, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class RateLimiter:
+    '''
+    Token buckets holding up to `burst` tokens per key, refilled at `rate`
+    tokens per second. At most `max_keys` buckets are kept; the least
+    recently used are dropped, which only ever makes a key less limited.
+    '''
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+
+        # key -> (tokens, time.monotonic() they were counted at)
+        self._buckets: 'OrderedDict[Hashable, Tuple[float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, key: Hashable) -> bool:
+        '''
+        Take a token from the key's bucket. Returns False if it is empty.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            tokens, counted_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - counted_at) * self.rate)
+            ok = tokens >= 1
+            if ok:
+                tokens -= 1
+                self.allowed += 1
+            else:
+                self.limited += 1
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return ok
+
+    def stats(self) -> dict:
+        return {
+            'keys': len(self._buckets),
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
@@ -0,0 +1,617 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from cardreader import CardReader, InvalidDataEvent, ReaderEvent, SwipeEvent
+from decision import Decision
+from snapshot import AccessSnapshot
+from config import Config
+from utils import Utils
+import hashlib
+import hmac
+import itertools
+import logging
+import math
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+
+'''
+Module for splitting GateKeeper into one decision daemon and many door nodes.
+
+The daemon (remote.role = daemon) owns the IPA client, the access cache, the
+policy and the audit log. Door nodes (remote.role = door) only run their card
+readers and strike and send every swipe to the daemon, which answers with the
+decision. Without a [remote] section GateKeeper runs standalone as before.
+
+Each door node keeps one persistent connection (TCP or a Unix socket) to the
+daemon and pipelines its swipes over it: a request does not wait for the
+answer to the previous one, and answers carry the request's ID so they may
+come back in any order. The daemon serves every connection from a single
+thread with `selectors` (epoll on Linux) and hands the swipes to the same
+SwipePipeline as local card readers, so it keeps each door in order.
+
+Wire format, big-endian. Every message is a frame:
+
+    u32 length of the rest of the frame
+    u8  message type
+    u32 request ID, chosen by the door node
+    ... the message
+    32 bytes HMAC-SHA256 of everything before it
+
+    HELLO (door -> daemon, then daemon -> door), request ID 0:
+        16 random bytes, the sender's nonce
+
+    SWIPE (door -> daemon):
+        u8 length + id, u8 length + lcc, u8 length + reader name (utf-8)
+        f64 read_seconds, NaN if unknown
+
+    DECISION (daemon -> door):
+        u8 granted
+        u8 length + source, u8 length + reason, u8 length + netid (utf-8,
+        empty for None)
+
+A connection starts with the two HELLOs, signed with `remote.secret`. Every
+later frame is signed with HMAC-SHA256(remote.secret, door nonce + daemon
+nonce), so frames recorded from another connection do not verify, and the
+daemon only takes increasing request IDs on a connection. A frame that does
+not verify closes the connection. Frames are not encrypted. Without a secret
+the addresses must be unix: sockets or loopback (see config.py), where only
+this host can connect.
+
+If the daemon cannot be reached or does not answer within remote.timeout, a
+door node decides the swipe by its offline policy, from its own snapshot file
+if it has one.
+'''
+
+MSG_SWIPE = 1
+MSG_DECISION = 2
+MSG_HELLO = 3
+
+FRAME_HEADER = struct.Struct('!IBI')
+READ_SECONDS = struct.Struct('!d')
+MAC_SIZE = hashlib.sha256().digest_size
+NONCE_SIZE = 16
+# far larger than any valid message, a longer frame means the stream is corrupt
+MAX_FRAME = 4096
+
+class ProtocolError(Exception):
+    '''
+    Raised when a peer sends a frame that does not decode.
+    '''
+
+def parse_address(address: str) -> Tuple[int, object]:
+    '''
+    Socket family and address for `unix:/path` or `host:port`.
+    '''
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f"Expected unix:/path or host:port, got {address!r}")
+    host = host.strip('[]')
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+def _pack_str(value: Optional[str]) -> bytes:
+    data = (value or '').encode()
+    if len(data) > 255:
+        raise ValueError(f"{value!r} is too long to send")
+    return bytes((len(data),)) + data
+
+def _unpack_str(payload: bytes, offset: int) -> Tuple[str, int]:
+    end = offset + 1 + payload[offset]
+    if end > len(payload):
+        raise ProtocolError('string runs past the end of the frame')
+    return str(payload[offset + 1:end], 'utf-8'), end
+
+def _frame(key: bytes, type: int, request_id: int, body: bytes) -> bytes:
+    data = FRAME_HEADER.pack(FRAME_HEADER.size - 4 + len(body) + MAC_SIZE, type, request_id) + body
+    return data + hmac.digest(key, data, 'sha256')
+
+def _session_key(secret: bytes, door_nonce: bytes, daemon_nonce: bytes) -> bytes:
+    return hmac.digest(secret, door_nonce + daemon_nonce, 'sha256')
+
+def encode_swipe(key: bytes, request_id: int, evt: SwipeEvent) -> bytes:
+    read_seconds = math.nan if evt.read_seconds is None else evt.read_seconds
+    return _frame(key, MSG_SWIPE, request_id, _pack_str(evt.id) + _pack_str(evt.lcc) + _pack_str(evt.reader) + READ_SECONDS.pack(read_seconds))
+
+def encode_decision(key: bytes, request_id: int, decision: Decision) -> bytes:
+    return _frame(key, MSG_DECISION, request_id, bytes((decision.granted,)) + _pack_str(decision.source) + _pack_str(decision.reason) + _pack_str(decision.netid))
+
+def decode_swipe(payload: bytes) -> Tuple[str, str, str, Optional[float]]:
+    '''
+    (id, lcc, reader, read_seconds) from the body of a SWIPE frame.
+    '''
+    try:
+        id, offset = _unpack_str(payload, 0)
+        lcc, offset = _unpack_str(payload, offset)
+        reader, offset = _unpack_str(payload, offset)
+        read_seconds, = READ_SECONDS.unpack_from(payload, offset)
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise ProtocolError(f"malformed swipe: {e}")
+    return id, lcc, reader, None if math.isnan(read_seconds) else read_seconds
+
+def decode_decision(payload: bytes) -> Decision:
+    try:
+        source, offset = _unpack_str(payload, 1)
+        reason, offset = _unpack_str(payload, offset)
+        netid, offset = _unpack_str(payload, offset)
+        granted = bool(payload[0])
+    except (IndexError, UnicodeDecodeError) as e:
+        raise ProtocolError(f"malformed decision: {e}")
+    return Decision(granted=granted, netid=netid or None, source=source, reason=reason or None)
+
+def _split_frames(buf: bytearray, key: bytes) -> Iterator[Tuple[int, int, bytes]]:
+    '''
+    Yields (type, request ID, body) of every complete frame at the start of
+    `buf`, then removes them from it. Raises ProtocolError at the first
+    frame not signed with `key`.
+    '''
+    offset = 0
+    try:
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, type, request_id = FRAME_HEADER.unpack_from(buf, offset)
+            if not FRAME_HEADER.size - 4 + MAC_SIZE <= length <= MAX_FRAME:
+                raise ProtocolError(f"frame of {length} bytes")
+            end = offset + 4 + length
+            if end > len(buf):
+                break
+            signed = bytes(buf[offset:end - MAC_SIZE])
+            if not hmac.compare_digest(buf[end - MAC_SIZE:end], hmac.digest(key, signed, 'sha256')):
+                raise ProtocolError('frame not signed with remote.secret')
+            yield type, request_id, signed[FRAME_HEADER.size:]
+            offset = end
+    finally:
+        del buf[:offset]
+
+def _hello(buf: bytearray, secret: bytes) -> Optional[bytes]:
+    '''
+    The peer's nonce once its HELLO is complete in `buf`, which it has to
+    send before anything else.
+    '''
+    frames = list(_split_frames(buf, secret))
+    if not frames:
+        return None
+    type, _, body = frames[0]
+    if len(frames) > 1 or type != MSG_HELLO or len(body) != NONCE_SIZE:
+        raise ProtocolError('expected a hello to start the connection')
+    return body
+
+def handshake(sock: socket.socket, secret: bytes) -> Tuple[bytes, bytearray]:
+    '''
+    Exchange HELLOs with the daemon on the connected, blocking `sock`.
+    Returns the key of the connection and whatever followed the daemon's
+    HELLO.
+    '''
+    nonce = os.urandom(NONCE_SIZE)
+    sock.sendall(_frame(secret, MSG_HELLO, 0, nonce))
+    buf = bytearray()
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise ProtocolError('daemon closed the connection, check remote.secret')
+        buf += data
+        daemon_nonce = _hello(buf, secret)
+        if daemon_nonce is not None:
+            return _session_key(secret, nonce, daemon_nonce), buf
+
+@dataclass
+class RemoteSwipeEvent(SwipeEvent):
+    '''
+    A swipe received from a door node. Answer it with `reply()`.
+    '''
+    request_id: int = 0
+    connection: Optional['_Connection'] = field(default=None, repr=False, compare=False)
+
+    def reply(self, decision: Decision) -> None:
+        self.connection.send(encode_decision(self.connection.key, self.request_id, decision))
+
+class _Connection:
+    '''
+    A door node connected to the DecisionServer. Replies are sent from the
+    lookup threads; whatever the socket does not take at once is left in
+    `outbuf` for the server thread.
+    '''
+
+    def __init__(self, server: 'DecisionServer', sock: socket.socket, name: str) -> None:
+        self.server = server
+        self.sock = sock
+        self.name = name
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.closed = False
+        # signs the frames once the door node's HELLO was answered
+        self.key: Optional[bytes] = None
+        self.last_request_id = 0
+        # guards outbuf and closed
+        self.lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, data: bytes) -> None:
+        with self.lock:
+            if self.closed:
+                self.server.dropped_replies += 1
+                return
+            if not self.outbuf:
+                try:
+                    sent = self.sock.send(data)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except OSError:
+                    # the server thread notices the broken connection on its next read
+                    self.server.dropped_replies += 1
+                    return
+                data = data[sent:]
+                if not data:
+                    return
+            self.outbuf += data
+        self.server._want_write(self)
+
+    def flush(self) -> bool:
+        '''
+        Send what is left in `outbuf`. Returns True once it is empty.
+        '''
+        with self.lock:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except (BlockingIOError, InterruptedError):
+                return False
+            del self.outbuf[:sent]
+            return not self.outbuf
+
+class DecisionServer(CardReader):
+    '''
+    Accepts door nodes on `address` and yields their swipes from `events()`
+    as RemoteSwipeEvents, like a card reader does. Runs in the thread
+    iterating over `events()`.
+    '''
+    name = 'remote'
+
+    def __init__(self, logger: logging.Logger, address: str, secret: str) -> None:
+        self.logger = logger
+        self.address = address
+        self._secret = secret.encode()
+
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            # left behind by a daemon that did not shut down cleanly
+            os.unlink(sockaddr)
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(sockaddr)
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        self._unix_path = sockaddr if family == socket.AF_UNIX else None
+
+        self._connections: Dict[int, _Connection] = {}
+        # connections with replies waiting in their outbuf, guarded by _lock
+        self._writers: List[_Connection] = []
+        self._lock = threading.Lock()
+        self._stopped = False
+        # written to by reply threads and close() to wake events() from select()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+        self.accepted = 0
+        self.swipes = 0
+        self.protocol_errors = 0
+        self.dropped_replies = 0
+
+    @property
+    def bound_address(self):
+        return self._listener.getsockname()
+
+    def close(self) -> None:
+        self._stopped = True
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            # a wakeup is pending already
+            pass
+
+    def _want_write(self, connection: _Connection) -> None:
+        with self._lock:
+            self._writers.append(connection)
+        self._wake()
+
+    def events(self) -> Iterator[ReaderEvent]:
+        logger = self.logger
+        self.logger.info(f"Decision daemon listening on {self.address}")
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wake_r, selectors.EVENT_READ)
+            selector.register(self._listener, selectors.EVENT_READ)
+
+            while not self._stopped:
+                for key, mask in selector.select():
+                    fileobj = key.fileobj
+                    if fileobj == self._wake_r:
+                        try:
+                            while os.read(self._wake_r, 64):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        with self._lock:
+                            writers, self._writers = self._writers, []
+                        for connection in writers:
+                            if not connection.closed:
+                                selector.modify(connection, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                    elif fileobj is self._listener:
+                        self._accept(selector)
+                    else:
+                        connection = fileobj
+                        if connection.closed:
+                            continue
+                        if mask & selectors.EVENT_WRITE:
+                            try:
+                                if connection.flush():
+                                    selector.modify(connection, selectors.EVENT_READ)
+                            except OSError:
+                                self._close_connection(selector, connection)
+                                continue
+                        if mask & selectors.EVENT_READ:
+                            yield from self._read(selector, connection)
+
+            for connection in list(self._connections.values()):
+                self._close_connection(selector, connection)
+
+        self._listener.close()
+        if self._unix_path is not None:
+            os.unlink(self._unix_path)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        logger.info("Decision daemon stopped: no more swipes from door nodes will be received")
+
+    def _accept(self, selector: selectors.BaseSelector) -> None:
+        while True:
+            try:
+                sock, peer = self._listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. out of file descriptors, the door node retries
+                self.logger.error("Unable to accept a door node", exc_info=e)
+                return
+            sock.setblocking(False)
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            name = f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else (peer or f"#{self.accepted + 1}")
+            connection = _Connection(self, sock, name)
+            self._connections[sock.fileno()] = connection
+            selector.register(connection, selectors.EVENT_READ)
+            self.accepted += 1
+            self.logger.info(f"Door node {name} connected")
+
+    def _read(self, selector: selectors.BaseSelector, connection: _Connection) -> Iterator[ReaderEvent]:
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close_connection(selector, connection)
+            return
+
+        buf = connection.inbuf
+        buf += data
+        events = []
+        try:
+            if connection.key is None:
+                door_nonce = _hello(buf, self._secret)
+                if door_nonce is None:
+                    return
+                nonce = os.urandom(NONCE_SIZE)
+                connection.key = _session_key(self._secret, door_nonce, nonce)
+                connection.send(_frame(self._secret, MSG_HELLO, 0, nonce))
+            for type, request_id, body in _split_frames(buf, connection.key):
+                if type != MSG_SWIPE:
+                    raise ProtocolError(f"unexpected message type {type}")
+                # a replayed frame would be decided and audited again
+                if request_id <= connection.last_request_id:
+                    raise ProtocolError(f"request ID {request_id} after {connection.last_request_id}")
+                connection.last_request_id = request_id
+                id, lcc, reader, read_seconds = decode_swipe(body)
+                events.append(RemoteSwipeEvent(id=id, lcc=lcc, reader=reader, read_seconds=read_seconds, request_id=request_id, connection=connection))
+        except ProtocolError as e:
+            self.protocol_errors += 1
+            events.append(InvalidDataEvent(data=bytes(buf[:64]).hex(), exc_info=e, reader=connection.name))
+            self._close_connection(selector, connection)
+
+        self.swipes += len(events)
+        # yielded after parsing, the consumer may block while holding a frame
+        yield from events
+
+    def _close_connection(self, selector: selectors.BaseSelector, connection: _Connection) -> None:
+        with connection.lock:
+            if connection.closed:
+                return
+            connection.closed = True
+        self._connections.pop(connection.fileno(), None)
+        selector.unregister(connection)
+        connection.sock.close()
+        self.logger.info(f"Door node {connection.name} disconnected")
+
+    def stats(self) -> dict:
+        return {
+            'connections': len(self._connections),
+            'accepted': self.accepted,
+            'swipes': self.swipes,
+            'protocol_errors': self.protocol_errors,
+            'dropped_replies': self.dropped_replies,
+        }
+
+class RemoteDecider(threading.Thread):
+    '''
+    Decides a door node's swipes by asking the decision daemon. `decide()` is
+    safe to call from several lookup threads at once; their requests share
+    one connection. The thread itself keeps the connection up and reads the
+    answers.
+    '''
+
+    def __init__(self, logger: logging.Logger, config: Config, snapshot: AccessSnapshot) -> None:
+        super().__init__(name='remote', daemon=True)
+        self.logger = logger
+        self.config = config
+        # decides swipes while the daemon is unreachable
+        self.snapshot = snapshot
+
+        self._sock: Optional[socket.socket] = None
+        # signs the frames on _sock
+        self._key = b''
+        # guards _sock, _key, _pending and _request_ids, and keeps frames from interleaving
+        self._lock = threading.Lock()
+        # request ID -> answer of a swipe sent on the current connection
+        self._pending: Dict[int, Future] = {}
+        # restarted on every connection, the daemon wants them increasing
+        self._request_ids = itertools.count(1)
+        self._stop_event = threading.Event()
+        self.connected = threading.Event()
+
+        self.requests = 0
+        self.timeouts = 0
+        self.offline = 0
+        self.connects = 0
+
+    def decide(self, evt: SwipeEvent) -> Decision:
+        start = time.perf_counter()
+        decision = self._ask(evt)
+        if decision is None:
+            self.offline += 1
+            granted = Utils.decide_offline(evt.id, evt.lcc, self.logger, self.config, self.snapshot)
+            decision = Decision(granted=granted, source='offline', reason=f"offline_{self.config.offline.policy}")
+        decision.lookup_seconds = time.perf_counter() - start
+        return decision
+
+    def _ask(self, evt: SwipeEvent) -> Optional[Decision]:
+        '''
+        The daemon's decision, or None if it did not answer in time.
+        '''
+        reader = evt.reader if evt.reader not in (None, 'default') else self.config.remote.door
+        future = Future()
+        with self._lock:
+            sock = self._sock
+            if sock is None:
+                return None
+            request_id = next(self._request_ids) & 0xffffffff
+            self._pending[request_id] = future
+            try:
+                sock.sendall(encode_swipe(self._key, request_id, SwipeEvent(id=evt.id, lcc=evt.lcc, reader=reader, read_seconds=evt.read_seconds)))
+            except OSError as e:
+                del self._pending[request_id]
+                self.logger.warning(f"Unable to send ID: {evt.id} to the decision daemon: {e}")
+                return None
+        self.requests += 1
+
+        try:
+            return future.result(self.config.remote.timeout)
+        except FutureTimeoutError:
+            self.timeouts += 1
+            self.logger.warning(f"Decision daemon did not answer for ID: {evt.id} within {self.config.remote.timeout}s")
+        except ConnectionError as e:
+            self.logger.warning(f"Lost the decision daemon while deciding ID: {evt.id}: {e}")
+        with self._lock:
+            self._pending.pop(request_id, None)
+        return None
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def run(self) -> None:
+        backoff = 0.1
+        while not self._stop_event.is_set():
+            address = self.config.remote.connect
+            try:
+                sock, key, buf = self._connect(address)
+            except (OSError, ProtocolError) as e:
+                self.logger.warning(f"Unable to connect to the decision daemon at {address}, retrying in {backoff:.1f}s: {e}")
+                self._stop_event.wait(backoff)
+                backoff = min(self.config.remote.max_backoff, backoff * 2)
+                continue
+
+            backoff = 0.1
+            self.connects += 1
+            self.logger.info(f"Connected to the decision daemon at {address}")
+            with self._lock:
+                self._sock = sock
+                self._key = key
+                self._request_ids = itertools.count(1)
+            self.connected.set()
+            try:
+                self._receive(sock, key, buf)
+            except (OSError, ProtocolError) as e:
+                self.logger.warning(f"Connection to the decision daemon failed: {e}")
+
+            self.connected.clear()
+            with self._lock:
+                self._sock = None
+                pending, self._pending = self._pending, {}
+            sock.close()
+            for future in pending.values():
+                future.set_exception(ConnectionError('connection closed'))
+            if not self._stop_event.is_set():
+                self.logger.warning(f"Disconnected from the decision daemon at {address}, swipes are decided offline until it is back")
+
+    def _connect(self, address: str) -> Tuple[socket.socket, bytes, bytearray]:
+        '''
+        A connection to the daemon, its key, and what followed the handshake.
+        '''
+        family, sockaddr = parse_address(address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.config.remote.timeout)
+            sock.connect(sockaddr)
+            if family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            key, buf = handshake(sock, self.config.remote.secret.encode())
+        except (OSError, ProtocolError):
+            sock.close()
+            raise
+        return sock, key, buf
+
+    def _receive(self, sock: socket.socket, key: bytes, buf: bytearray) -> None:
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                # the timeout is meant for sends, an idle connection is fine
+                continue
+            if not data:
+                return
+            buf += data
+            for type, request_id, body in _split_frames(buf, key):
+                if type != MSG_DECISION:
+                    raise ProtocolError(f"unexpected message type {type}")
+                decision = decode_decision(body)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                # None if the swipe timed out meanwhile
+                if future is not None:
+                    future.set_result(decision)
+
+    def stats(self) -> dict:
+        return {
+            'connected': int(self.connected.is_set()),
+            'requests': self.requests,
+            'timeouts': self.timeouts,
+            'offline': self.offline,
+            'connects': self.connects,
+            'pending': len(self._pending),
+        }
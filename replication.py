@@ -0,0 +1,322 @@
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from access_cache import AccessCache, AccessEntry
+from config import Replication
+from remote import parse_address
+import hashlib
+import hmac
+import json
+import logging
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+
+'''
+Module for sharing the access cache between several GateKeepers.
+
+Every `replication.interval` seconds each node runs an anti-entropy exchange
+with each of its peers over TCP:
+
+    node -> peer: its digest, a hash of every bucket of the cache
+    peer -> node: its digest, and its records in the buckets whose hashes differ
+    node -> peer: its records in those buckets
+
+Cards are spread over BUCKETS buckets by a hash of their ID, and a bucket's
+hash is the XOR of the hashes of its records, so nodes that agree only send
+the digests (a few KB) and a changed card only costs its bucket. Both sides
+keep the newer version of every record (see `AccessCache.merge`). Removals
+are records too, so a removed account does not come back from a peer that
+missed the removal.
+
+Versions are time.time() values, so the nodes' clocks have to be in sync
+(NTP). Every message carries an HMAC-SHA256 with `replication.secret`;
+messages without a valid one are dropped. They are not encrypted, so keep
+replication on a trusted network.
+
+The live node with the lowest `replication.node` name is the leader and the
+only one whose SyncWorker polls IPA; the others get its results through
+replication. A node counts as live while it exchanged with this one within
+`replication.peer_timeout` seconds. LCC updates made by a swipe at any node
+reach the others with the next exchange, and a node starting with an empty
+or old cache is brought up to date by its first one.
+'''
+
+BUCKETS = 256
+FRAME = struct.Struct('!I')
+MAC_SIZE = hashlib.sha256().digest_size
+# far larger than a full cache of a few thousand accounts
+MAX_MESSAGE = 64 * 1024 * 1024
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class _Server6(_Server):
+    address_family = socket.AF_INET6
+
+class ReplicationError(Exception):
+    '''
+    Raised when a peer's message is invalid or not authentic.
+    '''
+
+def _bucket(id: str) -> int:
+    return zlib.crc32(id.encode()) % BUCKETS
+
+def _encode_entry(entry: AccessEntry) -> list:
+    return [entry.id, entry.uid, entry.lcc, sorted(entry.groups), entry.fetched_at, entry.changed_at]
+
+def _record_hash(record: list) -> int:
+    return int.from_bytes(hashlib.blake2b(json.dumps(record).encode(), digest_size=8).digest(), 'big')
+
+class _Digest:
+    '''
+    Hashes of the cache's buckets and their encoded records.
+    '''
+
+    def __init__(self, entries: List[AccessEntry], removed: Dict[str, float]) -> None:
+        self.hashes = [0] * BUCKETS
+        self.entries: List[List[list]] = [[] for _ in range(BUCKETS)]
+        self.removed: List[List[list]] = [[] for _ in range(BUCKETS)]
+        for entry in entries:
+            record = _encode_entry(entry)
+            bucket = _bucket(entry.id)
+            self.hashes[bucket] ^= _record_hash(record)
+            self.entries[bucket].append(record)
+        for id, removed_at in removed.items():
+            record = [id, removed_at]
+            bucket = _bucket(id)
+            self.hashes[bucket] ^= _record_hash(record)
+            self.removed[bucket].append(record)
+
+    def differing(self, hashes: List[int]) -> List[int]:
+        if len(hashes) != BUCKETS:
+            raise ReplicationError(f"digest of {len(hashes)} buckets")
+        return [bucket for bucket in range(BUCKETS) if hashes[bucket] != self.hashes[bucket]]
+
+    def records(self, buckets: List[int]) -> dict:
+        return {
+            'entries': [record for bucket in buckets for record in self.entries[bucket]],
+            'removed': [record for bucket in buckets for record in self.removed[bucket]],
+        }
+
+def _send(sock: socket.socket, secret: bytes, message: dict) -> int:
+    body = zlib.compress(json.dumps(message, separators=(',', ':')).encode(), 1)
+    mac = hmac.new(secret, body, hashlib.sha256).digest()
+    data = FRAME.pack(MAC_SIZE + len(body)) + mac + body
+    sock.sendall(data)
+    return len(data)
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ReplicationError('connection closed mid-message')
+    return data
+
+def _recv(f: BinaryIO, secret: bytes) -> Tuple[dict, int]:
+    '''
+    The next message from `f` and its size on the wire.
+    '''
+    size, = FRAME.unpack(_read_exact(f, FRAME.size))
+    if not MAC_SIZE <= size <= MAX_MESSAGE:
+        raise ReplicationError(f"message of {size} bytes")
+    data = _read_exact(f, size)
+    mac, body = data[:MAC_SIZE], data[MAC_SIZE:]
+    if not hmac.compare_digest(mac, hmac.new(secret, body, hashlib.sha256).digest()):
+        raise ReplicationError('message not signed with replication.secret')
+    decompressor = zlib.decompressobj()
+    try:
+        message = json.loads(decompressor.decompress(body, MAX_MESSAGE))
+    except (zlib.error, ValueError) as e:
+        raise ReplicationError(f"undecodable message: {e}")
+    if decompressor.unconsumed_tail:
+        raise ReplicationError(f"message larger than {MAX_MESSAGE} bytes")
+    return message, FRAME.size + size
+
+class Replicator(threading.Thread):
+    '''
+    Keeps `cache` in sync with the peers' caches and elects the node that
+    polls IPA. Serves the peers' exchanges from a thread per connection and
+    starts its own from this thread.
+
+    `on_merge` is called after records from a peer changed the cache, and
+    `on_leader` when this node becomes the leader.
+    '''
+
+    def __init__(self, logger: logging.Logger, config: Replication, cache: AccessCache, on_merge: Callable[[], None], on_leader: Callable[[], None]) -> None:
+        super().__init__(name='replication', daemon=True)
+        self.logger = logger
+        self.config = config
+        self.cache = cache
+        self.on_merge = on_merge
+        self.on_leader = on_leader
+        self.secret = config.secret.encode()
+
+        self._stop_event = threading.Event()
+        # set after the first round of exchanges, until then there is no leader
+        self.ready = threading.Event()
+        # peer node name -> time.monotonic() of the last exchange with it
+        self._seen: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        # (cache generation, digest), recomputed only after the cache changed
+        self._digest: Tuple[int, Optional[_Digest]] = (-1, None)
+        self._leader: Optional[str] = None
+
+        self.exchanges = 0
+        self.failures = 0
+        self.rejected = 0
+        self.records_sent = 0
+        self.records_received = 0
+        self.records_merged = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        replicator = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                replicator._serve(self.connection, self.rfile, self.client_address)
+
+        family, address = parse_address(config.listen)
+        self._server = (_Server6 if family == socket.AF_INET6 else _Server)(address, Handler)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(config.peers)), thread_name_prefix='replication')
+
+    @property
+    def bound_address(self):
+        return self._server.server_address
+
+    def leader(self) -> Optional[str]:
+        '''
+        Name of the live node with the lowest name, None before the first
+        round of exchanges.
+        '''
+        if not self.ready.is_set():
+            return None
+        now = time.monotonic()
+        with self._lock:
+            alive = [node for node, seen_at in self._seen.items() if now - seen_at < self.config.peer_timeout]
+        return min(alive + [self.config.node])
+
+    def is_leader(self) -> bool:
+        return self.leader() == self.config.node
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+        self._executor.shutdown(wait=False)
+
+    def run(self) -> None:
+        threading.Thread(target=self._server.serve_forever, name='replication-server', daemon=True).start()
+        self.logger.info(f"Replicating the access cache as {self.config.node} on {self.config.listen} with {', '.join(self.config.peers) or 'no peers yet'}")
+
+        while not self._stop_event.is_set():
+            start = time.monotonic()
+            list(self._executor.map(self._exchange, self.config.peers))
+            if not self.ready.is_set():
+                self.ready.set()
+                self.logger.info(f"First replication round took {(time.monotonic() - start) * 1000:.0f}ms, cache holds {len(self.cache)}")
+
+            leader = self.leader()
+            if leader != self._leader:
+                self.logger.info(f"{'This node' if leader == self.config.node else leader} now polls IPA for the access cache")
+                self._leader = leader
+                if leader == self.config.node:
+                    self.on_leader()
+            self._stop_event.wait(self.config.interval)
+
+    def _current_digest(self) -> _Digest:
+        # removed() drops old removals, which changes the generation, so it goes first
+        removed = self.cache.removed()
+        generation = self.cache.generation
+        with self._lock:
+            if self._digest[0] == generation:
+                return self._digest[1]
+        digest = _Digest(self.cache.entries(), removed)
+        with self._lock:
+            self._digest = (generation, digest)
+        return digest
+
+    def _mark_seen(self, node: object) -> None:
+        if not isinstance(node, str):
+            raise ReplicationError('message without a node name')
+        if node == self.config.node:
+            raise ReplicationError(f"peer uses this node's name {node!r}, replication.node has to be unique")
+        with self._lock:
+            self._seen[node] = time.monotonic()
+
+    def _merge(self, records: dict) -> None:
+        try:
+            entries = [AccessEntry(id=id, uid=uid, lcc=lcc, groups=list(groups), fetched_at=float(fetched_at), changed_at=float(changed_at)) for id, uid, lcc, groups, fetched_at, changed_at in records['entries']]
+            removed = {id: float(removed_at) for id, removed_at in records['removed']}
+        except (KeyError, TypeError, ValueError) as e:
+            raise ReplicationError(f"invalid records: {e}")
+        self.records_received += len(entries) + len(removed)
+        merged = self.cache.merge(entries, removed)
+        if merged:
+            self.records_merged += merged
+            self.on_merge()
+
+    def _exchange(self, peer: str) -> None:
+        family, address = parse_address(peer)
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                sock.settimeout(min(self.config.interval, 5.0))
+                sock.connect(address)
+                f = sock.makefile('rb')
+                digest = self._current_digest()
+                self.bytes_sent += _send(sock, self.secret, {'node': self.config.node, 'digest': digest.hashes})
+
+                reply, size = _recv(f, self.secret)
+                self.bytes_received += size
+                self._mark_seen(reply.get('node'))
+                differing = digest.differing(reply['digest'])
+                records = digest.records(differing)
+                self.records_sent += len(records['entries']) + len(records['removed'])
+                self.bytes_sent += _send(sock, self.secret, {'records': records})
+                self._merge(reply['records'])
+            self.exchanges += 1
+        except (OSError, ReplicationError, KeyError) as e:
+            self.failures += 1
+            self.logger.debug(f"Replication with {peer} failed: {e}")
+
+    def _serve(self, sock: socket.socket, f: BinaryIO, peer) -> None:
+        try:
+            sock.settimeout(min(self.config.interval, 5.0))
+            request, size = _recv(f, self.secret)
+            self.bytes_received += size
+            self._mark_seen(request.get('node'))
+            digest = self._current_digest()
+            differing = digest.differing(request['digest'])
+            records = digest.records(differing)
+            self.records_sent += len(records['entries']) + len(records['removed'])
+            self.bytes_sent += _send(sock, self.secret, {'node': self.config.node, 'digest': digest.hashes, 'records': records})
+
+            request, size = _recv(f, self.secret)
+            self.bytes_received += size
+            self._merge(request['records'])
+        except ReplicationError as e:
+            self.rejected += 1
+            self.logger.warning(f"Rejected replication from {peer}: {e}")
+        except (OSError, KeyError) as e:
+            self.failures += 1
+            self.logger.debug(f"Replication from {peer} failed: {e}")
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            peers_alive = sum(now - seen_at < self.config.peer_timeout for seen_at in self._seen.values())
+        return {
+            'leader': int(self.is_leader()),
+            'peers_alive': peers_alive,
+            'exchanges': self.exchanges,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'records_sent': self.records_sent,
+            'records_received': self.records_received,
+            'records_merged': self.records_merged,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
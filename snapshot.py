@@ -0,0 +1,141 @@
+from typing import Iterable, Optional
+from access_cache import GROUPS, AccessEntry
+import bisect
+import logging
+import mmap
+import os
+import pathlib
+import struct
+
+'''
+Module for the persisted snapshot of authorized cards used while IPA is
+unreachable.
+
+The snapshot is a small binary file:
+
+    HEADER: magic b'GKS1', <u32 record count>
+    RECORD: <u32 card id><u8 minimum LCC>, sorted by card id
+
+It is memory-mapped on load, so opening it costs the same no matter how many
+cards it holds, and a lookup is a binary search over the mapped records.
+'''
+
+MAGIC = b'GKS1'
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<IB')
+
+class _RecordKeys:
+    '''
+    Sequence view over the card IDs in the mapped file, so `bisect` can search
+    it without copying anything.
+    '''
+
+    def __init__(self, buf: mmap.mmap, count: int) -> None:
+        self.buf = buf
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> int:
+        return RECORD.unpack_from(self.buf, HEADER.size + i * RECORD.size)[0]
+
+class AccessSnapshot:
+    '''
+    Read-only view of the authorized (card id, minimum LCC) pairs on disk.
+    '''
+
+    def __init__(self, logger: logging.Logger, path: Optional[os.PathLike]) -> None:
+        self.logger = logger
+        self.path = path
+        self._buf: Optional[mmap.mmap] = None
+        self._keys: Optional[_RecordKeys] = None
+
+    def __len__(self) -> int:
+        return len(self._keys) if self._keys is not None else 0
+
+    def load(self) -> None:
+        '''
+        Map the snapshot file into memory. A missing or corrupt file leaves the
+        snapshot empty.
+        '''
+        if not self.path:
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or len(buf) != HEADER.size + count * RECORD.size:
+                raise ValueError(f"{self.path} is not a valid access snapshot")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            self.logger.warning(f"Unable to load access snapshot from {self.path}", exc_info=e)
+            return
+
+        # the old mapping is not closed explicitly: a lookup on another thread
+        # may still hold it, it is unmapped once the last reference is gone
+        self._buf = buf
+        self._keys = _RecordKeys(buf, count)
+
+    def min_lcc(self, id: str) -> Optional[int]:
+        '''
+        Returns the minimum LCC accepted for the card ID, or None if the card is
+        not authorized.
+        '''
+        keys = self._keys
+        if keys is None or not id.isdigit():
+            return None
+
+        key = int(id)
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return RECORD.unpack_from(keys.buf, HEADER.size + i * RECORD.size)[1]
+        return None
+
+    def allows(self, id: str, lcc: str) -> bool:
+        min_lcc = self.min_lcc(id)
+        if min_lcc is None:
+            return False
+        try:
+            return int(lcc) >= min_lcc
+        except ValueError:
+            return False
+
+    def write(self, entries: Iterable[AccessEntry], allowed_groups: set) -> int:
+        '''
+        Replace the snapshot on disk with the authorized entries and map the
+        new file. Returns the number of records written.
+        '''
+        if not self.path:
+            return 0
+
+        records = {}
+        allowed_mask = GROUPS.register(allowed_groups)
+        for entry in entries:
+            if not entry.group_mask & allowed_mask:
+                continue
+            try:
+                id, lcc = int(entry.id), int(entry.lcc)
+            except ValueError:
+                # the snapshot only holds numeric card ids and LCCs, anything
+                # else could never be swiped anyway
+                continue
+            if 0 <= id <= 0xFFFFFFFF and 0 <= lcc <= 0xFF:
+                records[id] = lcc
+
+        try:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, len(records)))
+                for id in sorted(records):
+                    f.write(RECORD.pack(id, records[id]))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.logger.warning(f"Unable to save access snapshot to {self.path}", exc_info=e)
+            return 0
+
+        self.load()
+        return len(records)
@@ -1,24 +1,102 @@
-from typing import Union
+from typing import Optional, Union
 from utils import Utils
-import serial
+from config import Strike as StrikeConfig
 import logging
+import os
+import tempfile
+import threading
 import time
-import serial.tools.list_ports
 
 class Strike():
     """
     Parent class for ArduinoStrike and RasPiStrike. Used for testing purposes as well.
+
+    `strike()` never blocks: it engages the strike and hands the release to an
+    actuator thread that closes it `hold_time` seconds later. A grant while
+    the strike is already open extends the hold instead of queuing another
+    pulse. Subclasses implement `_engage()`, which returns whether the strike
+    was engaged, and `_release()`.
     """
     
-    def __init__(self, logger: logging.Logger) -> None:
+    def __init__(self, logger: logging.Logger, hold_time: float = 5.0) -> None:
         self.logger = logger
+        self.hold_time = hold_time
+
+        # monotonic time at which the strike should close, None while closed.
+        # Engaging and releasing both happen under this lock, so a grant can
+        # never be undone by a release racing with it.
+        self._release_at: Optional[float] = None
+        self._cond = threading.Condition()
+        self._actuator: Optional[threading.Thread] = None
+        self._closed = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._release_at is not None
 
-    def strike(self):
+    def strike(self) -> bool:
         """
-        Strike function for testing purposes.
+        Open the door for `hold_time` seconds without waiting for it to close.
+        Returns False if the strike could not be engaged.
         """
-        
+
+        with self._cond:
+            if self._closed or not self._engage():
+                # an open strike still closes at its current deadline
+                return False
+            extended = self._release_at is not None
+            self._release_at = time.monotonic() + self.hold_time
+
+            if self._actuator is None:
+                self._actuator = threading.Thread(target=self._actuate, name='strike-actuator', daemon=True)
+                self._actuator.start()
+            self._cond.notify()
+
+        if extended:
+            self.logger.debug(f"Strike already open, hold extended by {self.hold_time}s")
+        return True
+
+    def _actuate(self) -> None:
+        with self._cond:
+            while not self._closed:
+                if self._release_at is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = self._release_at - time.monotonic()
+                if remaining > 0:
+                    # woken early if a new grant moves the deadline
+                    self._cond.wait(remaining)
+                    continue
+
+                self._release_at = None
+                self._release()
+
+    def close(self) -> None:
+        """
+        Release the strike if it is open, stop the actuator thread and free
+        the hardware, so another Strike can take over after a config change.
+        """
+
+        with self._cond:
+            self._closed = True
+            if self._release_at is not None:
+                self._release_at = None
+                self._release()
+            self._cond.notify()
+        if self._actuator is not None:
+            self._actuator.join()
+
+    def _engage(self) -> bool:
+        """
+        Fake strike for testing purposes.
+        """
+
         self.logger.info("Fake strike activated!")
+        return True
+
+    def _release(self) -> None:
+        self.logger.info("Fake strike released.")
 
 class RasPiStrike(Strike):
     """
@@ -26,82 +104,109 @@ class RasPiStrike(Strike):
     """
 
     channel = 36
-    def __init__(self, logger: logging.Logger) -> None:
+    def __init__(self, logger: logging.Logger, hold_time: float = 5.0) -> None:
         import RPi.GPIO as GPIO
-        self.logger = logger
+        super().__init__(logger, hold_time)
         self.GPIO = GPIO
         GPIO.setmode(GPIO.BOARD)
         GPIO.setup(self.channel,GPIO.OUT)
         
-    def strike(self):
+    def _engage(self) -> bool:
         """
         Implementation of striking the door using the Raspberry Pi's pins.
         """
         #self.logger.info("RasPi Striking!")
         self.GPIO.output(self.channel,self.GPIO.HIGH)
-        time.sleep(5.0)
+        return True
+
+    def _release(self) -> None:
         self.GPIO.output(self.channel,self.GPIO.LOW)
 
+    def close(self) -> None:
+        super().close()
+        self.GPIO.cleanup(self.channel)
+
 class ArduinoStrike(Strike):
     """
     Class implementation of striking the door using an Arduino.
+
+    The sketch closes the strike on its own 5 seconds after the last '1', so
+    a `hold_time` longer than that is cut short by the Arduino.
     """
 
-    def __init__(self, logger: logging.Logger) -> None:
-        self.logger = logger
-        self.arduino = self.find_arduino()
-        
-    def find_arduino(self) -> serial.Serial:
-        """
-        Find the Arduino's serial connection by testing 
-        all serial connections until the Arduino is found. 
-        """
-        
-        ports = serial.tools.list_ports.comports()
-        for port in ports:
-            try:
-                ser = serial.Serial(port.device, 9600, timeout=1)
-                time.sleep(2)  # Allow some time for connection stabilization
-                ser.write(b'Q')  # Query the device
-                response = ser.readline().decode().strip()
-                if response == "Arduino_Online":
-                    self.logger.info(f"Arduino found on port {port.device}")
-                    return ser
-            except Exception as e:
-                self.logger.warning(f"Exception: {str(e)}")
-                continue  # Go to the next port
-        
-        self.logger.error("Arduino not found")
-        return None
-    
-    def strike(self) -> None:
+    def __init__(self, logger: logging.Logger, hold_time: float = 5.0, port: Optional[str] = None, state_path: Optional[str] = None, heartbeat: float = 30.0) -> None:
+        # pyserial is only needed, and imported, for the Arduino
+        from arduino import ArduinoConnection
+
+        super().__init__(logger, hold_time)
+        # finds the Arduino in the background, strikes before it is found are
+        # logged and dropped
+        self.arduino = ArduinoConnection(logger, port=port, state_path=state_path, heartbeat=heartbeat)
+        self.arduino.start()
+
+    def _engage(self) -> bool:
         """
         Implementation of striking the door using the Arduino.
         """
 
-        if self.arduino is not None:
-            try:
-                self.arduino.write(b'1')
-            except Exception as e:
-                self.logger.error(f"Error striking: {str(e)}")
-        else:
+        if not self.arduino.connected:
             self.logger.warning("Strike not sent; Arduino not available.")
+            return False
+        if not self.arduino.write(b'1'):
+            self.logger.error("Error striking; reconnecting to the Arduino.")
+            return False
+        return True
+
+    def _release(self) -> None:
+        self.arduino.write(b'0')
+
+    def close(self) -> None:
+        super().close()
+        self.arduino.stop()
 
-def get_strike_for_method(method: Union['fake', 'arduino', 'pi'], logger: logging.Logger) -> Strike:
+def get_strike_for_method(method: Union['fake', 'arduino', 'pi'], logger: logging.Logger, config: StrikeConfig) -> Strike:
     if method == 'fake':
-        return Strike(logger)
+        return Strike(logger, config.hold_time)
     elif method == 'arduino':
-        return ArduinoStrike(logger)
+        return ArduinoStrike(logger, config.hold_time, port=config.arduino_port, state_path=config.arduino_state, heartbeat=config.arduino_heartbeat)
     elif method == 'pi':
-        return RasPiStrike(logger)
+        return RasPiStrike(logger, config.hold_time)
     else:
         raise TypeError(f'Expected method to be one of fake, arduino, pi, but got `{method}`')
 
 def main():
-    # Testing
-    logger = Utils.setup_custom_logger(__name__)
-    strike_controller = Strike(logger)
-    strike_controller.strike()
+    # Testing: feed swipes at random intervals through the swipe loop's
+    # act_on_decision() with the fake strike, and show that the time from
+    # swipe to handled decision is the same whether the door is being held
+    # open or not.
+    from cardreader import SwipeEvent
+    from decision import Decision
+    from main import act_on_decision
+    from metrics import Metrics
+    import random
+
+    # the log file is only needed by the logger, the results go to the screen
+    logger = Utils.setup_custom_logger(__name__, log_file=os.path.join(tempfile.gettempdir(), 'gatekeeper_strike_test.log'))
+    strike_controller = Strike(logger, hold_time=1.0)
+    metrics = Metrics()
+
+    latencies = {True: [], False: []}
+    for i in range(40):
+        was_open = strike_controller.is_open
+        evt = SwipeEvent(id=f"{i:08d}", lcc='01', reader='default')
+        act_on_decision(logger, metrics, strike_controller, None, evt, Decision(granted=True, netid=f"user{i}"))
+        latencies[was_open].append(time.monotonic() - evt.received_at)
+        time.sleep(random.choice([0.05, 0.2, 1.5]))
+
+    for was_open, values in latencies.items():
+        if values:
+            values.sort()
+            print(f"swipe to handled decision with the door {'open' if was_open else 'closed'}: {len(values)} swipes, median {values[len(values) // 2] * 1e6:.0f}us, max {values[-1] * 1e6:.0f}us")
+
+    # let the hold run out
+    time.sleep(strike_controller.hold_time + 0.5)
+    print(f"Strike open after hold time: {strike_controller.is_open}")
+    strike_controller.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,10 +1,18 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 import os
 import pathlib
 import configparser
+from typing import Optional
 from account import Account
-from python_freeipa import ClientMeta
+from access_cache import AccessCache
+from snapshot import AccessSnapshot
+from lcc_writeback import LCCWriteback
+from policy import Policy
+from ipa_client import IPAClient, IPAUnavailable
 from config import Config
 
 class Utils():
@@ -23,6 +31,10 @@ class Utils():
     def setup_custom_logger(name: str, log_file: str) -> logging.Logger:
         """
         Function to return a Logger with all the previously specified options.
+
+        Log calls only put the record on a queue. The file and the screen are
+        written by a listener thread, so a slow disk or terminal never delays
+        a swipe. The listener is stopped, writing out what is left, at exit.
         """
 
         # Ensure directory containing the log_file exists
@@ -34,10 +46,15 @@ class Utils():
         handler.setFormatter(formatter)
         screen_handler = logging.StreamHandler(stream=sys.stdout)
         screen_handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, handler, screen_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
         logger = logging.getLogger(name)
         logger.setLevel(logging.DEBUG)
-        logger.addHandler(handler)
-        logger.addHandler(screen_handler)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
         return logger
     
     def check_log_path_cfg():
@@ -52,25 +69,48 @@ class Utils():
         
         return path
     
-    def setup_ipa_client(logger: logging.Logger, config: Config) -> ClientMeta:
-        client = None
+    def setup_ipa_client(logger: logging.Logger, config: Config) -> Optional[IPAClient]:
+        """
+        Log in to IPA. Returns `None` only if the config does not make a
+        client. If the servers can not be reached, the client is returned
+        anyway and keeps logging in in the background, with its own backoff;
+        swipes are decided by the offline policy until it succeeds. The
+        returned client renews its session in the background.
+        """
 
         try:
-            client = ClientMeta(config.credentials.host, verify_ssl=config.credentials.verify_ssl)
-            client.login(config.credentials.username, config.credentials.password)
+            client = IPAClient(logger, config.credentials, config.ipa)
+        except Exception as e:
+            logger.error(f"Unable to set up the IPA client for {config.credentials.host}. Check the [credentials] and [ipa] sections.", exc_info=e)
+            return None
 
-            logger.info(f"Successfuly logged in to IPA at {config.credentials.host} as: {config.credentials.username}")
+        try:
+            client.login()
         except Exception as e:
-            logger.critical(f"Unable to connect to IPA server at {config.credentials.host}. Check credentials.", exc_info=e)
-            Utils.exit(logger, msg = "Forcing exit...")
+            logger.error(f"Unable to connect to IPA server at {config.credentials.host}, retrying in the background. Check credentials.", exc_info=e)
 
+        client.start()
         return client
 
-    def get_account_from_ipa(id: str, lcc: str, logger: logging.Logger, client: ClientMeta, config: Config) -> Account:
+    def get_account_from_ipa(id: str, lcc: str, logger: logging.Logger, client: IPAClient, config: Config, cache: Optional[AccessCache] = None, writeback: Optional[LCCWriteback] = None, policy: Optional[Policy] = None, door: Optional[str] = None) -> Account:
         account: Account = None
 
+        entry = cache.get(id) if cache is not None else None
+        if entry is None and client is None:
+            # not logged in to IPA (yet), nothing to look the card up in
+            return None
+
         try:
-            account = Account(id, lcc, client, logger, config)
+            account = Account(id, lcc, client, logger, config, entry=entry, writeback=writeback, policy=policy, door=door)
+
+            # with a deferred LCC write-back, this is what makes the next swipe
+            # see the new LCC before IPA does
+            if cache is not None and (entry is None or account.lcc_updated):
+                new_entry = account.to_access_entry()
+                if new_entry is not None:
+                    cache.put(new_entry)
+        except IPAUnavailable as e:
+            logger.warning(f"Unable to look up ID: {id}, LCC: {lcc}: {e}")
         except Exception as e:
             # Note: This may log errors from python-freeipa. Inspecting the
             # library source shows this will not leak any credentials into the
@@ -79,6 +119,22 @@ class Utils():
 
         return account
     
+    def decide_offline(id: str, lcc: str, logger: logging.Logger, config: Config, snapshot: AccessSnapshot) -> bool:
+        """
+        Decide a swipe according to `offline.policy` while IPA is unreachable.
+        """
+
+        policy = config.offline.policy
+        if policy == 'open':
+            granted = True
+        elif policy == 'snapshot':
+            granted = snapshot.allows(id, lcc)
+        else:
+            granted = False
+
+        logger.warning(f"IPA unreachable, {'granting' if granted else 'denying'} access to ID: {id} LCC: {lcc} per offline policy '{policy}'")
+        return granted
+
     def exit(logger: logging.Logger, msg = "Exiting...") -> None:
         """
         Logger behavior on exit.